@@ -1,9 +1,11 @@
 # Embeddings and vocabulary utility methods
 import codecs
+import hashlib
 import logging
 import re
 import os
 from collections import defaultdict
+from collections.abc import Mapping
 
 import json
 import nltk
@@ -210,6 +212,117 @@ def load_word_embeddings(path):
     return embeddings, word2idx
 
 
+class Vocabulary(Mapping):
+    def __init__(self, path_to_vocabulary):
+        """
+        A read-only word to index mapping backed by a vocabulary file with one word per line, the line number
+        is the index of the word. The file is only read on the first access. Unknown words are mapped
+        to the index of the unknown token, the same as with the dictionary returned by load_word_embeddings.
+
+        :param path_to_vocabulary: location of the vocabulary file
+        """
+        self.path_to_vocabulary = path_to_vocabulary
+        self._word2idx = None
+
+    def _get_word2idx(self):
+        if self._word2idx is None:
+            word2idx = {}
+            with codecs.open(self.path_to_vocabulary, 'r', encoding='utf-8') as f:
+                for idx, line in enumerate(f):
+                    word = line.rstrip("\n")
+                    if word:
+                        word2idx[word] = idx
+            self._word2idx = word2idx
+        return self._word2idx
+
+    def __getitem__(self, word):
+        word2idx = self._get_word2idx()
+        return word2idx[word] if word in word2idx else word2idx[unknown_el]
+
+    def get(self, word, default=None):
+        return self._get_word2idx().get(word, default)
+
+    def __contains__(self, word):
+        return word in self._get_word2idx()
+
+    def __iter__(self):
+        return iter(self._get_word2idx())
+
+    def __len__(self):
+        return len(self._get_word2idx())
+
+
+def save_word_embeddings_binary(embeddings, word2idx, path_prefix):
+    """
+    Store the embeddings as a .npy matrix and the words as a .vocab file with one word per line.
+
+    :param embeddings: embeddings as a numpy array
+    :param word2idx: word to index dictionary
+    :param path_prefix: the output location without the extension
+    """
+    np.save(path_prefix + ".npy", np.asarray(embeddings, dtype='float32'))
+    save_vocabulary(word2idx, embeddings.shape[0], path_prefix + ".vocab")
+
+
+def save_vocabulary(word2idx, vocabulary_size, path_to_vocabulary):
+    """
+    Store the words in a file with one word per line, so that it can be read with Vocabulary.
+
+    :param word2idx: word to index dictionary
+    :param vocabulary_size: the number of indices, the unused indices are left empty
+    :param path_to_vocabulary: the output location
+    """
+    idx2word = [""] * vocabulary_size
+    for word, idx in word2idx.items():
+        idx2word[idx] = word
+    with codecs.open(path_to_vocabulary, 'w', encoding='utf-8') as out:
+        out.write("\n".join(idx2word) + "\n")
+
+
+def get_file_hash(path_to_file):
+    """
+    Compute the SHA-1 digest of the file contents.
+
+    :param path_to_file: location of the file
+    :return: the digest as a hex string
+    """
+    digest = hashlib.sha1()
+    with open(path_to_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_vocabulary_hash(word2idx):
+    """
+    Compute the SHA-1 digest of a word to index mapping that doesn't depend on the order of the words.
+
+    :param word2idx: word to index dictionary or a Vocabulary
+    :return: the digest as a hex string
+    >>> get_vocabulary_hash({'a': 2, 'b': 3}) == get_vocabulary_hash({'b': 3, 'a': 2})
+    True
+    >>> get_vocabulary_hash({'a': 2, 'b': 3}) == get_vocabulary_hash({'a': 3, 'b': 2})
+    False
+    """
+    digest = hashlib.sha1()
+    for word, idx in sorted(word2idx.items()):
+        digest.update(f"{word}\t{idx}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def load_word_embeddings_binary(path_prefix):
+    """
+    Loads embeddings stored with save_word_embeddings_binary. The matrix is memory-mapped and
+    the vocabulary is read on the first access.
+
+    :param path_prefix: the location of the embeddings without the extension
+    :return: (embeddings as a read-only numpy array, word to index mapping)
+    """
+    embeddings = np.load(path_prefix + ".npy", mmap_mode='r')
+    logger.debug("Loaded: {}".format(embeddings.shape))
+    return embeddings, Vocabulary(path_prefix + ".vocab")
+
+
 def get_idx(word, word2idx):
     """
     Get the word index for the given word. Maps all numbers to 0, lowercases if necessary.
@@ -0,0 +1,55 @@
+import json
+import sys
+
+import click
+import tqdm
+
+PATH_EL = "../entity-linking/"
+sys.path.insert(0, PATH_EL)
+from entitylinking import core
+
+from questionanswering import config_utils
+from questionanswering.construction import sentence
+from questionanswering.grounding import neighbourhood_index, query_cache
+
+
+@click.command()
+@click.argument('config_file_path', default="default_config.yaml")
+def build(config_file_path):
+
+    config, logger = config_utils.load_config(config_file_path)
+    if "neighbourhood.index" not in config:
+        logger.error("Neighbourhood index parameters not in the config file!")
+        sys.exit()
+    index_config = config['neighbourhood.index']
+    linking_config = config['entity.linking']
+
+    with open(index_config['questions']) as f:
+        questions = json.load(f)
+    logger.info('Loaded questions, size: {}'.format(len(questions)))
+
+    logger.info("Load entity linker")
+    entitylinker = getattr(core, linking_config['linker'])(logger=logger, **linking_config['linker.options'])
+
+    entityids = []
+    for q_obj in tqdm.tqdm(questions, ncols=100):
+        q = q_obj.get('utterance', q_obj.get('question'))
+        sent = entitylinker.link_entities_in_raw_input(q, element_id=q_obj['questionid'])
+        if "max.num.entities" in index_config:
+            sent.entities = sent.entities[:index_config["max.num.entities"]]
+        sent = sentence.Sentence(input_text=sent.input_text, tagged=sent.tagged, entities=sent.entities)
+        # Common nouns are only used as classes and are never grounded with ungrounded relations
+        entityids.extend(kbID for e in sent.graphs[0].graph.free_entities if e.get("type") not in {'NN', 'YEAR'}
+                         for kbID, _ in e.get("linkings", []) if kbID)
+    entityids = list(dict.fromkeys(entityids))
+    logger.info("Entities to index: {}".format(len(entityids)))
+
+    added = neighbourhood_index.build_index(tqdm.tqdm(entityids, ncols=100), index_config['save.to'],
+                                            leg_length=index_config.get('leg.length', neighbourhood_index.DEFAULT_LEG_LENGTH))
+    print("Entities added to the index: {}".format(added))
+    if query_cache.CACHE is not None:
+        print("Query cache: {}".format(query_cache.CACHE.stats()))
+
+
+if __name__ == "__main__":
+    build()
@@ -6,13 +6,14 @@ import random
 import numpy as np
 import torch
 
-from questionanswering.grounding import staged_generation
+from questionanswering.grounding import staged_generation, query_cache, local_store, graph_queries, neighbourhood_index, \
+    async_queries
 from wikidata import endpoint_access
 
 
 def load_config(config_file_path, seed=-1, gpuid=-1):
     with open(config_file_path, 'r') as config_file:
-        config = yaml.load(config_file.read())
+        config = yaml.safe_load(config_file.read())
     print(config)
     config_global = config.get('global', {})
 
@@ -35,6 +36,28 @@ def load_config(config_file_path, seed=-1, gpuid=-1):
 
     if "wikidata" in config:
         endpoint_access.set_backend(config['wikidata']['backend'])
+        if 'local.store' in config['wikidata']:
+            query_cache.set_local_backend(local_store.TripleStore.from_file(config['wikidata']['local.store']))
+            logger.info("Local triple store: {}".format(config['wikidata']['local.store']))
+        if 'neighbourhood.index' in config['wikidata']:
+            graph_queries.set_neighbourhood_index(
+                neighbourhood_index.NeighbourhoodIndex(config['wikidata']['neighbourhood.index']))
+            logger.info("Neighbourhood index: {}".format(config['wikidata']['neighbourhood.index']))
+        if 'cache.path' in config['wikidata']:
+            query_cache.set_cache(query_cache.SparqlCache(config['wikidata']['cache.path'],
+                                                          max_entries=config['wikidata'].get('cache.max.entries',
+                                                                                             query_cache.DEFAULT_MAX_ENTRIES),
+                                                          read_only=config['wikidata'].get('cache.read.only', False)))
+            logger.info("Query cache: {}".format(config['wikidata']['cache.path']))
+        if 'grounding.workers' in config['wikidata']:
+            staged_generation.set_grounding_workers(config['wikidata']['grounding.workers'])
+            query_cache.set_max_concurrent_queries(config['wikidata'].get('max.concurrent.queries', 0))
+            logger.info("Grounding workers: {}".format(config['wikidata']['grounding.workers']))
+        if config['wikidata'].get('async.grounding', False):
+            query_cache.set_max_concurrent_queries(config['wikidata'].get('max.concurrent.queries', 0))
+            staged_generation.set_async_grounder(async_queries.AsyncGrounder(
+                config['wikidata']['backend'], timeout=config['wikidata'].get('timeout', async_queries.DEFAULT_TIMEOUT)))
+            logger.info("Asynchronous grounding")
 
     if torch.cuda.is_available():
         logger.info("Using your CUDA device")
@@ -1,4 +1,5 @@
 import collections
+import hashlib
 import itertools
 from collections import namedtuple
 from copy import copy
@@ -9,6 +10,8 @@ from questionanswering import base_objects
 
 WithScore = namedtuple("WithScore", ['graph', 'scores'])
 
+QUESTION_VAR = "?qvar"
+
 
 class Edge:
     def __init__(self,
@@ -99,6 +102,9 @@ class EdgeList(collections.MutableSequence):
     def __getitem__(self, i):
         return self._list[i]
 
+    def __iter__(self):
+        return iter(self._list)
+
     def __delitem__(self, i):
         del self._list[i]
 
@@ -147,6 +153,64 @@ class SemanticGraph:
     def get_ungrounded_edges(self):
         return [edge for edge in self.edges if not edge.grounded]
 
+    def canonical_edges(self):
+        """
+        Order the edges of the graph canonically: the order doesn't depend on the edge ids, on the order in which
+        the edges were added or on the names of the intermediate variables.
+
+        :return: a list of (signature, edge) tuples in the canonical order
+        >>> SemanticGraph([Edge(leftentityid=QUESTION_VAR, rightentityid="Q5"), Edge(leftentityid="Q76", rightentityid=QUESTION_VAR)]).canonical_edges()
+        [(('?qvar', '', 'Q5', '', ''), Edge(0, ?qvar-None->Q5)), (('Q76', '', '?qvar', '', ''), Edge(1, Q76-None->?qvar))]
+        """
+        # The intermediate variables are told apart by what they connect to: the label of a variable is refined
+        # with the sorted signatures of its edges until the labels are stable. The edges are ordered with the labels
+        # and the variables are then named in the order of their first appearance
+        variables = sorted({n for e in self.edges for n in e.nodes() if _is_intermediate_variable(n)})
+        var2name = {n: "?v" for n in variables}
+        for _ in range(len(variables)):
+            refined = {n: sorted(_edge_signature(e, {**var2name, n: "?self"}) for e in self.edges if n in e.nodes())
+                       for n in variables}
+            labels = sorted(set(map(repr, refined.values())))
+            if len(labels) == len(set(var2name.values())):
+                break
+            var2name = {n: f"?v{labels.index(repr(refined[n]))}" for n in variables}
+        ordered = sorted(self.edges, key=lambda e: _edge_signature(e, var2name))
+        var2name = {}
+        for e in ordered:
+            for n in e.nodes():
+                if _is_intermediate_variable(n) and n not in var2name:
+                    var2name[n] = f"?v{len(var2name)}"
+        return sorted([(_edge_signature(e, var2name), e) for e in ordered], key=lambda x: x[0])
+
+    def fingerprint(self):
+        """
+        Compute a hash of the graph structure. Graphs that differ only in edge ids, edge order or the names of
+        the intermediate variables have the same fingerprint. Tokens and free entities are not taken into account.
+
+        :return: fingerprint as a hex string
+        >>> SemanticGraph([Edge(leftentityid=QUESTION_VAR, rightentityid="?m0Q76"), Edge(leftentityid="?m0Q76", rightentityid="Q76")]).fingerprint() == \
+        SemanticGraph([Edge(leftentityid="?m1Q76", rightentityid="Q76"), Edge(leftentityid=QUESTION_VAR, rightentityid="?m1Q76")]).fingerprint()
+        True
+        >>> SemanticGraph([Edge(leftentityid=QUESTION_VAR, rightentityid="Q76")]).fingerprint() == \
+        SemanticGraph([Edge(leftentityid="Q76", rightentityid=QUESTION_VAR)]).fingerprint()
+        False
+        >>> legs = [[Edge(leftentityid=QUESTION_VAR, relationid="P1", rightentityid="?m0Q1"), Edge(leftentityid="?m0Q1", relationid="P2", rightentityid="Q1")], \
+        [Edge(leftentityid=QUESTION_VAR, relationid="P1", rightentityid="?m0Q2"), Edge(leftentityid="?m0Q2", relationid="P3", rightentityid="Q2")]]
+        >>> SemanticGraph(legs[0] + legs[1]).fingerprint() == SemanticGraph(legs[1] + legs[0]).fingerprint()
+        True
+        """
+        signatures = tuple(signature for signature, _ in self.canonical_edges())
+        return hashlib.sha1(repr(signatures).encode("utf-8")).hexdigest()
+
+
+def _is_intermediate_variable(node):
+    return node is not None and node.startswith("?") and node != QUESTION_VAR
+
+
+def _edge_signature(edge: Edge, var2name):
+    return tuple(var2name.get(n, n) if n else "" for n in (edge.leftentityid, edge.relationid, edge.rightentityid,
+                                                          edge.qualifierrelationid, edge.qualifierentityid))
+
 
 def graph_format_update(g):
     """
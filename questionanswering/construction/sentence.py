@@ -1,10 +1,15 @@
 import json
-from copy import copy
+from copy import copy, deepcopy
 
 from questionanswering.construction.graph import SemanticGraph, WithScore, Edge, DUMMY_EDGE, EdgeList
 
 QUESTION_TYPES = {"location", "temporal", "object", "person", "other"}
 
+# Default fields of the decoded objects for the files that were written before a field was added,
+# the values are copied for every object, see _set_fields
+_GRAPH_DEFAULTS = dict(SemanticGraph().__dict__)
+_EDGE_DEFAULTS = dict(DUMMY_EDGE.__dict__)
+
 
 class Sentence:
     def __init__(self,
@@ -63,6 +68,142 @@ def sentence_object_hook(obj):
     return obj
 
 
+def sentence_from_dict(obj):
+    """
+    Decode a sentence that was encoded with SentenceEncoder and parsed without an object hook. Unlike
+    sentence_object_hook, the type of each object is given by its position in the sentence, so no objects
+    are constructed to probe the keys.
+
+    :param obj: a dictionary with the sentence fields
+    :return: a Sentence object
+    >>> s = sentence_from_dict(json.loads(json.dumps(Sentence(entities=[{"type": "NN", "linkings": [("Q5", "human")], 'token_ids': [0]}]), cls=SentenceEncoder)))
+    >>> s.graphs[0].graph.free_entities[0]['linkings'], s.graphs[0].scores
+    ([['Q5', 'human']], [0.0, 0.0, 0.0])
+    """
+    s = Sentence.__new__(Sentence)
+    s.__dict__.update(obj)
+    s.graphs = [WithScore(_graph_from_dict(g), scores) for g, scores in obj['graphs']]
+    return s
+
+
+def _graph_from_dict(obj):
+    g = SemanticGraph.__new__(SemanticGraph)
+    _set_fields(g, obj, _GRAPH_DEFAULTS)
+    g.edges = EdgeList()
+    g.edges._list = [_edge_from_dict(e) for e in obj['edges']]
+    return g
+
+
+def _edge_from_dict(obj):
+    e = Edge.__new__(Edge)
+    _set_fields(e, obj, _EDGE_DEFAULTS)
+    return e
+
+
+def _set_fields(o, obj, defaults):
+    """
+    Set the decoded fields of the object, the missing fields get a copy of the default value.
+
+    >>> g1, g2 = _graph_from_dict({'edges': []}), _graph_from_dict({'edges': []})
+    >>> g1.denotations.append("Q76")
+    >>> g2.denotations, _GRAPH_DEFAULTS['denotations']
+    ([], [])
+    """
+    o.__dict__.update(obj)
+    for k, v in defaults.items():
+        if k not in obj:
+            o.__dict__[k] = deepcopy(v)
+
+
+def read_sentences_jsonl(path_to_file):
+    """
+    Read sentences one at a time from a JSON lines file with one encoded sentence per line.
+
+    :param path_to_file: location of the file
+    :return: a generator of Sentence objects
+    """
+    with open(path_to_file) as f:
+        for line in f:
+            if line.strip():
+                yield sentence_from_dict(json.loads(line))
+
+
+def write_sentences_jsonl(sentences, path_to_file):
+    """
+    Write the sentences to a JSON lines file with one encoded sentence per line.
+
+    :param sentences: an iterable of Sentence objects
+    :param path_to_file: location of the output file
+    :return: the number of written sentences
+    """
+    count = 0
+    with open(path_to_file, 'w') as out:
+        for s in sentences:
+            out.write(json.dumps(s, sort_keys=True, cls=SentenceEncoder) + "\n")
+            count += 1
+    return count
+
+
+def iter_sentences(path_to_file):
+    """
+    Iterate over a data set of sentences in a JSON lines file (.jsonl), in a file in the columnar format (.npz),
+    see silver_columns, or in a JSON list. The sentences of the first two formats are decoded one at a time,
+    a JSON list is loaded completely.
+
+    :param path_to_file: location of the file
+    :return: an iterator of Sentence objects
+    """
+    if path_to_file.endswith(".jsonl"):
+        return read_sentences_jsonl(path_to_file)
+    if path_to_file.endswith(".npz"):
+        from questionanswering.construction import silver_columns
+        return iter(silver_columns.SilverColumns(path_to_file))
+    with open(path_to_file) as f:
+        return iter(json.load(f, object_hook=sentence_object_hook))
+
+
+def load_sentences(path_to_file):
+    """
+    Load a data set of sentences, see iter_sentences for the supported formats.
+
+    :param path_to_file: location of the file
+    :return: a list of Sentence objects
+    """
+    return list(iter_sentences(path_to_file))
+
+
+def convert_to_jsonl(path_to_file, path_to_output):
+    """
+    Convert a data set of sentences stored as a JSON list to the JSON lines format. The objects are copied without
+    decoding them into sentences.
+
+    :param path_to_file: location of the JSON list
+    :param path_to_output: location of the JSON lines file
+    :return: the number of converted sentences
+    """
+    with open(path_to_file) as f:
+        dataset = json.load(f)
+    with open(path_to_output, 'w') as out:
+        for obj in dataset:
+            out.write(json.dumps(obj, sort_keys=True) + "\n")
+    return len(dataset)
+
+
+def convert_to_json(path_to_file, path_to_output):
+    """
+    Convert a data set of sentences in any of the formats of iter_sentences to the JSON list format of
+    generate_silver_graphs.
+
+    :param path_to_file: location of the data set
+    :param path_to_output: location of the output .json file
+    :return: the number of converted sentences
+    """
+    dataset = load_sentences(path_to_file)
+    with open(path_to_output, 'w') as out:
+        json.dump(dataset, out, sort_keys=True, indent=4, cls=SentenceEncoder)
+    return len(dataset)
+
+
 def get_question_type(question_text):
     if question_text.startswith("when") or question_text.startswith("what year"):
         return "temporal"
@@ -0,0 +1,170 @@
+import json
+import logging
+
+import numpy as np
+
+from questionanswering.construction.graph import SemanticGraph, Edge, EdgeList, WithScore
+from questionanswering.construction import sentence
+from questionanswering.construction.sentence import Sentence, SentenceEncoder, read_sentences_jsonl, sentence_object_hook
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.ERROR)
+
+FORMAT_VERSION = 1
+EDGE_FIELDS = ('leftentityid', 'relationid', 'rightentityid', 'qualifierrelationid', 'qualifierentityid')
+NUM_SCORES = 3
+_STRING_SEPARATOR = "\x00"
+
+
+class SilverColumns:
+    def __init__(self, path_to_file):
+        """
+        A silver graphs data set stored column-wise in a .npz file. All strings (entity and relation ids,
+        denotations, and the JSON encoded sentence and graph fields) are interned in one string table. The edges
+        are stored as arrays of string ids, the graphs and the sentences as offsets into the edge and graph arrays.
+
+        The encoders in vectorization take Sentence objects, so the sentences are still decoded for training,
+        only the graph scores are read without decoding, see sentence_scores.
+
+        :param path_to_file: location of the .npz file written with save_silver_columns
+        """
+        with np.load(path_to_file) as columns:
+            assert int(columns['format_version']) == FORMAT_VERSION
+            self.strings = columns['strings'].tobytes().decode('utf-8').split(_STRING_SEPARATOR)
+            self.sentence_fields = columns['sentence_fields']
+            self.sentence_graph_offsets = columns['sentence_graph_offsets']
+            self.graph_scores = columns['graph_scores']
+            self.graph_fields = columns['graph_fields']
+            self.graph_edge_offsets = columns['graph_edge_offsets']
+            self.graph_denotation_offsets = columns['graph_denotation_offsets']
+            self.denotations = columns['denotations']
+            self.edge_ids = columns['edge_ids']
+            self.edge_nodes = columns['edge_nodes']
+        logger.debug(f"Loaded {len(self)} sentences, {len(self.graph_scores)} graphs, {len(self.edge_ids)} edges")
+
+    def __len__(self):
+        return len(self.sentence_graph_offsets) - 1
+
+    def __iter__(self):
+        return (self.sentence(i) for i in range(len(self)))
+
+    def sentence_scores(self, i):
+        """
+        :param i: index of the sentence
+        :return: the scores of the graphs of the sentence as an array of shape (graphs, 3)
+        """
+        return self.graph_scores[self.sentence_graph_offsets[i]:self.sentence_graph_offsets[i + 1]]
+
+    def sentence(self, i):
+        """
+        Decode a single sentence with its graphs. Within the sentence, the decoded fields are shared between
+        the graphs that have the same tokens and free entities, in the same way as for the graphs that are
+        constructed by Sentence. Nothing is kept between the calls.
+
+        :param i: index of the sentence
+        :return: a Sentence object
+        """
+        s = Sentence.__new__(Sentence)
+        s.__dict__.update(json.loads(self.strings[self.sentence_fields[i]]))
+        graph_start, graph_end = self.sentence_graph_offsets[i], self.sentence_graph_offsets[i + 1]
+        edge_offsets = self.graph_edge_offsets[graph_start:graph_end + 1].tolist()
+        denotation_offsets = self.graph_denotation_offsets[graph_start:graph_end + 1].tolist()
+        edge_ids = self.edge_ids[edge_offsets[0]:edge_offsets[-1]].tolist()
+        edge_nodes = self.edge_nodes[edge_offsets[0]:edge_offsets[-1]].tolist()
+        denotations = self.denotations[denotation_offsets[0]:denotation_offsets[-1]].tolist()
+        strings = self.strings
+        decoded_fields = {}
+        s.graphs = []
+        for k, (fields_id, scores) in enumerate(zip(self.graph_fields[graph_start:graph_end].tolist(),
+                                                    self.graph_scores[graph_start:graph_end].tolist())):
+            g = SemanticGraph.__new__(SemanticGraph)
+            if fields_id not in decoded_fields:
+                decoded_fields[fields_id] = json.loads(strings[fields_id])
+            g.__dict__.update(decoded_fields[fields_id])
+            g.edges = EdgeList()
+            for ei in range(edge_offsets[k] - edge_offsets[0], edge_offsets[k + 1] - edge_offsets[0]):
+                e = Edge.__new__(Edge)
+                e.edgeid = edge_ids[ei]
+                for field, string_id in zip(EDGE_FIELDS, edge_nodes[ei]):
+                    setattr(e, field, strings[string_id] if string_id >= 0 else None)
+                g.edges._list.append(e)
+            g.denotations = [strings[d] for d in denotations[denotation_offsets[k] - denotation_offsets[0]:
+                                                             denotation_offsets[k + 1] - denotation_offsets[0]]]
+            s.graphs.append(WithScore(g, scores))
+        return s
+
+
+def save_silver_columns(sentences, path_to_file):
+    """
+    Store the sentences in the columnar format, see SilverColumns.
+
+    :param sentences: an iterable of Sentence objects
+    :param path_to_file: location of the output .npz file
+    :return: the number of stored sentences
+    """
+    string2id = {}
+
+    def intern(string):
+        if string not in string2id:
+            assert _STRING_SEPARATOR not in string
+            string2id[string] = len(string2id)
+        return string2id[string]
+
+    sentence_fields, sentence_graph_offsets = [], [0]
+    graph_scores, graph_fields, graph_edge_offsets, graph_denotation_offsets = [], [], [0], [0]
+    denotations, edge_ids, edge_nodes = [], [], []
+    for s in sentences:
+        sentence_fields.append(intern(json.dumps({k: v for k, v in s.__dict__.items() if k != 'graphs'},
+                                                 sort_keys=True, cls=SentenceEncoder)))
+        for g, scores in s.graphs:
+            assert len(scores) == NUM_SCORES
+            graph_scores.append(scores)
+            graph_fields.append(intern(json.dumps({k: v for k, v in g.__dict__.items()
+                                                   if k not in {'edges', 'denotations'}},
+                                                  sort_keys=True, cls=SentenceEncoder)))
+            for e in g.edges:
+                edge_ids.append(e.edgeid)
+                edge_nodes.append([intern(n) if n is not None else -1 for n in (getattr(e, f) for f in EDGE_FIELDS)])
+            denotations += [intern(d) for d in g.denotations]
+            graph_edge_offsets.append(len(edge_ids))
+            graph_denotation_offsets.append(len(denotations))
+        sentence_graph_offsets.append(len(graph_scores))
+
+    np.savez(path_to_file,
+             format_version=np.array(FORMAT_VERSION),
+             strings=np.frombuffer(_STRING_SEPARATOR.join(string2id).encode('utf-8'), dtype=np.uint8),
+             sentence_fields=np.array(sentence_fields, dtype=np.int32),
+             sentence_graph_offsets=np.array(sentence_graph_offsets, dtype=np.int64),
+             graph_scores=np.array(graph_scores, dtype=np.float64).reshape(-1, NUM_SCORES),
+             graph_fields=np.array(graph_fields, dtype=np.int32),
+             graph_edge_offsets=np.array(graph_edge_offsets, dtype=np.int64),
+             graph_denotation_offsets=np.array(graph_denotation_offsets, dtype=np.int64),
+             denotations=np.array(denotations, dtype=np.int32),
+             edge_ids=np.array(edge_ids, dtype=np.int32),
+             edge_nodes=np.array(edge_nodes, dtype=np.int32).reshape(-1, len(EDGE_FIELDS)))
+    return len(sentence_fields)
+
+
+def convert_to_columns(path_to_dataset, path_to_output):
+    """
+    Convert a silver graphs data set in the JSON or the JSON lines format to the columnar format.
+
+    :param path_to_dataset: location of the .json or .jsonl file
+    :param path_to_output: location of the output .npz file
+    :return: the number of converted sentences
+    """
+    if path_to_dataset.endswith(".jsonl"):
+        return save_silver_columns(read_sentences_jsonl(path_to_dataset), path_to_output)
+    with open(path_to_dataset) as f:
+        return save_silver_columns(json.load(f, object_hook=sentence_object_hook), path_to_output)
+
+
+def convert_to_json(path_to_columns, path_to_output):
+    """
+    Convert a data set in the columnar format back to the JSON format of generate_silver_graphs.
+
+    :param path_to_columns: location of the .npz file
+    :param path_to_output: location of the output .json file
+    :return: the number of converted sentences
+    """
+    return sentence.convert_to_json(path_to_columns, path_to_output)
@@ -0,0 +1,17 @@
+import click
+
+from questionanswering.models import vectorization as V
+
+
+@click.command()
+@click.argument('path_to_embeddings')
+def convert(path_to_embeddings):
+    """
+    Convert word embeddings in the GloVe text format to the binary format that is memory-mapped at startup.
+    """
+    path_prefix = V.convert_word_embeddings(path_to_embeddings)
+    print(f"Saved binary embeddings to {path_prefix}.npy and {path_prefix}.vocab")
+
+
+if __name__ == "__main__":
+    convert()
@@ -0,0 +1,44 @@
+import os
+import sys
+
+import click
+
+from questionanswering.construction import sentence, silver_columns
+
+# The output format of the conversion when no output file is given
+DEFAULT_OUTPUT_EXTENSION = {".json": ".jsonl", ".jsonl": ".json", ".npz": ".json"}
+
+
+@click.command()
+@click.argument('path_to_dataset')
+@click.argument('path_to_output', default="")
+def convert(path_to_dataset, path_to_output):
+    """
+    Convert a silver graphs data set between the formats, the output format is chosen by the extension:
+    JSON lines (.jsonl) that are read as a stream, the columnar format (.npz) or the JSON list (.json).
+    Without an output file a JSON list is converted to JSON lines and the other formats to a JSON list.
+    """
+    base, input_extension = os.path.splitext(path_to_dataset)
+    if input_extension not in DEFAULT_OUTPUT_EXTENSION:
+        print(f"Unknown data set format: {path_to_dataset}")
+        sys.exit(1)
+    if not path_to_output:
+        path_to_output = base + DEFAULT_OUTPUT_EXTENSION[input_extension]
+    output_extension = os.path.splitext(path_to_output)[1]
+    if output_extension not in DEFAULT_OUTPUT_EXTENSION or output_extension == input_extension:
+        print(f"Can't convert {path_to_dataset} to {path_to_output}")
+        sys.exit(1)
+
+    if output_extension == ".npz":
+        count = silver_columns.convert_to_columns(path_to_dataset, path_to_output)
+    elif output_extension == ".json":
+        count = sentence.convert_to_json(path_to_dataset, path_to_output)
+    elif input_extension == ".json":
+        count = sentence.convert_to_jsonl(path_to_dataset, path_to_output)
+    else:
+        count = sentence.write_sentences_jsonl(sentence.iter_sentences(path_to_dataset), path_to_output)
+    print(f"Converted {count} sentences to {path_to_output}")
+
+
+if __name__ == "__main__":
+    convert()
@@ -0,0 +1,89 @@
+import itertools
+import logging
+import multiprocessing
+import queue
+import traceback
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.ERROR)
+
+DEFAULT_MAX_QUEUED_BATCHES = 8
+# Seconds between the checks that the workers are alive while waiting for a batch
+WORKER_POLL_INTERVAL = 1.0
+
+
+def produce_batches(make_batch, batch_keys, seed, num_workers=0, max_queued_batches=DEFAULT_MAX_QUEUED_BATCHES):
+    """
+    Generate batches in background worker processes, so that the training loop doesn't wait on the data preparation.
+    The global numpy random state is seeded with (seed, batch number) before each batch is constructed,
+    the batches are therefore the same for a given seed independent of the number of workers.
+    The workers are forked when the generator starts, make_batch sees the state of the process at that moment.
+    A model that is trained in the meantime is not updated in the workers, so make_batch shouldn't score with it.
+
+    :param make_batch: a function that constructs a batch from a batch key, it is called in the worker processes
+    :param batch_keys: an iterable of batch keys, e.g. lists of sample indices, can be endless
+    :param seed: the base seed for the random state of the batches
+    :param num_workers: number of worker processes, the batches are constructed in the calling process if 0
+    :param max_queued_batches: maximum number of batches that are prepared in advance
+    :return: a generator of batches in the order of the batch keys
+    >>> list(produce_batches(lambda k: k + np.random.randint(10), [0, 100, 200], seed=1)) == \
+        list(produce_batches(lambda k: k + np.random.randint(10), [0, 100, 200], seed=1, num_workers=2))
+    True
+    """
+    if num_workers < 1:
+        for batch_number, batch_key in enumerate(batch_keys):
+            np.random.seed([seed, batch_number])
+            yield make_batch(batch_key)
+        return
+
+    context = multiprocessing.get_context("fork")
+    tasks, results = context.Queue(), context.Queue()
+    workers = [context.Process(target=_batch_worker, args=(make_batch, seed, tasks, results), daemon=True)
+               for _ in range(num_workers)]
+    for w in workers:
+        w.start()
+    try:
+        batch_keys = enumerate(batch_keys)
+        submitted, next_batch_number, ready = 0, 0, {}
+        for batch_number, batch_key in itertools.islice(batch_keys, max_queued_batches):
+            tasks.put((batch_number, batch_key))
+            submitted += 1
+        while next_batch_number < submitted:
+            while next_batch_number not in ready:
+                try:
+                    batch_number, batch, error = results.get(timeout=WORKER_POLL_INTERVAL)
+                except queue.Empty:
+                    # The workers only exit after the stop signal, a worker that isn't alive was killed
+                    dead = [w for w in workers if not w.is_alive()]
+                    if dead:
+                        raise RuntimeError(f"A batch worker process died with exit code {dead[0].exitcode}")
+                    continue
+                if error is not None:
+                    raise RuntimeError(f"Batch {batch_number} failed in a worker process:\n{error}")
+                ready[batch_number] = batch
+            batch = ready.pop(next_batch_number)
+            next_batch_number += 1
+            for batch_number, batch_key in itertools.islice(batch_keys, 1):
+                tasks.put((batch_number, batch_key))
+                submitted += 1
+            yield batch
+    finally:
+        for _ in workers:
+            tasks.put(None)
+        for w in workers:
+            w.join(timeout=1)
+            if w.is_alive():
+                w.terminate()
+        logger.debug(f"Stopped {len(workers)} batch workers")
+
+
+def _batch_worker(make_batch, seed, tasks, results):
+    for task in iter(tasks.get, None):
+        batch_number, batch_key = task
+        np.random.seed([seed, batch_number])
+        try:
+            results.put((batch_number, make_batch(batch_key), None))
+        except Exception:
+            results.put((batch_number, None, traceback.format_exc()))
@@ -0,0 +1,129 @@
+import logging
+
+import numpy as np
+import torch
+
+from questionanswering.models import vectorization as V
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.ERROR)
+
+DEFAULT_SCORING_BATCH_SIZE = 256
+
+
+class NegativeScoreCache:
+    def __init__(self, num_questions, refresh_interval=1, batch_size=DEFAULT_SCORING_BATCH_SIZE, encode=None):
+        """
+        Model scores of the negative graph pools that are used to select hard negatives. The pools of all questions
+        are scored together in large batches once every refresh_interval epochs and the samples of the epochs
+        in between are selected with the cached scores. The scores are stored in one flat array with
+        per-question offsets.
+
+        :param num_questions: number of questions in the data set, the questions are referred to by their index
+        :param refresh_interval: number of epochs between two refreshes of the scores
+        :param batch_size: number of questions that are scored together
+        :param encode: an optional function that encodes a list of instances as the padded model input,
+            see score_instances
+        """
+        self.refresh_interval = refresh_interval
+        self.batch_size = batch_size
+        self.encode = encode
+        self._offsets = np.zeros(num_questions + 1, dtype=np.int64)
+        self._scores = np.zeros(0, dtype=np.float32)
+        self._epochs_since_refresh = None
+
+    def next_epoch(self, model, indices, get_instance):
+        """
+        Start a new epoch and refresh the scores if the refresh interval has passed.
+
+        :param model: the model that is used to score the negative graphs
+        :param indices: indices of the questions that are sampled in the epoch
+        :param get_instance: a function that returns a (question tokens, negative pool) tuple for a question index
+            or None if the negative pool of the question doesn't need to be scored
+        :return: True if the scores were refreshed
+        """
+        if self._epochs_since_refresh is not None and self._epochs_since_refresh + 1 < self.refresh_interval:
+            self._epochs_since_refresh += 1
+            return False
+        self.refresh(model, indices, get_instance)
+        return True
+
+    def refresh(self, model, indices, get_instance):
+        """
+        Score the negative pools of the given questions, the scores of the other questions are discarded.
+
+        :param model: the model that is used to score the negative graphs
+        :param indices: indices of the questions to score
+        :param get_instance: see next_epoch
+        """
+        pool_sizes = np.zeros(len(self._offsets) - 1, dtype=np.int64)
+        question_scores = {}
+        for i in range(0, len(indices), self.batch_size):
+            batch = [(index, get_instance(index)) for index in indices[i:i + self.batch_size]]
+            batch = [(index, instance) for index, instance in batch if instance is not None]
+            if not batch:
+                continue
+            batch_scores = score_instances(model, [instance for _, instance in batch], encode=self.encode)
+            for (index, instance), scores in zip(batch, batch_scores):
+                if len(scores) != len(instance[1]):
+                    raise ValueError(f"got {len(scores)} scores for the {len(instance[1])} graphs "
+                                     f"of the negative pool of question {index}")
+                question_scores[index] = scores
+                pool_sizes[index] = len(scores)
+        self._offsets[1:] = np.cumsum(pool_sizes)
+        self._scores = np.zeros(self._offsets[-1], dtype=np.float32)
+        for index, scores in question_scores.items():
+            self._scores[self._offsets[index]:self._offsets[index + 1]] = scores
+        self._epochs_since_refresh = 0
+        logger.debug(f"Scored the negative pools of {len(question_scores)} questions, {len(self._scores)} graphs")
+
+    def get_scores(self, index):
+        """
+        :param index: question index
+        :return: the cached scores of the negative pool of the question, empty if the pool wasn't scored
+        """
+        return self._scores[self._offsets[index]:self._offsets[index + 1]]
+
+
+def score_instances(model, instances, encode=None):
+    """
+    Score the graphs of a list of instances with the model. With an encode function the instances are encoded
+    as one batch, padded to the largest pool, and scored with a single call of the torch model in eval mode,
+    the previous mode of the model is restored afterwards. Otherwise models that implement scores_for_instances
+    are given all instances at once and each instance is scored with scores_for_instance for the rest.
+
+    :param model: a torch model or a container with the torch model in _model, or a model with the
+        scores_for_instance or the scores_for_instances method
+    :param instances: a list of (question, list of graphs) tuples
+    :param encode: a function that encodes a list of instances as the input of the torch model, e.g. with
+        vectorization.encode_for_model, the graph axis should keep all graphs of each pool of at most
+        vectorization.MAX_NEGATIVE_GRAPHS graphs
+    :return: a list of graph scores for each instance
+    """
+    if encode is not None:
+        # The encoding keeps at most vectorization.MAX_NEGATIVE_GRAPHS graphs of a pool,
+        # wider pools are split into chunks that are scored in the same batch
+        chunk_size = V.MAX_NEGATIVE_GRAPHS
+        chunks = [(question, graphs[j:j + chunk_size]) for question, graphs in instances
+                  for j in range(0, max(len(graphs), 1), chunk_size)]
+        torch_model = getattr(model, "_model", model)
+        was_training = torch_model.training
+        torch_model.eval()
+        try:
+            samples = [torch.from_numpy(np.ascontiguousarray(m)) for m in encode(chunks)]
+            if next(torch_model.parameters()).is_cuda:
+                samples = [m.cuda() for m in samples]
+            with torch.no_grad():
+                scores = torch_model(*samples).cpu().numpy()
+        finally:
+            torch_model.train(was_training)
+        max_chunk_size = max(len(graphs) for _, graphs in chunks)
+        if scores.shape[1] < max_chunk_size:
+            raise ValueError(f"the encoding keeps {scores.shape[1]} graphs of a pool, scoring needs {max_chunk_size}"
+                             f" with vectorization.MAX_NEGATIVE_GRAPHS = {chunk_size}")
+        chunk_scores = iter(scores[i, :len(graphs)] for i, (_, graphs) in enumerate(chunks))
+        return [np.concatenate([next(chunk_scores) for _ in range(0, max(len(graphs), 1), chunk_size)])
+                for _, graphs in instances]
+    if hasattr(model, "scores_for_instances"):
+        return model.scores_for_instances(instances)
+    return [model.scores_for_instance(instance) for instance in instances]
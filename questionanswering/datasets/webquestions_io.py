@@ -11,6 +11,7 @@ from wikidata import scheme
 
 from questionanswering import base_objects
 from questionanswering.construction import graph
+from questionanswering.datasets import batch_producer, negative_mining
 from questionanswering.datasets.dataset import Dataset
 
 
@@ -130,12 +131,15 @@ class Wikipedia(DatasetWithoutNegatives):
 
 
 class WebQuestions(Dataset):
-    def __init__(self, parameters, **kwargs):
+    def __init__(self, parameters, encode_instances=None, **kwargs):
         """
         An object class to access the webquestion dataset. The path to the dataset should point to a folder that
         contains a preprocessed dataset.
 
         :param path_to_dataset: path to the data set location
+        :param encode_instances: an optional function that encodes a list of (question tokens, negative pool)
+            instances as the padded input of a torch model, the negative pools are then scored in batches with
+            one model call each, see negative_mining.score_instances
         """
         super(WebQuestions, self).__init__(**kwargs)
         self._p = parameters
@@ -173,10 +177,29 @@ class WebQuestions(Dataset):
             self._silver_graphs = [graph_set if any(len(g) == 3 and type(g[1]) is list and len(g[1]) == 3 and g[1][2] > 0.0 for g in graph_set) else [] for graph_set in self._silver_graphs ]
             self.logger.debug("Real average number of choices per question: {}".format(np.mean([len(graphs) for graphs in self._silver_graphs])))
 
+        # Hard negatives are selected with the model scores that are refreshed every few epochs
+        self._negative_scores = None
+        if self._p.get("negative.mining.refresh.epochs", 0) > 0:
+            self._negative_scores = negative_mining.NegativeScoreCache(
+                len(self._silver_graphs),
+                refresh_interval=self._p["negative.mining.refresh.epochs"],
+                batch_size=self._p.get("negative.mining.batch.size", negative_mining.DEFAULT_SCORING_BATCH_SIZE),
+                encode=encode_instances)
+
     def _get_samples(self, questions, model=None):
         indices = self._get_sample_indices(questions)
+        if model is not None and self._negative_scores is not None:
+            if self._negative_scores.next_epoch(model, indices, self._get_negative_instance):
+                self.logger.debug("Refreshed the negative pool scores")
         return self._get_indexed_samples(indices, model=model)
 
+    def _get_negative_instance(self, index):
+        graph_list = self._get_question_positive_silver(index)
+        negative_pool = self._get_question_negative_silver(index, graph_list)
+        if len(negative_pool) > self._p.get("max.negative.samples", 30) - len(graph_list):
+            return self.get_question_tokens(index), negative_pool
+        return None
+
     def _get_full(self, questions):
         indices = self._get_sample_indices(questions)
         max_silver_samples = self._p.get("max.silver.samples", 15)
@@ -205,7 +228,10 @@ class WebQuestions(Dataset):
             negative_pool = self._get_question_negative_silver(index, graph_list)
             negative_pool_size = self._p.get("max.negative.samples", 30) - len(graph_list)
             if model is not None and len(negative_pool) > negative_pool_size:
-                negative_pool_scores = model.scores_for_instance((question_tokens, negative_pool))
+                if self._negative_scores is not None:
+                    negative_pool_scores = self._negative_scores.get_scores(index)
+                else:
+                    negative_pool_scores = model.scores_for_instance((question_tokens, negative_pool))
             else:
                 negative_pool_scores = []
 
@@ -283,7 +309,9 @@ class WebQuestions(Dataset):
         repeatedly sampled if there are more or less negative graphs respectively.
         Graph are stored in triples, where the first element is the graph.
 
-        :param model: an optional qamodel that is used to select the negative samples, otherwise random
+        :param model: an optional qamodel that is used to select the negative samples, otherwise random.
+            If negative.mining.refresh.epochs is set, the scores of the model are cached and refreshed once in
+            the given number of calls.
         :return: a set of training samples.
         """
         return self._get_samples(self._questions_train, model=model)
@@ -360,19 +388,37 @@ class WebQuestions(Dataset):
                 for index in self._get_sample_indices(self._questions_train)
                 for g in self._silver_graphs[index] for e in g[0].get('edgeSet', []) if 'kbID' in e]
 
-    def get_training_generator(self, batch_size):
+    def get_training_generator(self, batch_size, encode=None):
         """
         Get a set of training samples as a cyclic generator. Negative samples are generated randomly at
-        each step.
+        each step. The batches are constructed in "generator.workers" background processes and at most
+        "generator.queue.size" batches are prepared in advance. The batches are seeded from the global numpy random
+        state and are the same for a given seed independent of the number of workers.
+        The negative graphs are sampled at random: the workers are forked copies of the process and would score
+        the negative pools with the weights of the model at the fork, so the model based negative mining is
+        not available here.
         Warning: This generator is endless, make sure you have a stopping condition.
 
         :param batch_size: The size of a batch to return at each step
+        :param encode: an optional function that converts the samples and the targets of a batch to the model input,
+            e.g. padded arrays. It is applied in the worker processes.
         :return: a generation that continuously returns batch of training data.
         """
+        if self._negative_scores is not None:
+            raise ValueError("The training generator doesn't support negative.mining.refresh.epochs, "
+                             "the negative pools would be scored with a stale copy of the model")
         indices = self._get_sample_indices(self._questions_train)
-        for i in itertools.cycle(range(0, len(indices), batch_size)):
-            batch_indices = indices[i:i + batch_size]
-            yield self._get_indexed_samples(batch_indices)
+        batches = (indices[i:i + batch_size] for i in itertools.cycle(range(0, len(indices), batch_size)))
+
+        def make_batch(batch_indices):
+            samples = self._get_indexed_samples(batch_indices)
+            return encode(*samples) if encode is not None else samples
+
+        return batch_producer.produce_batches(make_batch, batches,
+                                              seed=np.random.randint(2 ** 31),
+                                              num_workers=self._p.get("generator.workers", 0),
+                                              max_queued_batches=self._p.get("generator.queue.size",
+                                                                             batch_producer.DEFAULT_MAX_QUEUED_BATCHES))
 
     def get_train_sample_size(self):
         """
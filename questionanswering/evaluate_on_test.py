@@ -1,10 +1,14 @@
 import json
+import multiprocessing
+import queue
 import sys
 import os
+import traceback
 from collections import Counter
 
 import click
 import numpy as np
+import torch
 import tqdm
 
 import fackel
@@ -12,10 +16,10 @@ from wikidata import queries
 
 from questionanswering import config_utils, _utils
 from questionanswering.construction import sentence
-from questionanswering.grounding import staged_generation, graph_queries
+from questionanswering.grounding import staged_generation, graph_queries, query_cache
 from questionanswering.datasets import evaluation
 from questionanswering.datasets import webquestions_io
-from questionanswering.models import vectorization as V
+from questionanswering.models import vectorization as V, traced, slim
 
 from questionanswering import models
 
@@ -26,7 +30,9 @@ from questionanswering import models
 @click.argument('seed', default=-1)
 @click.argument('gpuid', default=-1)
 @click.argument('experiment_tag', default="")
-def generate(path_to_model, config_file_path, seed, gpuid, experiment_tag):
+@click.option('--resume', is_flag=True, help="Skip the questions that are already in the answers log.")
+@click.option('--fsync', is_flag=True, help="Force every answer to disk.")
+def generate(path_to_model, config_file_path, seed, gpuid, experiment_tag, resume, fsync):
     config, logger = config_utils.load_config(config_file_path, gpuid=gpuid, seed=seed)
     if "evaluation" not in config:
         print("Evaluation parameters not in the config file!")
@@ -49,27 +55,40 @@ def generate(path_to_model, config_file_path, seed, gpuid, experiment_tag):
         entitylinker = getattr(core, linking_config['linker'])(logger=logger,
                                                            **linking_config['linker.options'], pos_tags=True)
 
-    # Load the GloVe word embeddings and embeddings for special tokens
-    _, word2idx = V.extend_embeddings_with_special_tokens(
-        *_utils.load_word_embeddings(_utils.RESOURCES_FOLDER + "../../resources/embeddings/glove/glove.6B.100d.txt")
-    )
+    # A model exported with export_slim_model or export_traced_model comes with its own vocabulary,
+    # otherwise the GloVe word embeddings and embeddings for special tokens are loaded
+    word2idx = V.load_model_vocabulary(path_to_model)
     # Set the global mapping for words to indices
     V.WORD_2_IDX = word2idx
 
     # Derive the model type and the full model name from the model file
     model_type = path_to_model.split("/")[-1].split("_")[0]
-    model_name = path_to_model.split("/")[-1].replace(".pkl", "")
+    model_name = os.path.splitext(path_to_model.split("/")[-1])[0]
     logger.info(f"Model type: {model_type}")
     logger.info('Loading the model from: {}'.format(path_to_model))
 
-    # Load the PyTorch model
-    dummy_net = getattr(models, model_type)()
-    container = fackel.TorchContainer(
-        torch_model=dummy_net,
-        logger=logger
-    )
-    container.load_from_file(path_to_model)
-    model_gated = container._model._gnn.hp_gated if model_type == "GNNModel" else False
+    if path_to_model.endswith(".pt"):
+        # A model exported with export_traced_model
+        container = traced.TracedModelContainer(path_to_model)
+        model_gated = container.metadata.get('gated', False)
+    else:
+        if slim.is_slim_model(path_to_model):
+            # A model exported with export_slim_model is a whole pickled module
+            container = fackel.TorchContainer(
+                torch_model=slim.load_slim_model(path_to_model),
+                logger=logger
+            )
+        else:
+            # Load the PyTorch model
+            dummy_net = getattr(models, model_type)()
+            container = fackel.TorchContainer(
+                torch_model=dummy_net,
+                logger=logger
+            )
+            container.load_from_file(path_to_model)
+        model_gated = container._model._gnn.hp_gated if model_type == "GNNModel" else False
+        if model_type == "GNNModel" and 'gnn.propagation' in config['evaluation']:
+            container._model._gnn.hp_propagation = config['evaluation']['gnn.propagation']
 
     # Load the freebase entity set that was used top restrict the answer space by the previous work if specified.
     freebase_entity_set = set()
@@ -92,58 +111,55 @@ def generate(path_to_model, config_file_path, seed, gpuid, experiment_tag):
     global_answers = []
     avg_metrics = np.zeros(4)
 
+    # The answers are streamed to a JSON lines log, the aggregated file is written at the end
+    answers_log = save_answer_to + "l"
+    if resume and os.path.exists(answers_log):
+        for record in read_answers_log(answers_log):
+            global_answers.append(record['answer'])
+            avg_metrics += tuple(record['answer'][1]) + (record['graph.index'],)
+        print(f"Resuming with {len(global_answers)} answered questions")
+    answered = {a[0] for a in global_answers}
+    questions_to_answer = [q_obj for q_obj in webquestions_questions if q_obj['questionid'] not in answered]
+
     # Iterate over the questions in the dataset
-    data_iterator = tqdm.tqdm(webquestions_questions, ncols=100, ascii=True)
-    for i, q_obj in enumerate(data_iterator):
-        q = q_obj.get('utterance', q_obj.get('question'))
-        q_index = q_obj['questionid']
-
-        if entitylinker:
-            sent = entitylinker.link_entities_in_raw_input(q, element_id=q_index)
-            if "max.num.entities" in config['evaluation']:
-                sent.entities = sent.entities[:config['evaluation']["max.num.entities"]]
-            sent = sentence.Sentence(input_text=sent.input_text, tagged=sent.tagged, entities=sent.entities)
+    with open(answers_log, 'a' if resume else 'w') as answers_log_out:
+        if answers_log_out.tell() > 0:
+            answers_log_out.write("\n")  # Separate from a record that might have been truncated by a crash
+        workers = config['evaluation'].get('workers', 1)
+        if workers > 1 and torch.cuda.is_initialized():
+            logger.error("CUDA can't be used in forked workers, evaluating in a single process")
+            workers = 1
+        if workers > 1:
+            answers = evaluate_in_workers(questions_to_answer, workers,
+                                          entitylinker, container, config, freebase_entity_set)
         else:
-            tagged = _utils.get_tagged_from_server(q, caseless=q.islower())
-            sent = sentence.Sentence(input_text=q, tagged=tagged, entities=q_obj['entities'])
-
-        chosen_graphs = staged_generation.generate_with_model(sent,
-                                                              container,
-                                                              beam_size=config['evaluation'].get("beam.size", 10))
-        model_answers = []
-        g = ({},)
-        j = -1
-        if chosen_graphs:
-            j = 0
-            valid_answer_set = False
-            while not valid_answer_set and j < len(chosen_graphs):
-                g = chosen_graphs[j]
-                model_answers = graph_queries.get_graph_denotations(g.graph)
-                if model_answers:
-                    valid_answer_set = True
-                    if freebase_entity_set:
-                        labeled_answers = {l.lower() for _, labels in
-                                           queries.get_labels_for_entities(model_answers).items() for l in labels}
-                        valid_answer_set = len(labeled_answers & freebase_entity_set) > len(model_answers) - 1
-                j += 1
-
-        gold_answers = webquestions_io.get_answers_from_question(q_obj)
-        metrics = evaluation.retrieval_prec_rec_f1(gold_answers, model_answers)
-        global_answers.append((q_index, list(metrics), model_answers,
-                               [(c_g.graph, float(c_g.scores[2])) for c_g in chosen_graphs[:10]]))
-        avg_metrics += metrics + (j,)
-        precision, recall, f1, g_j = tuple(avg_metrics/(i+1))
-        data_iterator.set_postfix(prec=precision,
-                                  rec=recall,
-                                  f1=f1, g_j=g_j)
-
-        # Save intermediate results
-        if i > 0 and i % 100 == 0:
-            with open(save_answer_to, 'w') as answers_out:
-                json.dump(global_answers, answers_out, sort_keys=True, indent=4, cls=sentence.SentenceEncoder)
-
-    avg_metrics = avg_metrics / (len(webquestions_questions))
+            answers = (evaluate_question(q_obj, entitylinker, container, config, freebase_entity_set)
+                       for q_obj in questions_to_answer)
+        data_iterator = tqdm.tqdm(answers, total=len(questions_to_answer), ncols=100, ascii=True)
+        try:
+            for answer, j in data_iterator:
+                append_to_answers_log(answers_log_out, {'answer': answer, 'graph.index': j}, fsync=fsync)
+                global_answers.append(answer)
+                avg_metrics += tuple(answer[1]) + (j,)
+                precision, recall, f1, g_j = tuple(avg_metrics/len(global_answers))
+                data_iterator.set_postfix(prec=precision,
+                                          rec=recall,
+                                          f1=f1, g_j=g_j)
+        except RuntimeError as ex:
+            logger.error(f"Evaluation failed: {ex}")
+
+    # A partial run is never reported as a result, the answers log is kept for --resume
+    answered = {a[0] for a in global_answers}
+    missing = [q_obj['questionid'] for q_obj in webquestions_questions if q_obj['questionid'] not in answered]
+    if missing:
+        print(f"{len(missing)} questions were not answered, restart the evaluation with --resume")
+        sys.exit(1)
+
+    avg_metrics = avg_metrics / len(webquestions_questions)
     print("Average metrics: {}".format(avg_metrics))
+    if query_cache.CACHE is not None:
+        print("Query cache: {}".format(query_cache.CACHE.stats()))
+    print("Label encodings memo: {}".format(V.encoding_memo_stats()))
 
     # Fine-grained results, if there is a mapping of questions to the number of relation to find the correct answer
     results_by_hops = {}
@@ -192,6 +208,162 @@ def generate(path_to_model, config_file_path, seed, gpuid, experiment_tag):
                     results_out.write("\n")
 
     # Save final model output
+    finalize_answers(answers_log, save_answer_to, [q_obj['questionid'] for q_obj in webquestions_questions])
+
+
+def evaluate_question(q_obj, entitylinker, container, config, freebase_entity_set):
+    """
+    Answer a single question with the model and compute the metrics.
+
+    :param q_obj: a question from the data set
+    :return: a tuple of the answer record (question id, metrics, model answers, top graphs)
+             and the index of the graph that produced the answers
+    """
+    q = q_obj.get('utterance', q_obj.get('question'))
+    q_index = q_obj['questionid']
+
+    if entitylinker:
+        sent = entitylinker.link_entities_in_raw_input(q, element_id=q_index)
+        if "max.num.entities" in config['evaluation']:
+            sent.entities = sent.entities[:config['evaluation']["max.num.entities"]]
+        sent = sentence.Sentence(input_text=sent.input_text, tagged=sent.tagged, entities=sent.entities)
+    else:
+        tagged = _utils.get_tagged_from_server(q, caseless=q.islower())
+        sent = sentence.Sentence(input_text=q, tagged=tagged, entities=q_obj['entities'])
+
+    chosen_graphs = staged_generation.generate_with_model(sent,
+                                                          container,
+                                                          beam_size=config['evaluation'].get("beam.size", 10))
+    model_answers = []
+    g = ({},)
+    j = -1
+    if chosen_graphs:
+        j = 0
+        valid_answer_set = False
+        while not valid_answer_set and j < len(chosen_graphs):
+            g = chosen_graphs[j]
+            model_answers = graph_queries.get_graph_denotations(g.graph)
+            if model_answers:
+                valid_answer_set = True
+                if freebase_entity_set:
+                    labeled_answers = {l.lower() for _, labels in
+                                       queries.get_labels_for_entities(model_answers).items() for l in labels}
+                    valid_answer_set = len(labeled_answers & freebase_entity_set) > len(model_answers) - 1
+            j += 1
+
+    gold_answers = webquestions_io.get_answers_from_question(q_obj)
+    metrics = evaluation.retrieval_prec_rec_f1(gold_answers, model_answers)
+    return (q_index, list(metrics), model_answers,
+            [(c_g.graph, float(c_g.scores[2])) for c_g in chosen_graphs[:10]]), j
+
+
+def evaluate_in_workers(questions, workers, entitylinker, container, config, freebase_entity_set):
+    """
+    Evaluate the questions in several forked processes. The workers share the model weights with the coordinator
+    (copy-on-write) and send the answers back as soon as they are ready, so the answers come in arbitrary order.
+    A question that fails in a worker is reported back and the worker continues with the next one.
+
+    :param questions: questions to evaluate
+    :param workers: number of processes
+    :return: a generator of the results of evaluate_question
+    :raises RuntimeError: after all other answers are generated, if a question failed or a worker died
+    """
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    processes = [context.Process(target=_evaluation_worker,
+                                 args=(questions[w::workers], results,
+                                       entitylinker, container, config, freebase_entity_set))
+                 for w in range(workers)]
+    # The workers open their own connections to the cache file
+    if query_cache.CACHE is not None:
+        query_cache.CACHE.close()
+    for process in processes:
+        process.start()
+    finished = 0
+    errors = []
+    try:
+        while finished < len(processes):
+            try:
+                result = results.get(timeout=1)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes) and results.empty():
+                    break  # A worker died without reporting
+                continue
+            if result is None:
+                finished += 1
+                continue
+            answer, error = result
+            if error is not None:
+                errors.append(error)
+            else:
+                yield answer
+    finally:
+        for process in processes:
+            if finished < len(processes) and process.is_alive():
+                process.terminate()
+            process.join()
+        query_cache.reopen_cache()
+    if errors:
+        raise RuntimeError(f"{len(errors)} questions failed in the worker processes, the first one:\n{errors[0]}")
+    if finished < len(processes):
+        raise RuntimeError(f"{len(processes) - finished} worker processes died without reporting")
+
+
+def _evaluation_worker(questions, results, entitylinker, container, config, freebase_entity_set):
+    query_cache.reopen_cache()
+    # The workers already run in parallel
+    torch.set_num_threads(1)
+    for q_obj in questions:
+        try:
+            results.put((evaluate_question(q_obj, entitylinker, container, config, freebase_entity_set), None))
+        except Exception:
+            results.put((None, traceback.format_exc()))
+    results.put(None)
+
+
+def append_to_answers_log(answers_log_out, record, fsync=False):
+    """
+    Append a record to the answers log as a single JSON line.
+
+    :param answers_log_out: the log file opened for appending
+    :param record: a JSON serializable record
+    :param fsync: force the record to disk, otherwise it is only flushed to the OS
+    """
+    answers_log_out.write(json.dumps(record, sort_keys=True, cls=sentence.SentenceEncoder) + "\n")
+    answers_log_out.flush()
+    if fsync:
+        os.fsync(answers_log_out.fileno())
+
+
+def read_answers_log(answers_log):
+    """
+    Read the records from the answers log. A truncated last record is ignored.
+
+    :param answers_log: path to the log
+    :return: a list of records
+    """
+    records = []
+    with open(answers_log) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line, object_hook=sentence.sentence_object_hook))
+            except ValueError:
+                continue
+    return records
+
+
+def finalize_answers(answers_log, save_answer_to, question_ids):
+    """
+    Convert the answers log to the aggregated JSON file with the answers in the order of the data set.
+
+    :param answers_log: path to the log
+    :param save_answer_to: path to the aggregated file
+    :param question_ids: question ids in the order of the data set
+    """
+    answers = {record['answer'][0]: record['answer'] for record in read_answers_log(answers_log)}
+    global_answers = [answers[q_index] for q_index in question_ids if q_index in answers]
     with open(save_answer_to, 'w') as answers_out:
         json.dump(global_answers, answers_out, sort_keys=True, indent=4, cls=sentence.SentenceEncoder)
 
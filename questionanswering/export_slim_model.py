@@ -0,0 +1,67 @@
+import json
+import os
+import sys
+
+import click
+import nltk
+
+import fackel
+
+from questionanswering import config_utils, _utils
+from questionanswering import models
+from questionanswering.construction.sentence import iter_sentences
+from questionanswering.models import vectorization as V, slim
+
+
+@click.command()
+@click.argument('path_to_model')
+@click.argument('config_file_path', default="default_config.yaml")
+def export(path_to_model, config_file_path):
+    """
+    Export a model with the word embeddings restricted to the vocabulary that is reachable from
+    the evaluation questions and the training data sets in the config. The slim model is saved next to the original
+    one together with its vocabulary and is evaluated without loading the GloVe embeddings.
+    """
+    config, logger = config_utils.load_config(config_file_path)
+    if "evaluation" not in config:
+        print("Evaluation parameters not in the config file!")
+        sys.exit()
+
+    # Collect the question tokens and the entity labels from the data sets
+    tokens, entity_labels = [], []
+    with open(config['evaluation']['questions']) as f:
+        for q_obj in json.load(f):
+            tokens += nltk.word_tokenize(q_obj.get('utterance', q_obj.get('question')))
+            entity_labels += [l for e in q_obj.get('entities', []) for _, l in e['linkings']]
+    training_datasets = config.get('training', {}).get('path_to_dataset', [])
+    if not isinstance(training_datasets, list):
+        training_datasets = [training_datasets]
+    for path_to_dataset in training_datasets:
+        for s in iter_sentences(path_to_dataset):
+            tokens += s.tokens
+            entity_labels += [l for e in s.entities for _, l in e['linkings']]
+    words = V.get_reachable_vocabulary(tokens, entity_labels)
+    logger.info(f"Reachable vocabulary: {len(words)}")
+
+    _, word2idx = V.load_word_embeddings_with_special_tokens(
+        _utils.RESOURCES_FOLDER + "../../resources/embeddings/glove/glove.6B.100d.txt"
+    )
+    kept_indices, compact_word2idx = V.prune_vocabulary(word2idx, words)
+    logger.info(f"Vocabulary pruned from {len(word2idx)} to {len(kept_indices)} words")
+
+    model_type = path_to_model.split("/")[-1].split("_")[0]
+    container = fackel.TorchContainer(
+        torch_model=getattr(models, model_type)(),
+        logger=logger
+    )
+    container.load_from_file(path_to_model)
+
+    path_to_slim_model = os.path.splitext(path_to_model)[0] + slim.SLIM_MODEL_EXTENSION
+    slim.save_slim_model(slim.prune_model(container._model, kept_indices), path_to_slim_model)
+    path_to_vocabulary = os.path.splitext(path_to_slim_model)[0] + ".vocab"
+    _utils.save_vocabulary(compact_word2idx, len(kept_indices), path_to_vocabulary)
+    print(f"Saved the slim model to {path_to_slim_model} and its vocabulary to {path_to_vocabulary}")
+
+
+if __name__ == "__main__":
+    export()
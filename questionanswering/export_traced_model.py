@@ -0,0 +1,64 @@
+import itertools
+import os
+import sys
+
+import click
+import numpy as np
+import torch
+
+import fackel
+
+from questionanswering import config_utils, _utils
+from questionanswering import models
+from questionanswering.construction.sentence import iter_sentences
+from questionanswering.models import vectorization as V, traced
+
+
+@click.command()
+@click.argument('path_to_model')
+@click.argument('path_to_dataset')
+@click.argument('config_file_path', default="default_config.yaml")
+@click.option('--batch-size', default=16, help="Number of questions in the tracing and in the parity check batch.")
+@click.option('--tolerance', default=1e-5, help="Maximum allowed difference between the traced and the eager scores.")
+def export(path_to_model, path_to_dataset, config_file_path, batch_size, tolerance):
+    """
+    Export a model as a traced TorchScript model for the CPU inference. The model is traced on the first batch of
+    questions from the silver graphs data set and compared to the eager model on the next batch. The traced model
+    is saved next to the original one together with its vocabulary and can be evaluated with evaluate_on_test.
+    """
+    config, logger = config_utils.load_config(config_file_path)
+    word2idx = V.load_model_vocabulary(path_to_model)
+
+    model_type = path_to_model.split("/")[-1].split("_")[0]
+    container = fackel.TorchContainer(
+        torch_model=getattr(models, model_type)(),
+        logger=logger
+    )
+    container.load_from_file(path_to_model)
+    model = container._model.cpu()
+    model_gated = model._gnn.hp_gated if model_type == "GNNModel" else False
+
+    dataset = list(itertools.islice((s for s in iter_sentences(path_to_dataset) if len(s.graphs) > 0), batch_size * 2))
+    if len(dataset) < batch_size * 2:
+        print(f"Not enough questions in the data set for two batches of {batch_size}")
+        sys.exit(1)
+    trace_batch, check_batch = [[torch.from_numpy(np.ascontiguousarray(m))
+                                 for m in V.encode_for_model(batch, model_type, word2idx)]
+                                for batch in (dataset[:batch_size], dataset[batch_size:])]
+
+    traced_model = traced.trace_model(model, *trace_batch)
+    max_difference = traced.check_parity(model, traced_model, *check_batch)
+    print(f"Maximum score difference on the held-out batch: {max_difference}")
+    if max_difference > tolerance:
+        print("The traced model doesn't match the eager model, nothing is saved")
+        sys.exit(1)
+
+    path_prefix = os.path.splitext(path_to_model)[0] + ".traced"
+    traced.save_traced_model(traced_model, path_prefix + ".pt", model_type,
+                             description=container.description, gated=model_gated)
+    _utils.save_vocabulary(word2idx, model._tokens_encoder._word_embedding.num_embeddings, path_prefix + ".vocab")
+    print(f"Saved the traced model to {path_prefix}.pt and its vocabulary to {path_prefix}.vocab")
+
+
+if __name__ == "__main__":
+    export()
@@ -1,4 +1,6 @@
 import json
+import multiprocessing
+import os
 import sys
 
 import click
@@ -11,7 +13,7 @@ from entitylinking import core
 
 from questionanswering import config_utils
 from questionanswering.construction import graph, sentence
-from questionanswering.grounding import staged_generation
+from questionanswering.grounding import staged_generation, query_cache
 
 from questionanswering.datasets import webquestions_io
 
@@ -38,9 +40,8 @@ def generate(config_file_path):
     previous_silver = []
     if 'previous' in config['generation']:
         logger.debug("Loading the previous result")
-        with open(config['generation']['previous']) as f:
-            previous_silver = json.load(f,  object_hook=sentence.sentence_object_hook)
-            logger.info(f"Train: {len(previous_silver)}")
+        previous_silver = sentence.load_sentences(config['generation']['previous'])
+        logger.info(f"Train: {len(previous_silver)}")
         print(f"Previous number of answers covered: "
               f"{len([1 for s in previous_silver if len(s.graphs) > 0 and any([g.scores[2] > 0.0 for g in s.graphs])]) / len(previous_silver)}")
         print(f"Previous average f1 of the silver data: "
@@ -54,26 +55,17 @@ def generate(config_file_path):
         start_with = config['generation']['start.with']
         print("Starting with {}.".format(start_with))
 
+    if config['generation'].get('workers', 1) > 1:
+        silver_dataset = generate_sharded(list(range(start_with, len_webquestion)), webquestions_questions,
+                                          previous_silver, entitylinker, config, logger)
+        with open(config['generation']["save.silver.to"], 'w') as out:
+            json.dump(silver_dataset, out, sort_keys=True, indent=4, cls=sentence.SentenceEncoder)
+        print_statistics(silver_dataset, len_webquestion)
+        return
+
     data_iterator = tqdm.tqdm(range(start_with, len_webquestion), ncols=100)
     for i in data_iterator:
-        if len(previous_silver) > i and previous_silver[i].graphs \
-                and max(g.scores[2] for g in previous_silver[i].graphs) > 0.8:
-            silver_dataset.append(previous_silver[i])
-        else:
-            q_obj = webquestions_questions[i]
-            q = q_obj.get('utterance', q_obj.get('question'))
-            q_index = q_obj['questionid']
-
-            sent = entitylinker.link_entities_in_raw_input(q, element_id=q_index)
-            if "max.num.entities" in config['generation']:
-                sent.entities = sent.entities[:config['generation']["max.num.entities"]]
-
-            sent = sentence.Sentence(input_text=sent.input_text, tagged=sent.tagged, entities=sent.entities)
-
-            gold_answers = webquestions_io.get_answers_from_question(q_obj)
-            if gold_answers and any(gold_answers):
-                sent.graphs = staged_generation.generate_with_gold(sent.graphs[0], gold_answers)
-            silver_dataset.append(sent)
+        silver_dataset.append(generate_for_question(i, webquestions_questions, previous_silver, entitylinker, config))
 
         coverage = len([1 for s in silver_dataset if len(s.graphs) > 0 and any([g.scores[2] > 0.0 for g in s.graphs])]) / (i+1)
         avg_f1 = np.average([np.max([g.scores[2] for g in s.graphs]) if len(s.graphs) > 0 else 0.0 for s in silver_dataset])
@@ -86,11 +78,117 @@ def generate(config_file_path):
     logger.debug("Generation finished. Silver dataset size: {}".format(len(silver_dataset)))
     with open(config['generation']["save.silver.to"], 'w') as out:
         json.dump(silver_dataset, out, sort_keys=True, indent=4, cls=sentence.SentenceEncoder)
+    print_statistics(silver_dataset, len_webquestion)
+
 
+def print_statistics(silver_dataset, len_webquestion):
     print("Number of answers covered: {}".format(
         len([1 for s in silver_dataset if len(s.graphs) > 0 and any([g.scores[2] > 0.0 for g in s.graphs])]) / len_webquestion ))
     print("Average f1 of the silver data: {}".format(
         np.average([np.max([g.scores[2] for g in s.graphs]) if len(s.graphs) > 0 else 0.0 for s in silver_dataset])))
+    if query_cache.CACHE is not None:
+        print("Query cache: {}".format(query_cache.CACHE.stats()))
+
+
+def generate_for_question(i, webquestions_questions, previous_silver, entitylinker, config):
+    """
+    Generate the silver graphs for a single question or reuse the previous result if it is good enough.
+
+    :param i: index of the question
+    :return: a Sentence object with the generated graphs
+    """
+    if len(previous_silver) > i and previous_silver[i].graphs \
+            and max(g.scores[2] for g in previous_silver[i].graphs) > 0.8:
+        return previous_silver[i]
+    q_obj = webquestions_questions[i]
+    q = q_obj.get('utterance', q_obj.get('question'))
+    q_index = q_obj['questionid']
+
+    sent = entitylinker.link_entities_in_raw_input(q, element_id=q_index)
+    if "max.num.entities" in config['generation']:
+        sent.entities = sent.entities[:config['generation']["max.num.entities"]]
+
+    sent = sentence.Sentence(input_text=sent.input_text, tagged=sent.tagged, entities=sent.entities)
+
+    gold_answers = webquestions_io.get_answers_from_question(q_obj)
+    if gold_answers and any(gold_answers):
+        sent.graphs = staged_generation.generate_with_gold(sent.graphs[0], gold_answers)
+    return sent
+
+
+def generate_sharded(indices, webquestions_questions, previous_silver, entitylinker, config, logger):
+    """
+    Generate the silver graphs in several processes. The questions are split into shards and every process
+    appends the result for each question as a JSON line to its shard log in generation.shards.dir.
+    The questions that are already in the shard logs are skipped, so that a crashed run can be resumed.
+    The worker processes are forked after the entity linker is loaded and open their own connections to the shared
+    query cache file, the connection of the parent process is closed before forking.
+
+    :param indices: indices of the questions to process
+    :return: the silver data set for the given indices merged from the shard logs
+    """
+    workers = config['generation']['workers']
+    shards_dir = config['generation'].get('shards.dir', config['generation']["save.silver.to"] + ".shards")
+    os.makedirs(shards_dir, exist_ok=True)
+    done = read_shards(shards_dir)
+    to_process = [i for i in indices if i not in done]
+    logger.info("Questions in the shard logs: {}, to process: {}".format(len(done), len(to_process)))
+
+    if query_cache.CACHE is not None:
+        query_cache.CACHE.close()
+    processes = []
+    for shard in range(workers):
+        shard_indices = to_process[shard::workers]
+        if not shard_indices:
+            continue
+        process = multiprocessing.get_context("fork").Process(target=_generate_shard,
+                                          args=(shard_indices, os.path.join(shards_dir, f"shard-{shard}.jsonl"),
+                                                webquestions_questions, previous_silver, entitylinker, config))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+    query_cache.reopen_cache()
+    if any(process.exitcode != 0 for process in processes):
+        logger.error("Some of the workers failed, restart the generation to resume")
+        sys.exit(1)
+
+    done = read_shards(shards_dir)
+    return [done[i] for i in indices]
+
+
+def _generate_shard(shard_indices, path_to_shard, webquestions_questions, previous_silver, entitylinker, config):
+    query_cache.reopen_cache()
+    with open(path_to_shard, 'a') as out:
+        if out.tell() > 0:
+            out.write("\n")  # Separate from a record that might have been truncated by a crash
+        for i in tqdm.tqdm(shard_indices, ncols=100, desc=os.path.basename(path_to_shard)):
+            sent = generate_for_question(i, webquestions_questions, previous_silver, entitylinker, config)
+            out.write(json.dumps({'index': i, 'sentence': sent}, sort_keys=True, cls=sentence.SentenceEncoder) + "\n")
+            out.flush()
+
+
+def read_shards(shards_dir):
+    """
+    Read all records from the shard logs. A truncated last record of a crashed worker is ignored.
+
+    :param shards_dir: the directory with the shard logs
+    :return: a dictionary from question indices to Sentence objects
+    """
+    records = {}
+    for file_name in sorted(os.listdir(shards_dir)):
+        if not file_name.endswith(".jsonl"):
+            continue
+        with open(os.path.join(shards_dir, file_name)) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line, object_hook=sentence.sentence_object_hook)
+                except ValueError:
+                    continue
+                records[record['index']] = record['sentence']
+    return records
 
 
 if __name__ == "__main__":
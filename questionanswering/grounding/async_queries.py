@@ -0,0 +1,262 @@
+import asyncio
+import logging
+import os
+import random
+from typing import List
+
+import aiohttp
+
+from questionanswering.construction import sentence
+from questionanswering.construction.graph import SemanticGraph
+from questionanswering.grounding import graph_queries, query_cache
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.ERROR)
+
+WIKIDATA_NAMESPACE = "http://www.wikidata.org/"
+DEFAULT_TIMEOUT = 20
+DEFAULT_MAX_CONNECTIONS = 8
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_BACKOFF = 0.5
+# Seconds to establish a connection to the endpoint
+CONNECT_TIMEOUT = 10
+# The endpoint enforces the query timeout, the client waits this many seconds longer for the response
+READ_TIMEOUT_MARGIN = 5
+
+
+class AsyncSparqlClient:
+    def __init__(self, endpoint, max_connections=DEFAULT_MAX_CONNECTIONS, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff=DEFAULT_BACKOFF, timeout=DEFAULT_TIMEOUT):
+        """
+        A SPARQL client for asyncio that keeps a pool of persistent connections to the endpoint.
+        Failed queries are retried with a jittered exponential backoff, queries rejected by the endpoint
+        (4xx responses) are not. Just as query_cache.query_wikidata the client returns None if a query
+        could not be executed, shares the results with the global query cache and uses the local triple store
+        instead of the endpoint if one is set. The number of queries in flight is limited by
+        query_cache.set_max_concurrent_queries or by max_connections if no limit is set.
+
+        :param endpoint: URL of the SPARQL endpoint
+        :param max_connections: maximum number of simultaneous connections to the endpoint
+        :param max_retries: number of times a failed query is repeated
+        :param backoff: base delay in seconds before the first retry, doubled for every next retry
+        :param timeout: default query timeout in seconds, sent to the endpoint with the query
+        """
+        self.endpoint = endpoint
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit_per_host=self.max_connections)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  headers={'Accept': "application/sparql-results+json"})
+            self._semaphore = asyncio.Semaphore(query_cache.MAX_CONCURRENT_QUERIES or self.max_connections)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def query_wikidata(self, query, **kwargs):
+        """
+        Execute the query or retrieve the result from the global cache. Failed queries are never cached.
+
+        :param query: SPARQL query as a string
+        :param kwargs: additional query arguments, only timeout is supported
+        :return: a list of dictionaries for SELECT queries, True or an empty list for ASK queries, None on exception
+        """
+        result = query_cache.get_cached_result(query, **kwargs)
+        if result is not None:
+            return result
+        if query_cache.LOCAL_BACKEND is not None:
+            result = query_cache.LOCAL_BACKEND.query(query, **kwargs)
+        else:
+            result = await self._query_endpoint(query, kwargs.get('timeout', self.timeout))
+        query_cache.cache_result(query, result, **kwargs)
+        return result
+
+    async def _query_endpoint(self, query, timeout):
+        await self.open()
+        # Only the time the endpoint takes to respond counts, not the time spent waiting for a free connection
+        client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT,
+                                               sock_read=timeout + READ_TIMEOUT_MARGIN)
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._semaphore:
+                    async with self._session.post(self.endpoint,
+                                                  data={'query': query, 'timeout': str(int(timeout * 1000))},
+                                                  timeout=client_timeout) as response:
+                        if 400 <= response.status < 500 and response.status != 429:
+                            logger.error(f"Query rejected with status {response.status}: {query}")
+                            return None
+                        response.raise_for_status()
+                        return parse_sparql_json(await response.json(content_type=None))
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as ex:
+                logger.debug(f"Query failed (attempt {attempt + 1}): {ex}")
+                if attempt < self.max_retries:
+                    await asyncio.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+        logger.error(f"Query failed after {self.max_retries + 1} attempts: {query}")
+        return None
+
+
+class AsyncGrounder:
+    def __init__(self, endpoint, **client_args):
+        """
+        Grounds lists of graphs, e.g. a beam level, concurrently from the synchronous code. The event loop and
+        the connection pool are kept between the calls, a forked process creates its own ones on the first call.
+
+        :param endpoint: URL of the SPARQL endpoint
+        :param client_args: additional arguments for the AsyncSparqlClient
+        """
+        self.endpoint = endpoint
+        self.client_args = client_args
+        self._loop = None
+        self._client = None
+        self._pid = None
+
+    def ground_graphs(self, graphs: List[SemanticGraph]):
+        """
+        Retrieve the groundings for a list of graphs, see ground_graphs_async.
+
+        :param graphs: a list of SemanticGraph objects
+        :return: a list of groundings for each graph in the same order
+        """
+        if self._pid != os.getpid():
+            self._loop = asyncio.new_event_loop()
+            self._client = AsyncSparqlClient(self.endpoint, **self.client_args)
+            self._pid = os.getpid()
+        return self._loop.run_until_complete(ground_graphs_async(graphs, self._client))
+
+    def close(self):
+        if self._loop is not None and self._pid == os.getpid():
+            self._loop.run_until_complete(self._client.close())
+            self._loop.close()
+        self._loop, self._client, self._pid = None, None, None
+
+
+def parse_sparql_json(response):
+    """
+    Convert a SPARQL JSON response to the format of endpoint_access.query_wikidata.
+
+    :param response: parsed JSON response of the endpoint
+    :return: a list of dictionaries with the namespace stripped from the Wikidata URIs, True or an empty list for ASK
+    >>> parse_sparql_json({'head': {}, 'boolean': True})
+    True
+    >>> parse_sparql_json({'head': {}, 'boolean': False})
+    []
+    >>> parse_sparql_json({'head': {'vars': ['e0']}, 'results': {'bindings': [{'e0': {'type': 'uri', 'value': 'http://www.wikidata.org/entity/Q76'}}, {'e0': {'type': 'literal', 'value': '1961'}}]}})
+    [{'e0': 'Q76'}, {'e0': '1961'}]
+    """
+    if 'boolean' in response:
+        return True if response['boolean'] else []
+    results = []
+    for binding in response['results']['bindings']:
+        r = {}
+        for var, value in binding.items():
+            v = value['value']
+            if value.get('type') == 'uri' and v.startswith(WIKIDATA_NAMESPACE):
+                v = v[v.rfind("/") + 1:]
+            r[var] = v
+        results.append(r)
+    return results
+
+
+async def get_graph_groundings_async(g: SemanticGraph, client: AsyncSparqlClient, pass_exception=False):
+    """
+    Asynchronous variant of graph_queries.get_graph_groundings that shares the memo and the neighbourhood index
+    with it.
+
+    :param g: graph as a SemanticGraph
+    :param client: an AsyncSparqlClient
+    :param pass_exception: return None instead of an empty list if the query fails
+    :return: graph groundings encoded as a list of dictionaries
+    """
+    groundings = graph_queries.memoized_groundings(g)
+    if groundings is not None:
+        return groundings
+    groundings = await _get_graph_groundings_async(g, client)
+    if groundings is None:  # Failed queries are not memoized
+        return None if pass_exception else []
+    graph_queries.memoize_groundings(g, groundings)
+    return groundings
+
+
+async def _get_graph_groundings_async(g: SemanticGraph, client: AsyncSparqlClient):
+    if not g.get_ungrounded_edges():
+        return [{}] if await verify_grounding_async(g, client) else []
+    groundings = graph_queries.predefined_groundings(g)
+    if groundings is not None:
+        return groundings
+    if graph_queries.NEIGHBOURHOOD_INDEX is not None:
+        groundings = graph_queries.NEIGHBOURHOOD_INDEX.get_groundings(g)
+    if groundings is None:  # The graph shape is not covered by the index
+        groundings = await client.query_wikidata(graph_queries.graph_to_query(g, limit=500))
+    if groundings is None:
+        return None
+    return graph_queries.post_process_groundings(g, groundings)
+
+
+async def verify_grounding_async(g: SemanticGraph, client: AsyncSparqlClient):
+    """
+    Asynchronous variant of graph_queries.verify_grounding that shares the memo with it.
+
+    :param g: graph as a SemanticGraph
+    :param client: an AsyncSparqlClient
+    :return: true if the graph exists, false otherwise, None if the query failed
+    """
+    verified = graph_queries.memoized_verification(g)
+    if verified is not None:
+        return verified
+    if graph_queries.has_misplaced_time_relation(g):
+        verified = False
+    else:
+        verified = await client.query_wikidata(graph_queries.graph_to_ask(g), timeout=1)
+        if verified == []:
+            verified = False
+    graph_queries.memoize_verification(g, verified)
+    return verified
+
+
+async def get_graph_denotations_async(g: SemanticGraph, client: AsyncSparqlClient):
+    """
+    Asynchronous variant of graph_queries.get_graph_denotations.
+
+    :param g: graph as a SemanticGraph
+    :param client: an AsyncSparqlClient
+    :return: a list of string denotations, empty if the query failed
+    """
+    denotations = await client.query_wikidata(graph_queries.graph_to_denotation_query(g))
+    if denotations is None:
+        return []
+    if sentence.get_question_type(" ".join(g.tokens)) == 'temporal':
+        # Labels are retrieved with a blocking query
+        return await asyncio.get_running_loop().run_in_executor(None, graph_queries.post_process_denotations,
+                                                                g, denotations)
+    return graph_queries.post_process_denotations(g, denotations)
+
+
+async def ground_graphs_async(graphs: List[SemanticGraph], client: AsyncSparqlClient):
+    """
+    Retrieve the groundings for a list of graphs, e.g. a beam level, concurrently.
+
+    :param graphs: a list of SemanticGraph objects
+    :param client: an AsyncSparqlClient
+    :return: a list of groundings for each graph in the same order
+    """
+    return await asyncio.gather(*[get_graph_groundings_async(g, client) for g in graphs])
+
+
+if __name__ == "__main__":
+    import doctest
+    print(doctest.testmod())
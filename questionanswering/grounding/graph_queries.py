@@ -1,15 +1,16 @@
 import logging
 import re
 import itertools
-
+from typing import List
 
 from wikidata import scheme, endpoint_access, queries
 
 from questionanswering.construction import graph, sentence
 from questionanswering.construction.graph import SemanticGraph, Edge
 from questionanswering._utils import RESOURCES_FOLDER, load_blacklist
+from questionanswering.grounding import query_cache
 
-QUESTION_VAR = "?qvar"
+QUESTION_VAR = graph.QUESTION_VAR
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.ERROR)
@@ -50,6 +51,10 @@ sparql_character_label = """
         FILTER CONTAINS(?labelright, %entitylabels)}
 """
 
+sparql_candidate_block = """
+        {{ SELECT ({candidate} AS ?candidate) WHERE {{ {patterns} }} LIMIT 1 }}
+    """
+
 sparql_restriction_time_argmax = "?m ?a [base:time ?n]. FILTER (YEAR(?n) = ?yearvalue)"
 
 sparql_filter_main_entity = """
@@ -73,6 +78,21 @@ CONTENT_PROPERTIES = scheme.content_properties - BLACK_LIST
 
 FREQ_THRESHOLD = 500
 
+MAX_BATCH_VERIFICATION_SIZE = 50
+MAX_BATCH_QUERY_LENGTH = 20000
+
+# Groundings and verification results are memoized by the graph fingerprint and shared between
+# graphs that differ only in edge ids, edge order or names of intermediate variables
+MEMOIZE_GROUNDINGS = True
+MAX_MEMO_SIZE = 100000
+_groundings_memo = {}
+_verification_memo = {}
+
+grounding_variable_pattern = re.compile(r"^r(\d+)v$")
+
+# Precomputed groundings of the one- and two-hop graphs around the entities, see neighbourhood_index
+NEIGHBOURHOOD_INDEX = None
+
 
 def filter_relations(results, b='p', freq_threshold=0):
     """
@@ -126,31 +146,33 @@ def get_graph_groundings(g: SemanticGraph, pass_exception=False, use_wikidata=Tr
     >>> get_graph_groundings(SemanticGraph([Edge(leftentityid='Q35637', relationid='P1346', rightentityid=QUESTION_VAR, qualifierentityid='2009'), Edge(leftentityid=QUESTION_VAR, relationid='iclass')]))
     [{'r1v': 'P31c', 'topic': 'human'}, {'r1v': 'P106c', 'topic': 'politician'}]
     """
+    if not MEMOIZE_GROUNDINGS:
+        return _get_graph_groundings(g, pass_exception, use_wikidata)
+    groundings = memoized_groundings(g, use_wikidata)
+    if groundings is not None:
+        return groundings
+    groundings = _get_graph_groundings(g, True, use_wikidata)
+    if groundings is None:  # Failed queries are not memoized
+        return None if pass_exception else []
+    memoize_groundings(g, groundings, use_wikidata)
+    return groundings
+
+
+def _get_graph_groundings(g: SemanticGraph, pass_exception=False, use_wikidata=True):
     ungrouded_edges = g.get_ungrounded_edges()
     if ungrouded_edges:
-        if len(ungrouded_edges) == 1 and ungrouded_edges[0].relationid == "iclass":
-            if "zip" in g.tokens and any(e.relationid == "P281" for e in g.edges):
-                return [{'r1v': 'P31c', 'topic': 'Q37447'}]
-            elif any([scheme.property2label[e.relationid]["type"] == "time"
-                      for e in g.edges if e.leftentityid != QUESTION_VAR]):
-                return [{'r1v': 'P31c', 'topic': "Q577"}]
+        predefined_groundings = predefined_groundings(g)
+        if predefined_groundings is not None:
+            return predefined_groundings
         if use_wikidata:
-            groundings = endpoint_access.query_wikidata(graph_to_query(g, limit=500))
+            groundings = NEIGHBOURHOOD_INDEX.get_groundings(g) if NEIGHBOURHOOD_INDEX is not None else None
+            if groundings is None:  # The graph shape is not covered by the index
+                groundings = query_cache.query_wikidata(graph_to_query(g, limit=500))
         else:
             groundings = get_all_groundings(g)
         if groundings is None:  # If there was an exception
             return None if pass_exception else []
-        elif len(groundings) > 0:
-            # keys = {b for r in groundings for b in r if b.startswith("r")}
-            for e in ungrouded_edges:
-                groundings = filter_relations(groundings, b=f"r{e.edgeid:d}v", freq_threshold=FREQ_THRESHOLD)
-            if sentence.get_question_type(" ".join(g.tokens)) != 'temporal':
-                groundings = [r for r in groundings if all([scheme.property2label[r[f"r{e.edgeid:d}v"][:-1]]["type"] != "time"
-                                                           for e in ungrouded_edges if e.leftentityid != QUESTION_VAR])]
-        groundings = sorted(groundings,
-                            key=lambda r: sum([scheme.property2label[r[f"r{e.edgeid:d}v"][:-1]]['freq']
-                                               for e in ungrouded_edges if f"r{e.edgeid:d}v" in r]), reverse=True)
-        return groundings
+        return post_process_groundings(g, groundings)
     else:
         if verify_grounding(g) or not use_wikidata:
             return [{}]
@@ -158,6 +180,55 @@ def get_graph_groundings(g: SemanticGraph, pass_exception=False, use_wikidata=Tr
             return []
 
 
+def set_neighbourhood_index(index):
+    """
+    Ground the graphs around single entities with the precomputed index, None switches the index off.
+
+    :param index: a neighbourhood_index.NeighbourhoodIndex or None
+    """
+    global NEIGHBOURHOOD_INDEX
+    NEIGHBOURHOOD_INDEX = index
+
+
+def predefined_groundings(g: SemanticGraph):
+    """
+    Some class groundings are known in advance and don't need to be queried.
+
+    :param g: a graph with ungrounded edges
+    :return: a list of groundings or None if the groundings should be queried
+    """
+    ungrouded_edges = g.get_ungrounded_edges()
+    if len(ungrouded_edges) == 1 and ungrouded_edges[0].relationid == "iclass":
+        if "zip" in g.tokens and any(e.relationid == "P281" for e in g.edges):
+            return [{'r1v': 'P31c', 'topic': 'Q37447'}]
+        elif any([scheme.property2label[e.relationid]["type"] == "time"
+                  for e in g.edges if e.leftentityid != QUESTION_VAR]):
+            return [{'r1v': 'P31c', 'topic': "Q577"}]
+    return None
+
+
+def post_process_groundings(g: SemanticGraph, groundings):
+    """
+    Filter out groundings with blacklisted or infrequent relations and sort the rest by the relation frequency.
+
+    :param g: a graph with ungrounded edges
+    :param groundings: groundings retrieved for the graph
+    :return: a list of groundings
+    """
+    ungrouded_edges = g.get_ungrounded_edges()
+    if len(groundings) > 0:
+        # keys = {b for r in groundings for b in r if b.startswith("r")}
+        for e in ungrouded_edges:
+            groundings = filter_relations(groundings, b=f"r{e.edgeid:d}v", freq_threshold=FREQ_THRESHOLD)
+        if sentence.get_question_type(" ".join(g.tokens)) != 'temporal':
+            groundings = [r for r in groundings if all([scheme.property2label[r[f"r{e.edgeid:d}v"][:-1]]["type"] != "time"
+                                                       for e in ungrouded_edges if e.leftentityid != QUESTION_VAR])]
+    groundings = sorted(groundings,
+                        key=lambda r: sum([scheme.property2label[r[f"r{e.edgeid:d}v"][:-1]]['freq']
+                                           for e in ungrouded_edges if f"r{e.edgeid:d}v" in r]), reverse=True)
+    return groundings
+
+
 def verify_grounding(g: SemanticGraph):
     """
     Verify the given graph with (partial) grounding exists in Wikidata.
@@ -169,16 +240,216 @@ def verify_grounding(g: SemanticGraph):
     """
     # if len(filter_relations(g.edges, b='kbID')) < len(g.edges):
     #     return False
-    if not sentence.get_question_type(" ".join(g.tokens)) == 'temporal' and \
-            any([scheme.property2label.get(edge.relationid, {}).get("type") == "time"
-                 for edge in g.edges if edge.leftentityid != QUESTION_VAR]):
+    if not MEMOIZE_GROUNDINGS:
+        return _verify_grounding(g)
+    verified = memoized_verification(g)
+    if verified is not None:
+        return verified
+    verified = _verify_grounding(g)
+    memoize_verification(g, verified)
+    return verified
+
+
+def _verify_grounding(g: SemanticGraph):
+    if has_misplaced_time_relation(g):
         return False
-    verified = endpoint_access.query_wikidata(graph_to_ask(g), timeout=1)
+    verified = query_cache.query_wikidata(graph_to_ask(g), timeout=1)
     if verified == []:
         return False
     return verified
 
 
+def has_misplaced_time_relation(g: SemanticGraph):
+    """
+    Time relations can only be grounded for temporal questions, such graphs are rejected without a query.
+    """
+    return not sentence.get_question_type(" ".join(g.tokens)) == 'temporal' and \
+        any([scheme.property2label.get(edge.relationid, {}).get("type") == "time"
+             for edge in g.edges if edge.leftentityid != QUESTION_VAR])
+
+
+def verify_groundings(graphs: List[SemanticGraph]):
+    """
+    Verify a list of graphs at once. The graphs are checked with a few SELECT queries, where each query
+    contains a UNION of sub-queries tagged with the candidate position. The candidates are split into several
+    queries if there are too many of them or the query gets too long. If a query fails, the candidates
+    are split further and single graphs are finally verified with verify_grounding.
+
+    :param graphs: a list of graphs with (partial) grounding
+    :return: a list of booleans, true if the corresponding graph exists in Wikidata
+    >>> verify_groundings([SemanticGraph([Edge(leftentityid=QUESTION_VAR, rightentityid="Q76")]), SemanticGraph([Edge(leftentityid=QUESTION_VAR, relationid="P1376", rightentityid="Q76")])])
+    [True, False]
+    """
+    verified = [None] * len(graphs)
+    to_query = []
+    for i, g in enumerate(graphs):
+        if has_misplaced_time_relation(g):
+            verified[i] = False
+        elif memoized_verification(g) is not None:
+            verified[i] = bool(memoized_verification(g))
+        else:
+            to_query.append(i)
+
+    chunks = []
+    chunk, chunk_length = [], 0
+    for i in to_query:
+        block_length = len(_graph_to_candidate_block(graphs[i], len(chunk)))
+        if chunk and (len(chunk) >= MAX_BATCH_VERIFICATION_SIZE or
+                      chunk_length + block_length > MAX_BATCH_QUERY_LENGTH):
+            chunks.append(chunk)
+            chunk, chunk_length = [], 0
+        chunk.append(i)
+        chunk_length += block_length
+    if chunk:
+        chunks.append(chunk)
+
+    while chunks:
+        chunk = chunks.pop(0)
+        if len(chunk) == 1:
+            verified[chunk[0]] = bool(verify_grounding(graphs[chunk[0]]))
+            continue
+        results = query_cache.query_wikidata(graphs_to_batch_verification([graphs[j] for j in chunk]),
+                                             timeout=1 + len(chunk) // 10)
+        if results is None:  # If there was an exception, split the batch
+            logger.debug("Batch verification failed for {} graphs, splitting".format(len(chunk)))
+            chunks = [chunk[:len(chunk) // 2], chunk[len(chunk) // 2:]] + chunks
+            continue
+        found = {int(r['candidate']) for r in results if 'candidate' in r}
+        for position, i in enumerate(chunk):
+            verified[i] = position in found
+            memoize_verification(graphs[i], verified[i])
+    return verified
+
+
+def graphs_to_batch_verification(graphs: List[SemanticGraph]):
+    """
+    Convert a list of graphs to a single SELECT query that returns the positions of the graphs that exist in Wikidata.
+
+    :param graphs: a list of graphs
+    :return: a SPARQL query as a string
+    """
+    blocks = [_graph_to_candidate_block(g, position) for position, g in enumerate(graphs)]
+    query = queries.sparql_prefix + queries.sparql_select
+    if any(edge.relationid == 'class' for g in graphs for edge in g.edges):
+        query = queries.sparql_inference_clause + query
+    query = query.format(queryvariables="?candidate")
+    query += "{{ {} }}".format(" UNION ".join(blocks))
+    query += queries.sparql_close.format(len(graphs))
+    return query
+
+
+def _graph_to_candidate_block(g: SemanticGraph, position):
+    edges = [edge_to_sparql(edge, expand_transitive=False) for edge in g.edges]
+    return sparql_candidate_block.format(candidate=position, patterns='\n'.join(edges))
+
+
+def _grounding_context(g: SemanticGraph):
+    """
+    The groundings of a graph depend on the question tokens only through the question type and the zip code marker.
+    """
+    return sentence.get_question_type(" ".join(g.tokens)), "zip" in g.tokens
+
+
+def to_canonical_grounding(grounding, canonical_edges):
+    """
+    Replace edge ids in the grounding variables with the positions of the edges in the canonical order.
+
+    :param grounding: a grounding dictionary
+    :param canonical_edges: the edges of the grounded graph in the canonical order
+    :return: a grounding dictionary with canonical variable names
+    >>> g = SemanticGraph([Edge(leftentityid='Q76', rightentityid=QUESTION_VAR), Edge(leftentityid=QUESTION_VAR, rightentityid='Q5')])
+    >>> to_canonical_grounding({'r1v': 'P31v', 'topic': 'Q5'}, [e for _, e in g.canonical_edges()])
+    {'c0': 'P31v', 'topic': 'Q5'}
+    """
+    edgeid2position = {e.edgeid: i for i, e in enumerate(canonical_edges)}
+    canonical = {}
+    for k, v in grounding.items():
+        m = grounding_variable_pattern.match(k)
+        if m and int(m.group(1)) in edgeid2position:
+            k = f"c{edgeid2position[int(m.group(1))]:d}"
+        canonical[k] = v
+    return canonical
+
+
+def from_canonical_grounding(grounding, canonical_edges):
+    """
+    Inverse of to_canonical_grounding: replace the canonical edge positions with the edge ids of the given graph.
+
+    :param grounding: a grounding dictionary with canonical variable names
+    :param canonical_edges: the edges of the graph to ground in the canonical order
+    :return: a grounding dictionary
+    >>> g = SemanticGraph([Edge(leftentityid='Q76', rightentityid=QUESTION_VAR), Edge(leftentityid=QUESTION_VAR, rightentityid='Q5')])
+    >>> from_canonical_grounding({'c0': 'P31v', 'topic': 'Q5'}, [e for _, e in g.canonical_edges()])
+    {'r1v': 'P31v', 'topic': 'Q5'}
+    """
+    return {f"r{canonical_edges[int(k[1:])].edgeid:d}v" if k.startswith("c") else k: v for k, v in grounding.items()}
+
+
+def memoized_groundings(g: SemanticGraph, use_wikidata=True):
+    """
+    Retrieve the groundings of an equivalent graph from the memo, see SemanticGraph.fingerprint.
+
+    :param g: a graph with ungrounded edges
+    :param use_wikidata: whether the groundings were retrieved from Wikidata
+    :return: a list of groundings for the edge ids of g or None if no equivalent graph has been grounded
+    """
+    if not MEMOIZE_GROUNDINGS:
+        return None
+    key = (g.fingerprint(), _grounding_context(g), use_wikidata, FREQ_THRESHOLD)
+    if key not in _groundings_memo:
+        return None
+    canonical_edges = [e for _, e in g.canonical_edges()]
+    return [from_canonical_grounding(r, canonical_edges) for r in _groundings_memo[key]]
+
+
+def memoize_groundings(g: SemanticGraph, groundings, use_wikidata=True):
+    """
+    Store the groundings of the graph in the memo, so that they are shared with the equivalent graphs.
+
+    :param g: a graph with ungrounded edges
+    :param groundings: a list of groundings, failed queries (None) should not be memoized
+    :param use_wikidata: whether the groundings were retrieved from Wikidata
+    """
+    if MEMOIZE_GROUNDINGS and groundings is not None:
+        canonical_edges = [e for _, e in g.canonical_edges()]
+        _memoize(_groundings_memo, (g.fingerprint(), _grounding_context(g), use_wikidata, FREQ_THRESHOLD),
+                 [to_canonical_grounding(r, canonical_edges) for r in groundings])
+
+
+def memoized_verification(g: SemanticGraph):
+    """
+    Retrieve the verification result of an equivalent graph from the memo.
+
+    :param g: a graph with (partial) grounding
+    :return: the verification result or None if no equivalent graph has been verified
+    """
+    if not MEMOIZE_GROUNDINGS:
+        return None
+    return _verification_memo.get((g.fingerprint(), _grounding_context(g)))
+
+
+def memoize_verification(g: SemanticGraph, verified):
+    """
+    Store the verification result of the graph in the memo, failed queries (None) are not stored.
+
+    :param g: a graph with (partial) grounding
+    :param verified: the verification result
+    """
+    if MEMOIZE_GROUNDINGS and verified is not None:
+        _memoize(_verification_memo, (g.fingerprint(), _grounding_context(g)), verified)
+
+
+def _memoize(memo, key, value):
+    if len(memo) >= MAX_MEMO_SIZE:
+        memo.clear()
+    memo[key] = value
+
+
+def reset_memo():
+    _groundings_memo.clear()
+    _verification_memo.clear()
+
+
 def get_graph_denotations(g: SemanticGraph):
     """
     Convert the given graph to a WikiData query and retrieve the denotations of the graph. The results contain the
@@ -191,9 +462,38 @@ def get_graph_denotations(g: SemanticGraph):
     >>> get_graph_denotations(SemanticGraph([Edge(leftentityid='Q37320', relationid='P131', rightentityid='?m0Q37320'), Edge(leftentityid='?m0Q37320', relationid='P421', rightentityid=QUESTION_VAR)]))
     ['Q941023', 'Q28146035']
     """
+    denotations = query_cache.query_wikidata(graph_to_denotation_query(g))
+    return post_process_denotations(g, denotations)
+
+
+def graph_to_denotation_query(g: SemanticGraph):
+    """
+    Convert the given graph to a query that retrieves its denotations.
+
+    :param g: graph as a SemanticGraph
+    :return: a SPARQL query as a string
+    """
+    if _asks_for_zip_code(g):
+        return graph_to_query(g, limit=100)
+    edges = [e for e in g.edges if e.rightentityid != "Q5"]  # filter out edges with human as argument since they often fail
+    return graph_to_query(SemanticGraph(edges=edges), limit=100)
+
+
+def _asks_for_zip_code(g: SemanticGraph):
+    return "zip" in g.tokens and any(e.relationid == "P281" for e in g.edges)
+
+
+def post_process_denotations(g: SemanticGraph, denotations):
+    """
+    Extract the answers from the denotation query results. The labels of the temporal answers are retrieved
+    with a blocking query.
+
+    :param g: graph as a SemanticGraph
+    :param denotations: the results of graph_to_denotation_query
+    :return: a list of string denotations
+    """
     qvar_name = QUESTION_VAR[1:]
-    if "zip" in g.tokens and any(e.relationid == "P281" for e in g.edges):
-        denotations = endpoint_access.query_wikidata(graph_to_query(g, limit=100))
+    if _asks_for_zip_code(g):
         denotations = [r for r in denotations if any('x' not in r[b] for b in r)]  # Post process zip codes
         post_processed = []
         for r in denotations:
@@ -204,8 +504,6 @@ def get_graph_denotations(g: SemanticGraph):
                         p = codes[0][:(len(codes[0])) - len(p)] + p
                     post_processed.append(p)
         return post_processed
-    edges = [e for e in g.edges if e.rightentityid != "Q5"]  # filter out edges with human as argument since they often fail
-    denotations = endpoint_access.query_wikidata(graph_to_query(SemanticGraph(edges=edges), limit=100))
     if denotations and all('step' in d for d in denotations):
         min_transitive_steps = min([d['step'] for d in denotations])
         denotations = [d for d in denotations if d['step'] == min_transitive_steps]
@@ -0,0 +1,643 @@
+import collections
+import gzip
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.ERROR)
+
+WIKIDATA_ENTITY_PREFIX = "http://www.wikidata.org/entity/"
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+RDFS_SUBCLASSOF = "http://www.w3.org/2000/01/rdf-schema#subClassOf"
+# Triples without a named graph are added to the default graph, patterns outside of a GRAPH clause match any graph
+DEFAULT_GRAPH = ""
+
+# Prefixes that are used if a query doesn't declare them
+DEFAULT_PREFIXES = {
+    'e': WIKIDATA_ENTITY_PREFIX,
+    'g': "http://wikidata.org/",
+    'base': "http://www.wikidata.org/ontology#",
+    'rdf': "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+    'rdfs': "http://www.w3.org/2000/01/rdf-schema#",
+}
+
+nquads_term_pattern = re.compile(r'<([^>]*)>|(_:\S+)|"((?:[^"\\]|\\.)*)"(?:\^\^<[^>]*>|@[\w-]+)?')
+sparql_token_pattern = re.compile(r"""
+      (?P<iri><[^>\s]*>)
+    | (?P<var>[?$]\w+)
+    | (?P<string>'[^']*'|"[^"]*")
+    | (?P<pname>[A-Za-z_][\w-]*:[\w-]*)
+    | (?P<number>-?\d+(?:\.\d+)?)
+    | (?P<word>[A-Za-z_]\w*)
+    | (?P<punct>[{}()\[\].;,/?*=!<>|+])
+""", re.VERBOSE)
+year_pattern = re.compile(r"^(-?\d+)-")
+
+
+class TripleStore:
+    def __init__(self):
+        """
+        An in-memory store of Wikidata triples indexed in named graphs. The store answers the SPARQL queries
+        produced by graph_queries (basic graph patterns in GRAPH clauses, UNION, VALUES, property paths,
+        Virtuoso transitive option, YEAR filters, sub-selects, ORDER BY and LIMIT) and returns the results
+        in the format of endpoint_access.query_wikidata. It can replace the SPARQL endpoint for the grounding.
+
+        Entity IRIs are stored without the Wikidata namespace, literals are stored as their lexical form.
+        >>> s = TripleStore()
+        >>> s.add("Q76", "P26s", "Q76S1", "http://wikidata.org/statements")
+        >>> s.add("Q76S1", "P26v", "Q13133", "http://wikidata.org/statements")
+        >>> s.query("ASK WHERE { GRAPH g:statements { e:Q76 e:P26s/e:P26v e:Q13133 . } }")
+        True
+        >>> s.query("SELECT DISTINCT ?r0v WHERE { GRAPH g:statements { e:Q76 ?r0s ?m0 . ?m0 ?r0v ?qvar . } } LIMIT 10")
+        [{'r0v': 'P26v'}]
+        """
+        # graph -> index name -> first term -> second term -> set of third terms
+        self._graphs = {}
+        self.size = 0
+        # Loaded files, they identify the store in the query cache
+        self.sources = []
+
+    @staticmethod
+    def from_file(path_to_dump, graph=DEFAULT_GRAPH):
+        """
+        Load a store from an N-Quads or N-Triples file (optionally gzipped).
+
+        :param path_to_dump: path to the file
+        :param graph: the graph for triples that don't specify one
+        :return: a TripleStore
+        """
+        store = TripleStore()
+        store.load(path_to_dump, graph)
+        return store
+
+    def load(self, path_to_dump, graph=DEFAULT_GRAPH):
+        """
+        Add the triples from an N-Quads or N-Triples file (optionally gzipped) to the store.
+
+        :param path_to_dump: path to the file
+        :param graph: the graph for triples that don't specify one
+        """
+        with (gzip.open(path_to_dump, "rt", encoding="utf-8") if path_to_dump.endswith(".gz")
+              else open(path_to_dump, encoding="utf-8")) as f:
+            for line in f:
+                terms = parse_nquads_line(line)
+                if terms is None:
+                    continue
+                if len(terms) == 3:
+                    terms.append(graph)
+                self.add(*terms[:4])
+        self.sources.append(path_to_dump)
+        logger.debug(f"Loaded {self.size} triples from {path_to_dump}")
+
+    def add(self, s, p, o, graph=DEFAULT_GRAPH):
+        if graph not in self._graphs:
+            self._graphs[graph] = {'spo': {}, 'pos': {}, 'osp': {}}
+        indices = self._graphs[graph]
+        if o in indices['spo'].get(s, {}).get(p, ()):
+            return
+        indices['spo'].setdefault(s, {}).setdefault(p, set()).add(o)
+        indices['pos'].setdefault(p, {}).setdefault(o, set()).add(s)
+        indices['osp'].setdefault(o, {}).setdefault(s, set()).add(p)
+        self.size += 1
+
+    def triples(self, s=None, p=None, o=None, graph=None):
+        """
+        Iterate over the triples that match the pattern, None matches any term.
+
+        :param s: subject
+        :param p: predicate
+        :param o: object
+        :param graph: the name of the graph, None matches all graphs
+        :return: a generator of (subject, predicate, object) tuples
+        """
+        graphs = self._graphs.values() if graph is None else [self._graphs.get(graph)]
+        for indices in graphs:
+            if indices is None:
+                continue
+            if s is not None:
+                for p_, objects in ([(p, indices['spo'].get(s, {}).get(p, ()))] if p is not None
+                                    else indices['spo'].get(s, {}).items()):
+                    for o_ in ([o] if o is not None and o in objects else [] if o is not None else objects):
+                        yield s, p_, o_
+            elif o is not None:
+                for s_, predicates in indices['osp'].get(o, {}).items():
+                    for p_ in ([p] if p is not None and p in predicates else [] if p is not None else predicates):
+                        yield s_, p_, o
+            elif p is not None:
+                for o_, subjects in indices['pos'].get(p, {}).items():
+                    for s_ in subjects:
+                        yield s_, p, o_
+            else:
+                for s_, predicates in indices['spo'].items():
+                    for p_, objects in predicates.items():
+                        for o_ in objects:
+                            yield s_, p_, o_
+
+    def query(self, query, **kwargs):
+        """
+        Execute a SPARQL query against the store.
+
+        :param query: SPARQL query as a string
+        :param kwargs: ignored, accepted for compatibility with endpoint_access.query_wikidata
+        :return: a list of dictionaries for SELECT queries, True or an empty list for ASK queries,
+                 None if the query could not be parsed
+        """
+        try:
+            parsed = _QueryParser(query).parse()
+        except ValueError as ex:
+            logger.error(f"Unsupported query: {ex}")
+            return None
+        evaluator = _Evaluator(self, parsed['inference'])
+        if parsed['ask']:
+            return True if any(True for _ in evaluator.solutions(parsed['where'], {})) else []
+        return evaluator.select(parsed)
+
+
+def parse_nquads_line(line):
+    """
+    Parse a line of an N-Quads or N-Triples file.
+
+    :param line: the line as a string
+    :return: a list of 3 or 4 terms or None for an empty or a comment line
+    >>> parse_nquads_line('<http://www.wikidata.org/entity/Q76> <http://www.wikidata.org/entity/P26s> <http://www.wikidata.org/entity/Q76S1> <http://wikidata.org/statements> .')
+    ['Q76', 'P26s', 'Q76S1', 'http://wikidata.org/statements']
+    >>> parse_nquads_line('_:t1 <http://www.wikidata.org/ontology#time> "2009-01-20T00:00:00Z"^^<http://www.w3.org/2001/XMLSchema#dateTime> .')
+    ['_:t1', 'http://www.wikidata.org/ontology#time', '2009-01-20T00:00:00Z']
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    terms = []
+    for m in nquads_term_pattern.finditer(line):
+        iri, bnode, literal = m.groups()
+        if iri is not None:
+            terms.append(_shorten(iri))
+        elif bnode is not None:
+            terms.append(bnode)
+        else:
+            terms.append(literal.replace('\\"', '"').replace("\\\\", "\\"))
+    if len(terms) not in {3, 4}:
+        logger.debug(f"Skipping malformed line: {line}")
+        return None
+    return terms
+
+
+def _shorten(iri):
+    return iri[len(WIKIDATA_ENTITY_PREFIX):] if iri.startswith(WIKIDATA_ENTITY_PREFIX) else iri
+
+
+class _Var(str):
+    pass
+
+
+# A step in a property path: predicate (a term or a _Var), modifier (None, '?' or '*')
+PathStep = collections.namedtuple("PathStep", ['predicate', 'modifier'])
+TriplePattern = collections.namedtuple("TriplePattern", ['s', 'path', 'o', 'graph', 'transitive'])
+Transitive = collections.namedtuple("Transitive", ['t_min', 't_max', 'step'])
+
+
+class _QueryParser:
+    """
+    A recursive descent parser for the SPARQL fragment produced by graph_queries.
+    """
+    def __init__(self, query):
+        self.tokens = []
+        position = 0
+        for m in sparql_token_pattern.finditer(query):
+            if query[position:m.start()].strip():
+                raise ValueError(f"unexpected input: {query[position:m.start()].strip()[:20]}")
+            position = m.end()
+            self.tokens.append((m.lastgroup, m.group()))
+        self.i = 0
+        self.prefixes = dict(DEFAULT_PREFIXES)
+        self._blank_nodes = 0
+
+    def peek(self, offset=0):
+        return self.tokens[self.i + offset][1] if self.i + offset < len(self.tokens) else None
+
+    def peek_kind(self):
+        return self.tokens[self.i][0] if self.i < len(self.tokens) else None
+
+    def next(self):
+        if self.i >= len(self.tokens):
+            raise ValueError("unexpected end of query")
+        self.i += 1
+        return self.tokens[self.i - 1][1]
+
+    def expect(self, value):
+        token = self.next()
+        if token.upper() != value.upper():
+            raise ValueError(f"expected {value}, got {token}")
+
+    def accept(self, value):
+        if self.peek() is not None and self.peek().upper() == value.upper():
+            self.i += 1
+            return True
+        return False
+
+    def parse(self):
+        inference = False
+        while True:
+            if self.accept("DEFINE"):
+                self.next(), self.next()  # input:inference 'name'
+                inference = True
+            elif self.accept("PREFIX"):
+                name = self.next()
+                self.prefixes[name[:-1]] = self.next()[1:-1]
+            else:
+                break
+        query = self.parse_select() if self.peek().upper() == "SELECT" else self.parse_ask()
+        query['inference'] = inference
+        if self.peek() is not None:
+            raise ValueError(f"unexpected token {self.peek()}")
+        return query
+
+    def parse_ask(self):
+        self.expect("ASK")
+        self.accept("WHERE")
+        return {'ask': True, 'where': self.parse_group(None)}
+
+    def parse_select(self):
+        self.expect("SELECT")
+        distinct = self.accept("DISTINCT")
+        projection = []
+        while self.peek() != "{" and self.peek().upper() != "WHERE":
+            if self.accept("("):
+                value = self.parse_term()
+                self.expect("AS")
+                projection.append((_Var(self.next()[1:]), value))
+                self.expect(")")
+            else:
+                projection.append((_Var(self.next()[1:]), None))
+        self.accept("WHERE")
+        query = {'ask': False, 'distinct': distinct, 'projection': projection,
+                 'where': self.parse_group(None), 'order_by': [], 'limit': None}
+        if self.accept("ORDER"):
+            self.expect("BY")
+            while self.peek() is not None and self.peek().upper() in {"ASC", "DESC"}:
+                descending = self.next().upper() == "DESC"
+                self.expect("(")
+                query['order_by'].append((_Var(self.next()[1:]), descending))
+                self.expect(")")
+        if self.accept("LIMIT"):
+            query['limit'] = int(self.next())
+        return query
+
+    def parse_group(self, graph):
+        """
+        Parse a group graph pattern into a list of elements:
+        ('triple', TriplePattern), ('union', [groups]), ('values', var, [terms]), ('filter', expression),
+        ('subselect', query).
+        """
+        self.expect("{")
+        elements = []
+        if self.peek().upper() == "SELECT":
+            elements.append(('subselect', self.parse_select()))
+            self.expect("}")
+            return elements
+        while not self.accept("}"):
+            token = self.peek()
+            if token == "{":
+                groups = [self.parse_group(graph)]
+                while self.accept("UNION"):
+                    groups.append(self.parse_group(graph))
+                elements.append(('union', groups))
+            elif token.upper() == "GRAPH":
+                self.next()
+                elements.append(('union', [self.parse_group(self.parse_term())]))
+            elif token.upper() == "VALUES":
+                self.next()
+                var = _Var(self.next()[1:])
+                self.expect("{")
+                terms = []
+                while not self.accept("}"):
+                    terms.append(self.parse_term())
+                elements.append(('values', var, terms))
+            elif token.upper() == "FILTER":
+                self.next()
+                elements.append(('filter', self.parse_filter()))
+            elif token in {".", ";"}:
+                self.next()
+            else:
+                elements.extend(('triple', t) for t in self.parse_triples(graph))
+        return elements
+
+    def parse_triples(self, graph):
+        triples = []
+        subject = self.parse_node(graph, triples)
+        path = self.parse_path()
+        obj = self.parse_node(graph, triples)
+        transitive = None
+        if self.peek() is not None and self.peek().lower() == "option":
+            transitive = self.parse_transitive_option()
+        triples.insert(0, TriplePattern(subject, path, obj, graph, transitive))
+        return triples
+
+    def parse_node(self, graph, triples):
+        if self.accept("["):
+            node = _Var(f"_b{self._blank_nodes}")
+            self._blank_nodes += 1
+            path = self.parse_path()
+            obj = self.parse_node(graph, triples)
+            self.expect("]")
+            triples.append(TriplePattern(node, path, obj, graph, None))
+            return node
+        return self.parse_term()
+
+    def parse_path(self):
+        steps = []
+        while True:
+            predicate = self.parse_term()
+            modifier = self.next() if self.peek() in {"?", "*"} else None
+            steps.append(PathStep(predicate, modifier))
+            if not self.accept("/"):
+                return steps
+
+    def parse_transitive_option(self):
+        self.next()
+        self.expect("(")
+        t_min, t_max, step, depth = 0, None, None, 1
+        while depth > 0:
+            token = self.next()
+            if token == "(":
+                depth += 1
+            elif token == ")":
+                depth -= 1
+            elif token.lower() in {"t_min", "t_max"}:
+                self.expect("(")
+                value = int(self.next())
+                self.expect(")")
+                if token.lower() == "t_min":
+                    t_min = value
+                else:
+                    t_max = value
+            elif token.upper() == "AS":
+                step = _Var(self.next()[1:])
+        return Transitive(t_min, t_max, step)
+
+    def parse_filter(self):
+        self.expect("(")
+        left = self.parse_operand()
+        operator = self.next()
+        if operator == "!":
+            self.expect("=")
+            operator = "!="
+        right = self.parse_operand()
+        self.expect(")")
+        return left, operator, right
+
+    def parse_operand(self):
+        if self.peek().upper() == "YEAR":
+            self.next()
+            self.expect("(")
+            operand = ('year', self.parse_term())
+            self.expect(")")
+            return operand
+        return 'term', self.parse_term()
+
+    def parse_term(self):
+        kind, token = self.tokens[self.i] if self.i < len(self.tokens) else (None, None)
+        self.i += 1
+        if kind == 'var':
+            return _Var(token[1:])
+        if kind == 'iri':
+            return _shorten(token[1:-1])
+        if kind == 'pname':
+            prefix, local = token.split(":", 1)
+            if prefix not in self.prefixes:
+                raise ValueError(f"unknown prefix {prefix}")
+            return _shorten(self.prefixes[prefix] + local)
+        if kind in {'string'}:
+            return token[1:-1]
+        if kind == 'number':
+            return token
+        if kind == 'word' and token == "a":
+            return RDF_TYPE
+        raise ValueError(f"unexpected term {token}")
+
+
+class _Evaluator:
+    def __init__(self, store, inference):
+        self.store = store
+        self.inference = inference
+
+    def select(self, query):
+        solutions = self.solutions(query['where'], {})
+        if query['order_by']:
+            solutions = list(solutions)
+            for var, descending in reversed(query['order_by']):
+                solutions.sort(key=lambda b: (var in b, b.get(var, "")), reverse=descending)
+        results, seen = [], set()
+        for binding in solutions:
+            result = {}
+            for var, value in query['projection']:
+                if value is not None:
+                    result[str(var)] = value
+                elif var in binding:
+                    result[str(var)] = binding[var]
+            if query['distinct']:
+                key = tuple(sorted(result.items()))
+                if key in seen:
+                    continue
+                seen.add(key)
+            results.append(result)
+            if query['limit'] is not None and len(results) >= query['limit']:
+                break
+        return results
+
+    def solutions(self, group, binding):
+        """
+        Evaluate the group with the given partial binding.
+
+        :return: a generator of complete bindings
+        """
+        patterns = [e for e in group if e[0] != 'filter']
+        filters = [e[1] for e in group if e[0] == 'filter']
+        for b in self._join(patterns, binding):
+            if all(self._filter(f, b) for f in filters):
+                yield b
+
+    def _join(self, elements, binding):
+        if not elements:
+            yield binding
+            return
+        # Triple patterns with the most bound terms are evaluated first
+        position = min(range(len(elements)), key=lambda i: self._cost(elements[i], binding))
+        element, rest = elements[position], elements[:position] + elements[position + 1:]
+        for b in self._evaluate(element, binding):
+            yield from self._join(rest, b)
+
+    def _cost(self, element, binding):
+        if element[0] == 'values':
+            return 0
+        if element[0] != 'triple':
+            return 2
+        pattern = element[1]
+        bound = [not isinstance(t, _Var) or t in binding for t in (pattern.s, pattern.o)]
+        return 1 if all(bound) else 2 if any(bound) else 3
+
+    def _evaluate(self, element, binding):
+        if element[0] == 'triple':
+            yield from self._match(element[1], binding)
+        elif element[0] == 'union':
+            for group in element[1]:
+                yield from self.solutions(group, binding)
+        elif element[0] == 'values':
+            var, terms = element[1], element[2]
+            for term in terms:
+                if var not in binding:
+                    yield {**binding, var: term}
+                elif binding[var] == term:
+                    yield binding
+        elif element[0] == 'subselect':
+            for result in self.select(element[1]):
+                result = {_Var(k): v for k, v in result.items()}
+                if all(binding.get(k, v) == v for k, v in result.items()):
+                    yield {**binding, **result}
+
+    def _match(self, pattern, binding):
+        s = binding.get(pattern.s, pattern.s) if isinstance(pattern.s, _Var) else pattern.s
+        o = binding.get(pattern.o, pattern.o) if isinstance(pattern.o, _Var) else pattern.o
+        s_bound, o_bound = not isinstance(s, _Var), not isinstance(o, _Var)
+        if pattern.transitive is not None:
+            pairs = self._transitive(pattern, binding, s if s_bound else None, o if o_bound else None)
+        elif o_bound and not s_bound:
+            pairs = ((x, o, b) for x, b in self._walk(list(reversed(pattern.path)), pattern.graph,
+                                                      o, binding, backward=True))
+        else:
+            starts = [s] if s_bound else self._subjects(pattern.path[0], pattern.graph, binding)
+            pairs = ((start, x, b) for start in starts for x, b in self._walk(pattern.path, pattern.graph,
+                                                                               start, binding))
+        for subject, obj, b in pairs:
+            if s_bound and subject != s or o_bound and obj != o:
+                continue
+            if not s_bound:
+                if pattern.s in b and b[pattern.s] != subject:
+                    continue
+                b = {**b, pattern.s: subject}
+            if not o_bound:
+                if pattern.o in b and b[pattern.o] != obj:
+                    continue
+                b = {**b, pattern.o: obj}
+            yield b
+
+    def _subjects(self, step, graph, binding):
+        predicate = binding.get(step.predicate, None) if isinstance(step.predicate, _Var) else step.predicate
+        return {t[0] for t in self.store.triples(p=predicate, graph=graph)}
+
+    def _walk(self, path, graph, node, binding, backward=False):
+        """
+        Follow the property path from the node.
+
+        :return: a generator of (end node, binding) tuples, the binding is extended with the predicate variables
+        """
+        if not path:
+            yield node, binding
+            return
+        step, rest = path[0], path[1:]
+        if step.modifier is not None:
+            for x in self._closure(step.predicate, graph, node, backward, step.modifier == "*"):
+                yield from self._walk(rest, graph, x, binding, backward)
+            return
+        for x, b in self._step(step.predicate, graph, node, binding, backward):
+            yield from self._walk(rest, graph, x, b, backward)
+
+    def _step(self, predicate, graph, node, binding, backward):
+        if isinstance(predicate, _Var):
+            p = binding.get(predicate)
+        else:
+            p = predicate
+        if self.inference and p == RDF_TYPE:
+            # Instances of the subclasses are also instances of the class
+            if backward:
+                for c in self._closure(RDFS_SUBCLASSOF, graph, node, True, True):
+                    for t in self.store.triples(o=c, p=RDF_TYPE, graph=graph):
+                        yield t[0], binding
+            else:
+                for t in self.store.triples(s=node, p=RDF_TYPE, graph=graph):
+                    for c in self._closure(RDFS_SUBCLASSOF, graph, t[2], False, True):
+                        yield c, binding
+            return
+        triples = self.store.triples(o=node, p=p, graph=graph) if backward \
+            else self.store.triples(s=node, p=p, graph=graph)
+        for t in triples:
+            b = binding if p is not None else {**binding, predicate: t[1]}
+            yield (t[0] if backward else t[2]), b
+
+    def _closure(self, predicate, graph, node, backward, unbounded):
+        reached = [node]
+        visited = {node}
+        frontier = [node]
+        while frontier:
+            next_frontier = []
+            for n in frontier:
+                for x, _ in self._step(predicate, graph, n, {}, backward):
+                    if x not in visited:
+                        visited.add(x)
+                        next_frontier.append(x)
+            reached.extend(next_frontier)
+            frontier = next_frontier if unbounded else []
+        return reached
+
+    def _transitive(self, pattern, binding, s, o):
+        """
+        Virtuoso transitive option: the whole path is repeated t_min to t_max times without cycles,
+        the number of repetitions is bound to the step variable.
+        """
+        options = pattern.transitive
+        backward = s is None and o is not None
+        if s is not None:
+            starts = [s]
+        elif o is not None:
+            starts = [o]
+        else:
+            starts = self._subjects(pattern.path[0], pattern.graph, binding)
+        path = list(reversed(pattern.path)) if backward else pattern.path
+        for start in starts:
+            visited = {start}
+            frontier = [start]
+            step = 0
+            if options.t_min == 0:
+                yield from self._with_step(start, start, backward, binding, options, step)
+            while frontier and (options.t_max is None or step < options.t_max):
+                step += 1
+                next_frontier = []
+                for n in frontier:
+                    for x, _ in self._walk(path, pattern.graph, n, binding, backward):
+                        if x not in visited:
+                            visited.add(x)
+                            next_frontier.append(x)
+                            if step >= options.t_min:
+                                yield from self._with_step(start, x, backward, binding, options, step)
+                frontier = next_frontier
+
+    @staticmethod
+    def _with_step(start, end, backward, binding, options, step):
+        b = binding if options.step is None else {**binding, options.step: str(step)}
+        yield (end, start, b) if backward else (start, end, b)
+
+    def _filter(self, expression, binding):
+        left, operator, right = [self._operand(e, binding) if isinstance(e, tuple) else e for e in expression]
+        if left is None or right is None:
+            return False
+        if operator == "=":
+            return left == right
+        if operator == "!=":
+            return left != right
+        raise ValueError(f"unsupported operator {operator}")
+
+    @staticmethod
+    def _operand(operand, binding):
+        kind, term = operand
+        value = binding.get(term) if isinstance(term, _Var) else term
+        if value is None:
+            return None
+        if kind == 'year':
+            m = year_pattern.match(value)
+            return str(int(m.group(1))) if m else None
+        return value
+
+
+if __name__ == "__main__":
+    import doctest
+    print(doctest.testmod())
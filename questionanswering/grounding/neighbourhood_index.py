@@ -0,0 +1,176 @@
+import gzip
+import json
+import logging
+import os
+
+from questionanswering.construction.graph import SemanticGraph
+from questionanswering.grounding import graph_queries, query_cache, stages
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.ERROR)
+
+DEFAULT_LEG_LENGTH = 2
+# The qualifier shapes are only generated for the questions with these tokens, see stages.add_entity_and_relation
+_QUALIFIER_SHAPE_TOKENS = ["played"]
+
+
+class NeighbourhoodIndex:
+    def __init__(self, path_to_index):
+        """
+        Precomputed groundings of the one- and two-hop graphs around an entity. The index answers
+        the ungrounded-relation queries for the graph shapes produced by stages.add_entity_and_relation
+        from a single entity. Other graphs are not covered and have to be grounded with SPARQL.
+
+        The index is stored as (optionally gzipped) JSON lines, one entity per line. The groundings of each shape are stored
+        in the raw form returned by the endpoint, keyed on the graph fingerprint, and use the canonical edge
+        positions instead of the edge ids.
+
+        :param path_to_index: location of the index file
+        """
+        self.hits = 0
+        self.misses = 0
+        self.entities = set()
+        self._groundings = {}
+        for entry in read_entries(path_to_index):
+            self.entities.add(entry['entity'])
+            self._groundings.update(entry['shapes'])
+        logger.debug(f"Loaded the neighbourhood of {len(self.entities)} entities, {len(self._groundings)} shapes")
+
+    def get_groundings(self, g: SemanticGraph):
+        """
+        Retrieve the raw groundings of the graph from the index.
+
+        :param g: a graph with ungrounded edges
+        :return: a list of groundings or None if the graph shape is not covered by the index
+        """
+        fingerprint = g.fingerprint()
+        if fingerprint not in self._groundings:
+            self.misses += 1
+            return None
+        self.hits += 1
+        canonical_edges = [e for _, e in g.canonical_edges()]
+        return [graph_queries.from_canonical_grounding(r, canonical_edges) for r in self._groundings[fingerprint]]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entities': len(self.entities)}
+
+
+def entity_shapes(entityid, leg_length=DEFAULT_LEG_LENGTH):
+    """
+    Construct all graphs with ungrounded relations that add_entity_and_relation produces for a single entity.
+
+    :param entityid: a Wikidata entity id
+    :param leg_length: maximum leg length
+    :return: a list of SemanticGraph objects with distinct fingerprints
+    >>> [g.fingerprint() for g in entity_shapes("Q76", leg_length=1)] == \
+    [g.fingerprint() for g in [SemanticGraph([graph_queries.graph.Edge(leftentityid=graph_queries.QUESTION_VAR, rightentityid="Q76")]), \
+    SemanticGraph([graph_queries.graph.Edge(leftentityid="Q76", rightentityid=graph_queries.QUESTION_VAR)]), \
+    SemanticGraph([graph_queries.graph.Edge(rightentityid=graph_queries.QUESTION_VAR, qualifierentityid="Q76")])]]
+    True
+    """
+    shapes = []
+    fingerprints = set()
+    for leg_len in range(1, leg_length + 1):
+        start = SemanticGraph(free_entities=[{'linkings': [(entityid, entityid)], 'type': 'NNP'}],
+                              tokens=_QUALIFIER_SHAPE_TOKENS)
+        for g in stages.add_entity_and_relation(start, leg_length=leg_len):
+            if g.fingerprint() not in fingerprints:
+                fingerprints.add(g.fingerprint())
+                shapes.append(g)
+    return shapes
+
+
+def read_entries(path_to_index):
+    """
+    Read the entries of an index file. A truncated tail, e.g. left by a killed job, is skipped with a warning.
+
+    :param path_to_index: location of the index file, gzipped if the name ends with .gz
+    :return: a generator of entry dictionaries
+    """
+    with _open_index(path_to_index, "rt") as f:
+        try:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Skipping a truncated entry in {path_to_index}")
+                    continue
+                yield entry
+        except (EOFError, OSError) as ex:
+            logger.warning(f"The index file {path_to_index} is truncated: {ex}")
+
+
+def build_index(entityids, path_to_index, leg_length=DEFAULT_LEG_LENGTH):
+    """
+    Query the groundings of the one- and two-hop shapes for each entity and add them to the index file.
+
+    New entries are appended to an uncompressed file next to the index (path_to_index + ".partial") that is
+    merged into the index once all entities are processed. The entities that are already in either file are
+    skipped, so that an interrupted job can be resumed even if it was killed in the middle of a write.
+
+    :param entityids: an iterable of Wikidata entity ids
+    :param path_to_index: location of the index file
+    :param leg_length: maximum leg length
+    :return: the number of the entities added to the index
+    """
+    path_to_partial = path_to_index + ".partial"
+    indexed = set()
+    if os.path.exists(path_to_index):
+        indexed = {entry['entity'] for entry in read_entries(path_to_index)}
+    if os.path.exists(path_to_partial):
+        _truncate_to_last_line(path_to_partial)
+        indexed |= {entry['entity'] for entry in read_entries(path_to_partial)}
+    added = 0
+    with open(path_to_partial, "a", encoding="utf-8") as out:
+        for entityid in entityids:
+            if entityid in indexed:
+                continue
+            indexed.add(entityid)
+            shapes = {}
+            for g in entity_shapes(entityid, leg_length):
+                groundings = query_cache.query_wikidata(graph_queries.graph_to_query(g, limit=500))
+                if groundings is None:  # Failed shapes are left to the SPARQL fallback
+                    continue
+                canonical_edges = [e for _, e in g.canonical_edges()]
+                shapes[g.fingerprint()] = [graph_queries.to_canonical_grounding(r, canonical_edges)
+                                           for r in groundings]
+            out.write(json.dumps({'entity': entityid, 'shapes': shapes}) + "\n")
+            out.flush()
+            added += 1
+    _merge_partial(path_to_index, path_to_partial)
+    return added
+
+
+def _open_index(path_to_index, mode):
+    if path_to_index.endswith(".gz"):
+        return gzip.open(path_to_index, mode, encoding="utf-8")
+    return open(path_to_index, mode, encoding="utf-8")
+
+
+def _truncate_to_last_line(path):
+    """
+    Cut off an incomplete last line, so that the next entry isn't appended to it.
+    """
+    with open(path, "rb+") as f:
+        content = f.read()
+        if content and not content.endswith(b"\n"):
+            f.truncate(content.rfind(b"\n") + 1)
+
+
+def _merge_partial(path_to_index, path_to_partial):
+    """
+    Write the entries of the index and the partial file to a new index and replace the old one at once.
+    """
+    path_to_tmp = path_to_index + ".tmp" + (".gz" if path_to_index.endswith(".gz") else "")
+    with _open_index(path_to_tmp, "wt") as out:
+        for path in [path_to_index, path_to_partial]:
+            if os.path.exists(path):
+                for entry in read_entries(path):
+                    out.write(json.dumps(entry) + "\n")
+    os.replace(path_to_tmp, path_to_index)
+    os.remove(path_to_partial)
+
+
+if __name__ == "__main__":
+    import doctest
+    print(doctest.testmod())
@@ -0,0 +1,316 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from wikidata import endpoint_access
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.ERROR)
+
+DEFAULT_MAX_ENTRIES = 1000000
+# Fraction of the cache that is freed at once when the size limit is reached
+EVICT_FRACTION = 0.05
+# Access times of cache hits are written to the file in batches of this size
+ACCESS_FLUSH_INTERVAL = 1000
+# Seconds to wait for a lock held by another process that uses the same cache file
+BUSY_TIMEOUT = 60.0
+
+CACHE = None
+# Limits the number of queries that are sent to the endpoint at the same time from concurrent threads
+_endpoint_semaphore = None
+# The same limit for the asynchronous client, see async_queries.AsyncSparqlClient
+MAX_CONCURRENT_QUERIES = 0
+# A local triple store that answers the queries instead of the endpoint, see local_store.TripleStore
+LOCAL_BACKEND = None
+# Cache keys of the endpoint results don't mention the backend, so that existing cache files stay valid
+DEFAULT_BACKEND = "endpoint"
+
+
+class SparqlCache:
+    def __init__(self, path_to_cache, max_entries=DEFAULT_MAX_ENTRIES, read_only=False):
+        """
+        A persistent cache for the results of SPARQL queries backed by an SQLite file. The least recently
+        used entries are evicted once the cache reaches max_entries.
+
+        :param path_to_cache: location of the SQLite file, ":memory:" creates a non-persistent cache
+        :param max_entries: maximum number of stored query results
+        :param read_only: if True the cache file is never modified, misses are answered by the endpoint
+        >>> c = SparqlCache(":memory:", max_entries=2)
+        >>> c.put("ASK { ?s ?p ?o }", {}, True)
+        >>> c.get("ASK  {  ?s ?p ?o }", {})
+        True
+        >>> c.get("ASK { ?s ?p ?o }", {'timeout': 1}) is None
+        True
+        >>> c.stats()
+        {'hits': 1, 'misses': 1, 'size': 1}
+        >>> c.get("ASK { ?s ?p ?o }", {}, backend="local") is None
+        True
+
+        Several processes can share the cache file. Entries are ordered by their wall clock access time,
+        the access times of hits are written in batches and the updates of a locked file are skipped
+        instead of failing the query.
+        """
+        self.path_to_cache = path_to_cache
+        self.max_entries = max_entries
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> access time of the hits that are not written to the file yet
+        self._pending_access = {}
+        if path_to_cache != ":memory:" and not read_only:
+            dir_name = os.path.dirname(path_to_cache)
+            if dir_name and not os.path.exists(dir_name):
+                os.makedirs(dir_name)
+        if read_only:
+            self._db = sqlite3.connect(f"file:{path_to_cache}?mode=ro", uri=True, timeout=BUSY_TIMEOUT,
+                                       check_same_thread=False)
+        else:
+            self._db = sqlite3.connect(path_to_cache, timeout=BUSY_TIMEOUT, check_same_thread=False)
+            if path_to_cache != ":memory:":
+                # Readers don't block the writer, and commits don't wait for a full fsync
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS results "
+                             "(key TEXT PRIMARY KEY, value TEXT, accessed INTEGER)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+            self._db.commit()
+        self._size = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def get(self, query, query_args, backend=DEFAULT_BACKEND):
+        """
+        Retrieve the stored result for the query.
+
+        :param query: SPARQL query as a string
+        :param query_args: additional arguments of the query, e.g. timeout
+        :param backend: name of the backend that answers the query, see backend_name
+        :return: the stored result or None if the query is not in the cache or the cache file is locked
+        """
+        key = query_key(query, query_args, backend)
+        with self._lock:
+            try:
+                row = self._db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            except sqlite3.OperationalError as ex:
+                logger.warning(f"Query cache read failed: {ex}")
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self._pending_access[key] = time.time_ns()
+                if len(self._pending_access) >= ACCESS_FLUSH_INTERVAL:
+                    self._flush_access()
+                    self._commit()
+        return json.loads(row[0])
+
+    def put(self, query, query_args, result, backend=DEFAULT_BACKEND):
+        """
+        Store the query result. Nothing is stored in the read-only mode.
+
+        :param query: SPARQL query as a string
+        :param query_args: additional arguments of the query, e.g. timeout
+        :param result: JSON serializable query result
+        :param backend: name of the backend that answered the query, see backend_name
+        """
+        if self.read_only:
+            return
+        key = query_key(query, query_args, backend)
+        with self._lock:
+            value = json.dumps(result)
+            try:
+                self._flush_access()
+                inserted = self._db.execute("INSERT OR IGNORE INTO results (key, value, accessed) VALUES (?, ?, ?)",
+                                            (key, value, time.time_ns())).rowcount
+                if inserted:
+                    self._size += 1
+                else:
+                    self._db.execute("UPDATE results SET value = ?, accessed = ? WHERE key = ?",
+                                     (value, time.time_ns(), key))
+                if self._size > self.max_entries:
+                    # Other processes might have added entries as well
+                    self._size = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+                if self._size > self.max_entries:
+                    to_evict = self._size - self.max_entries + int(self.max_entries * EVICT_FRACTION)
+                    self._db.execute("DELETE FROM results WHERE key IN "
+                                     "(SELECT key FROM results ORDER BY accessed ASC LIMIT ?)", (to_evict,))
+                    self._size = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+                    logger.debug(f"Evicted {to_evict} entries from the query cache")
+            except sqlite3.OperationalError as ex:
+                logger.warning(f"Query cache write failed: {ex}")
+                self._db.rollback()
+                return
+            self._commit()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': self._size}
+
+    def close(self):
+        with self._lock:
+            if not self.read_only:
+                try:
+                    self._flush_access()
+                except sqlite3.OperationalError as ex:
+                    logger.warning(f"Query cache write failed: {ex}")
+                self._commit()
+            self._db.close()
+
+    def _flush_access(self):
+        if self._pending_access:
+            pending, self._pending_access = self._pending_access, {}
+            self._db.executemany("UPDATE results SET accessed = ? WHERE key = ?",
+                                 [(accessed, key) for key, accessed in pending.items()])
+
+    def _commit(self):
+        try:
+            self._db.commit()
+        except sqlite3.OperationalError as ex:
+            logger.warning(f"Query cache write failed: {ex}")
+            self._db.rollback()
+
+
+def normalize_query(query):
+    """
+    Collapse all whitespace in the query, so that queries that differ only in formatting share a cache entry.
+
+    :param query: SPARQL query as a string
+    :return: normalized query string
+    >>> normalize_query("SELECT ?e  WHERE {\\n   ?e ?p ?o }\\n")
+    'SELECT ?e WHERE { ?e ?p ?o }'
+    """
+    return re.sub(r"\s+", " ", query).strip()
+
+
+def query_key(query, query_args, backend=DEFAULT_BACKEND):
+    """
+    Compute a cache key from the normalized query, the query arguments and the backend that answers the query.
+
+    :param query: SPARQL query as a string
+    :param query_args: a dictionary of additional query arguments
+    :param backend: name of the backend, see backend_name
+    :return: key as a hex string
+    >>> query_key("ASK { ?s ?p ?o }", {'timeout': 1}) == query_key("ASK {  ?s ?p ?o }", {'timeout': 1})
+    True
+    >>> query_key("ASK { ?s ?p ?o }", {}) == query_key("ASK { ?s ?p ?o }", {}, backend="local")
+    False
+    """
+    key = normalize_query(query) + "|" + json.dumps(query_args, sort_keys=True)
+    if backend != DEFAULT_BACKEND:
+        key += "|" + backend
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def set_cache(cache):
+    """
+    Set the global query cache, None switches caching off.
+
+    :param cache: a SparqlCache object or None
+    """
+    global CACHE
+    CACHE = cache
+
+
+def reopen_cache():
+    """
+    Open a new connection to the global cache file. Has to be called in a forked process,
+    since SQLite connections can't be shared with the parent process. The processes wait for each other's
+    locks for up to BUSY_TIMEOUT seconds, see SparqlCache.
+    """
+    if CACHE is not None:
+        set_cache(SparqlCache(CACHE.path_to_cache, max_entries=CACHE.max_entries, read_only=CACHE.read_only))
+
+
+def set_max_concurrent_queries(max_concurrent_queries):
+    """
+    Limit the number of concurrent requests to the endpoint, a value < 1 removes the limit.
+
+    :param max_concurrent_queries: maximum number of requests in flight
+    """
+    global _endpoint_semaphore, MAX_CONCURRENT_QUERIES
+    MAX_CONCURRENT_QUERIES = max(max_concurrent_queries, 0)
+    _endpoint_semaphore = threading.BoundedSemaphore(max_concurrent_queries) if max_concurrent_queries > 0 else None
+
+
+def set_local_backend(store):
+    """
+    Answer the queries with a local triple store instead of the endpoint, None switches back to the endpoint.
+
+    :param store: a local_store.TripleStore or None
+    """
+    global LOCAL_BACKEND
+    LOCAL_BACKEND = store
+
+
+def backend_name():
+    """
+    Name of the backend that currently answers the queries, results of different backends are cached separately.
+
+    :return: DEFAULT_BACKEND for the endpoint or the name of the local store
+    >>> backend_name()
+    'endpoint'
+    """
+    if LOCAL_BACKEND is not None:
+        return "local:" + ",".join(getattr(LOCAL_BACKEND, 'sources', []))
+    return DEFAULT_BACKEND
+
+
+def _query_endpoint(query, **kwargs):
+    if LOCAL_BACKEND is not None:
+        return LOCAL_BACKEND.query(query, **kwargs)
+    if _endpoint_semaphore is None:
+        return endpoint_access.query_wikidata(query, **kwargs)
+    with _endpoint_semaphore:
+        return endpoint_access.query_wikidata(query, **kwargs)
+
+
+def query_wikidata(query, **kwargs):
+    """
+    Execute the query against the Wikidata endpoint or retrieve the result from the global cache.
+    Failed queries (the endpoint returns None) are never cached.
+
+    :param query: SPARQL query as a string
+    :param kwargs: additional arguments for endpoint_access.query_wikidata
+    :return: query results as returned by endpoint_access.query_wikidata
+    """
+    result = get_cached_result(query, **kwargs)
+    if result is not None:
+        return result
+    result = _query_endpoint(query, **kwargs)
+    cache_result(query, result, **kwargs)
+    return result
+
+
+def get_cached_result(query, **kwargs):
+    """
+    Retrieve the result of the query answered by the current backend from the global cache.
+
+    :param query: SPARQL query as a string
+    :param kwargs: additional query arguments
+    :return: the stored result or None if the query is not cached or caching is off
+    """
+    if CACHE is None:
+        return None
+    return CACHE.get(query, kwargs, backend_name())
+
+
+def cache_result(query, result, **kwargs):
+    """
+    Store the result of the query answered by the current backend in the global cache. Failed queries (None)
+    are never cached.
+
+    :param query: SPARQL query as a string
+    :param result: query result
+    :param kwargs: additional query arguments
+    """
+    if CACHE is not None and result is not None:
+        CACHE.put(query, kwargs, result, backend_name())
+
+
+if __name__ == "__main__":
+    import doctest
+    print(doctest.testmod())
@@ -1,18 +1,33 @@
+import collections
+import heapq
 import logging
+from concurrent import futures
 from copy import copy
 from typing import List
 
+import numpy as np
+import torch
+
 from questionanswering.construction.graph import WithScore
 from questionanswering.construction import graph
 from questionanswering.construction.graph import SemanticGraph, Edge
 from questionanswering.construction import sentence
 from questionanswering.datasets import evaluation
 from questionanswering.grounding import graph_queries, stages
-from questionanswering.models import vectorization as V
+from questionanswering.models import vectorization as V, traced
 
 MIN_F_SCORE_TO_STOP = 0.9
 MAX_ITERATIONS = 1000
 
+# Number of threads that send grounding and denotation queries concurrently, 1 means serial execution
+GROUNDING_WORKERS = 1
+_executor = None
+# Grounds the candidate graphs of a beam step from one event loop instead, see async_queries.AsyncGrounder
+_async_grounder = None
+
+# Operations on the search frontier of generate_with_gold, can be inspected for profiling
+POOL_OPERATIONS = collections.Counter()
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.ERROR)
 
@@ -26,22 +41,27 @@ def generate_with_gold(graph_with_scores, gold_answers):
     :param gold_answers: list of gold answers for the encoded question
     :return: a list of generated grounded graphs
     """
-    pool = [graph_with_scores]  # pool of possible parses
     if len(gold_answers) == 0 or not any(gold_answers):
-        return pool
+        return [graph_with_scores]
+    # The pool of possible parses is a heap ordered by the number of edges and the f-score,
+    # ties are broken by the insertion order
+    pool = []
+    visited = set()
+    _push_to_pool(pool, visited, graph_with_scores)
     positive_graphs, negative_graphs = [], []
     iterations = 0
     while pool \
             and (max(g.scores[2] for g in positive_graphs) if len(positive_graphs) > 0 else 0.0) < MIN_F_SCORE_TO_STOP \
             and iterations < MAX_ITERATIONS:
-        g = pool.pop(0)
+        g = heapq.heappop(pool)[-1]
+        POOL_OPERATIONS['pop'] += 1
         logger.debug("Pool length: {}, Graph: {}".format(len(pool), g))
         master_g_fscore = g.scores[2]
         if master_g_fscore < MIN_F_SCORE_TO_STOP:
             chosen_graphs = []
             f_i = 0
             while f_i < len(stages.ACTIONS) and not chosen_graphs:
-                suggested_graphs = stages.ACTIONS[f_i](g[0])
+                suggested_graphs = deduplicate_graphs(stages.ACTIONS[f_i](g[0]))
                 logger.debug("Suggested graphs: {}".format(suggested_graphs))
                 for s_g in suggested_graphs:
                     iterations += 1
@@ -54,15 +74,16 @@ def generate_with_gold(graph_with_scores, gold_answers):
 
             if len(chosen_graphs) > 0:
                 logger.debug("Extending the pool.")
-                pool.extend(chosen_graphs)
-                pool = sorted(pool, key=lambda x: (len(x.graph.edges), 1-x.scores[2]), reverse=False)
+                for chosen_g in chosen_graphs:
+                    _push_to_pool(pool, visited, chosen_g)
 
     negative_graphs = sorted(negative_graphs, key=lambda x: (len(x.graph.edges), -len(x.graph.denotations)), reverse=True)
     positive_graphs = sorted(positive_graphs, key=lambda x: x.scores[2], reverse=True)
     return_graphs = positive_graphs + negative_graphs[:100]
-    for g in return_graphs:
-        g.graph.denotation_classes = graph_queries.get_graph_groundings(
-            stages.with_denotation_class_edge(g.graph))
+    denotation_classes = _map_grounding(lambda x: graph_queries.get_graph_groundings(
+        stages.with_denotation_class_edge(x.graph)), return_graphs)
+    for g, g_denotation_classes in zip(return_graphs, denotation_classes):
+        g.graph.denotation_classes = g_denotation_classes
     logger.debug(f"Iterations {iterations}")
     logger.debug(f"Negative {len(negative_graphs)}")
     if iterations >= MAX_ITERATIONS:
@@ -70,6 +91,63 @@ def generate_with_gold(graph_with_scores, gold_answers):
     return return_graphs
 
 
+def _push_to_pool(pool, visited, g):
+    """
+    Add the graph to the search frontier unless an equivalent graph has been added before.
+
+    :param pool: the frontier heap
+    :param visited: a set of canonical keys of the graphs that were added to the frontier
+    :param g: a graph with scores
+    >>> pool, visited = [], set()
+    >>> _push_to_pool(pool, visited, WithScore(SemanticGraph([Edge(leftentityid="Q76", rightentityid=graph_queries.QUESTION_VAR)]), (0.5, 0.5, 0.5)))
+    >>> _push_to_pool(pool, visited, WithScore(SemanticGraph([Edge(leftentityid="Q76", rightentityid=graph_queries.QUESTION_VAR)]), (0.5, 0.5, 0.5)))
+    >>> len(pool)
+    1
+    """
+    key = (g.graph.fingerprint(), tuple(l[0] for e in g.graph.free_entities for l in e.get('linkings', [])))
+    if key in visited:
+        POOL_OPERATIONS['duplicate'] += 1
+        return
+    visited.add(key)
+    POOL_OPERATIONS['push'] += 1
+    heapq.heappush(pool, (len(g.graph.edges), 1 - g.scores[2], len(visited), g))
+
+
+def set_grounding_workers(workers):
+    """
+    Set the number of threads used to query groundings and denotations. The results are always processed in
+    the original order, so the generated graphs are identical to the serial execution.
+
+    :param workers: number of threads, 1 switches the concurrent execution off
+    """
+    global GROUNDING_WORKERS, _executor
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+    GROUNDING_WORKERS = max(workers, 1)
+
+
+def set_async_grounder(grounder):
+    """
+    Ground the candidate graphs in generate_with_model concurrently from an event loop, None switches it off.
+
+    :param grounder: an async_queries.AsyncGrounder or None
+    """
+    global _async_grounder
+    if _async_grounder is not None:
+        _async_grounder.close()
+    _async_grounder = grounder
+
+
+def _map_grounding(f, items):
+    global _executor
+    if GROUNDING_WORKERS < 2 or len(items) < 2:
+        return [f(item) for item in items]
+    if _executor is None:
+        _executor = futures.ThreadPoolExecutor(max_workers=GROUNDING_WORKERS)
+    return list(_executor.map(f, items))
+
+
 def ground_one_with_gold(s_g, gold_answers, min_fscore):
     grounded_graphs = [apply_grounding(s_g, p) for p in graph_queries.get_graph_groundings(s_g)]
     logger.debug("Number of possible groundings: {}".format(len(grounded_graphs)))
@@ -77,9 +155,15 @@ def ground_one_with_gold(s_g, gold_answers, min_fscore):
     i = 0
     chosen_graphs, not_chosen_graphs = [], []
     last_f1 = 0.0
+    denotations = []
     while i < len(grounded_graphs) and last_f1 < MIN_F_SCORE_TO_STOP:
         s_g = grounded_graphs[i]
-        s_g.denotations = graph_queries.get_graph_denotations(s_g)
+        if i >= len(denotations):
+            # Denotations are retrieved ahead in windows of GROUNDING_WORKERS graphs,
+            # the ones after the stopping point are discarded
+            denotations += _map_grounding(graph_queries.get_graph_denotations,
+                                          grounded_graphs[len(denotations):len(denotations) + GROUNDING_WORKERS])
+        s_g.denotations = denotations[i]
         i += 1
         retrieved_answers = s_g.denotations
 
@@ -125,7 +209,8 @@ def apply_grounding(g: SemanticGraph, grounding) -> SemanticGraph:
     return grounded
 
 
-def ground_with_model(input_graphs, s, qa_model, min_score, beam_size=10, verify_with_wikidata=True):
+def ground_with_model(input_graphs, s, qa_model, min_score, beam_size=10, verify_with_wikidata=True,
+                      question_vector=None):
     """
 
     :param input_graphs: a list of equivalent graph extensions to choose from.
@@ -133,13 +218,20 @@ def ground_with_model(input_graphs, s, qa_model, min_score, beam_size=10, verify
     :param qa_model: a model to evaluate graphs
     :param min_score: filter out graphs that receive a score lower than that from the model.
     :param beam_size: size of the beam
+    :param question_vector: the question encoded with encode_question_with_model, computed if not given
     :return: a list of selected graphs with size = beam_size
     """
 
     logger.debug("Input graphs: {}".format(len(input_graphs)))
     logger.debug("First input one: {}".format(input_graphs[:1]))
 
-    grounded_graphs = [apply_grounding(s_g, p) for s_g in input_graphs for p in graph_queries.get_graph_groundings(s_g, use_wikidata=verify_with_wikidata)]
+    if _async_grounder is not None and verify_with_wikidata:
+        groundings = _async_grounder.ground_graphs(input_graphs)
+    else:
+        groundings = _map_grounding(lambda s_g: graph_queries.get_graph_groundings(s_g, use_wikidata=verify_with_wikidata),
+                                    input_graphs)
+    grounded_graphs = [apply_grounding(s_g, p) for s_g, s_g_groundings in zip(input_graphs, groundings)
+                       for p in s_g_groundings]
     grounded_graphs = filter_second_hops(grounded_graphs)
     logger.debug("Number of possible groundings: {}".format(len(grounded_graphs)))
     if len(grounded_graphs) == 0:
@@ -153,8 +245,18 @@ def ground_with_model(input_graphs, s, qa_model, min_score, beam_size=10, verify
         sentences.append(dummy_sentence)
     if len(sentences) == 0:
         return []
-    samples = V.encode_for_model(sentences, qa_model._model.__class__.__name__)
-    model_scores = qa_model.predict_batchwise(*samples).view(-1).data
+    model_type = traced.get_model_type(qa_model)
+    if hasattr(qa_model._model, "score_graphs"):
+        if question_vector is None:
+            question_vector = encode_question_with_model(s, qa_model)
+        with torch.no_grad():
+            model_scores = torch.cat([qa_model._model.score_graphs(
+                question_vector, *[_to_model_input(m[0], qa_model._model)
+                                   for m in V.encode_graphs_for_model([dummy_sentence], model_type)])
+                for dummy_sentence in sentences]).data
+    else:
+        samples = V.encode_for_model(sentences, model_type)
+        model_scores = qa_model.predict_batchwise(*samples).view(-1).data
 
     logger.debug("model_scores: {}".format(model_scores))
     all_chosen_graphs = [WithScore(grounded_graphs[i], (0.0, 0.0, model_scores[i]))
@@ -167,6 +269,27 @@ def ground_with_model(input_graphs, s, qa_model, min_score, beam_size=10, verify
     return all_chosen_graphs
 
 
+def encode_question_with_model(s, qa_model):
+    """
+    Encode the question with the model, so that the question vector can be reused to score all candidate graphs.
+
+    :param s: sentence
+    :param qa_model: a model container or a TracedModelContainer, the model should implement encode_question
+    :return: the question vector
+    """
+    qa_model._model.eval()
+    questions_m = V.encode_questions_for_model([s], traced.get_model_type(qa_model))
+    with torch.no_grad():
+        return qa_model._model.encode_question(_to_model_input(questions_m, qa_model._model))[0]
+
+
+def _to_model_input(m, model):
+    m = torch.from_numpy(np.ascontiguousarray(m))
+    if next(model.parameters()).is_cuda:
+        m = m.cuda()
+    return m
+
+
 def filter_second_hops(grounded_graphs: List[SemanticGraph]):
     """
     This methods filters out second hop relations that are already present as first hop relations. Relation direction is
@@ -186,6 +309,25 @@ def filter_second_hops(grounded_graphs: List[SemanticGraph]):
     return grounded_graphs
 
 
+def deduplicate_graphs(graphs: List[SemanticGraph]):
+    """
+    Remove graphs that are structurally identical to a previous graph in the list, see SemanticGraph.fingerprint.
+
+    :param graphs: list of graphs
+    :return: list of graphs with the first occurrence of each structure kept
+    >>> deduplicate_graphs([SemanticGraph([Edge(leftentityid="?m0Q76", rightentityid="Q76")]), SemanticGraph([Edge(leftentityid="?m1Q76", rightentityid="Q76")])])
+    [SemanticGraph([Edge(0, ?m0Q76-None->Q76)], 0)]
+    """
+    seen = set()
+    unique_graphs = []
+    for g in graphs:
+        fingerprint = g.fingerprint()
+        if fingerprint not in seen:
+            seen.add(fingerprint)
+            unique_graphs.append(g)
+    return unique_graphs
+
+
 def generate_with_model(s, qa_model, beam_size=10):
     pool = [WithScore(s.graphs[0].graph, (0.0, 0.0, 0.0))]  # pool of possible parses
     generated_graphs = []
@@ -200,6 +342,8 @@ def generate_with_model(s, qa_model, beam_size=10):
         stages.add_relation
     ]
 
+    # The question is encoded once and reused for every beam step
+    question_vector = encode_question_with_model(s, qa_model) if hasattr(qa_model._model, "score_graphs") else None
     while pool and iterations < 100:
         iterations += 1
         g = pool.pop(0)
@@ -208,13 +352,16 @@ def generate_with_model(s, qa_model, beam_size=10):
         a_i = 0
         chosen_graphs = []
         while a_i < len(actions) and not chosen_graphs:
-            suggested_graphs = actions[a_i](g[0])
+            suggested_graphs = deduplicate_graphs(actions[a_i](g[0]))
             suggested_graphs = [s_g for s_g in suggested_graphs if sum(1 for e in s_g.edges
                                 if any(n.startswith("Q") for n in e.nodes() if n) and graph_queries.QUESTION_VAR not in e.nodes()) < 2]
-            suggested_graphs = [s_g for s_g in suggested_graphs if graph_queries.verify_grounding(s_g)]
+            suggested_graphs = [s_g for s_g, verified in zip(suggested_graphs,
+                                                             graph_queries.verify_groundings(suggested_graphs))
+                                if verified]
             logger.debug("Suggested graphs:{}, {}".format(len(suggested_graphs), suggested_graphs))
             chosen_graphs += ground_with_model(suggested_graphs, s, qa_model, min_score=master_score,
-                                               beam_size=beam_size, verify_with_wikidata=True)
+                                               beam_size=beam_size, verify_with_wikidata=True,
+                                               question_vector=question_vector)
             a_i += 1
 
         logger.debug("Chosen graphs length: {}".format(len(chosen_graphs)))
@@ -6,6 +6,99 @@ from questionanswering.models import modules
 from questionanswering.models.modules import batchmv_cosine_similarity
 
 
+def dense_aggregation(current_state, edges_m, A_nodes, A_edges):
+    """
+    Sum the states of the adjacent nodes and the adjacent edges for each node. The adjacency lists are expanded
+    to the size of the hidden state and the states are gathered with them.
+
+    :param current_state: node states of shape (graphs, nodes, hidden)
+    :param edges_m: edge states of shape (graphs, edges, hidden)
+    :param A_nodes: adjacent nodes of shape (graphs, nodes, edges per node), 0 is padding
+    :param A_edges: adjacent edges of shape (graphs, nodes, edges per node), 0 is padding
+    :return: the sum for each node of shape (graphs, nodes, hidden)
+    """
+    nodes_per_graph = current_state.size(1)
+    edges_per_node = A_edges.size(-1)
+
+    A_nodes = A_nodes.unsqueeze(-1).expand(-1, -1, -1, current_state.size(-1))
+    A_edges = A_edges.unsqueeze(-1).expand(-1, -1, -1, edges_m.size(-1))
+
+    nodes = torch.gather(current_state.unsqueeze(2).expand(-1, -1, edges_per_node, -1),
+                         dim=1,
+                         index=A_nodes)
+
+    edges = torch.gather(edges_m.unsqueeze(1).expand(-1, nodes_per_graph, -1, -1),
+                         dim=2,
+                         index=A_edges)
+    nodes_mask = (A_nodes != 0).float()
+    edges_mask = (A_edges != 0).float()
+
+    return (nodes*nodes_mask + edges*edges_mask).sum(2)
+
+
+def sparse_adjacency(A_nodes, A_edges, edges_per_graph):
+    """
+    Convert the adjacency lists into flat edge lists over all graphs in the batch. The node and the edge ids
+    are offset by the position of the graph, so that they index the flattened state tensors.
+
+    :param A_nodes: adjacent nodes of shape (graphs, nodes, edges per node), 0 is padding
+    :param A_edges: adjacent edges of shape (graphs, nodes, edges per node), 0 is padding
+    :param edges_per_graph: the number of edge states per graph
+    :return: (receiving nodes, adjacent nodes, receiving nodes, adjacent edges) as flat index tensors
+    >>> sparse_adjacency(torch.LongTensor([[[0], [2], [1]], [[0], [2], [0]]]), torch.LongTensor([[[0], [1], [3]], [[0], [1], [0]]]), 4)
+    (tensor([1, 2, 4]), tensor([2, 1, 5]), tensor([1, 2, 4]), tensor([1, 3, 5]))
+    """
+    nodes_per_graph = A_nodes.size(1)
+    entries = A_nodes.nonzero()
+    node_targets = entries[:, 0] * nodes_per_graph + entries[:, 1]
+    node_sources = entries[:, 0] * nodes_per_graph + A_nodes[A_nodes != 0]
+    entries = A_edges.nonzero()
+    edge_targets = entries[:, 0] * nodes_per_graph + entries[:, 1]
+    edge_sources = entries[:, 0] * edges_per_graph + A_edges[A_edges != 0]
+    return node_targets, node_sources, edge_targets, edge_sources
+
+
+def sparse_aggregation(current_state, edges_m, node_targets, node_sources, edge_targets, edge_sources):
+    """
+    Sum the states of the adjacent nodes and the adjacent edges for each node with a scatter-sum over
+    the flat edge lists produced by sparse_adjacency. Gives the same result as dense_aggregation.
+
+    :param current_state: node states of shape (graphs, nodes, hidden)
+    :param edges_m: edge states of shape (graphs, edges, hidden)
+    :return: the sum for each node of shape (graphs, nodes, hidden)
+    """
+    state = current_state.contiguous().view(-1, current_state.size(-1))
+    edges = edges_m.contiguous().view(-1, edges_m.size(-1))
+    activation = torch.zeros_like(state)
+    activation.index_add_(0, node_targets, state.index_select(0, node_sources))
+    activation.index_add_(0, edge_targets, edges.index_select(0, edge_sources))
+    return activation.view_as(current_state)
+
+
+def trim_padding_rows(nodes_m, edges_m, A_nodes, A_edges):
+    """
+    Remove the node and edge rows at the end that are padding in all graphs of the batch. The graph vector is read
+    from the question variable node, so the padding rows don't change it. The incoming edges are referred to
+    in A_edges after all outgoing edges and their ids are shifted by the number of removed rows.
+
+    :param nodes_m: node labels of shape (questions, graphs, rows, tokens)
+    :param edges_m: edge labels of shape (questions, graphs, rows, tokens)
+    :param A_nodes: adjacent nodes of shape (questions, graphs, rows, edges per node)
+    :param A_edges: adjacent edges of shape (questions, graphs, rows, edges per node)
+    :return: the same tensors without the padding rows
+    """
+    rows = nodes_m.size(-2)
+    used_rows = max(2,  # The second row is the question variable
+                    modules.used_size(nodes_m, -2), modules.used_size(edges_m, -2),
+                    modules.used_size(A_nodes, -2), modules.used_size(A_edges, -2),
+                    int(A_nodes.max()) + 1, int((A_edges.long() % rows).max()) + 1)
+    if used_rows >= rows:
+        return nodes_m, edges_m, A_nodes, A_edges
+    A_edges = A_edges.long()
+    A_edges = torch.where(A_edges >= rows, A_edges - rows + used_rows, A_edges)
+    return tuple(m[..., :used_rows, :].contiguous() for m in (nodes_m, edges_m, A_nodes, A_edges))
+
+
 class PropagationModel(nn.Module):
 
     def __init__(self,
@@ -17,24 +110,10 @@ class PropagationModel(nn.Module):
                                            )
 
     def forward(self, current_state, edges_m, A_nodes, A_edges):
-        nodes_per_graph = current_state.size(1)
-        edges_per_node = A_edges.size(-1)
-
-        A_nodes = A_nodes.unsqueeze(-1).expand(-1, -1, -1, current_state.size(-1))
-        A_edges = A_edges.unsqueeze(-1).expand(-1, -1, -1, edges_m.size(-1))
-
-        nodes = torch.gather(current_state.unsqueeze(2).expand(-1, -1, edges_per_node, -1),
-                             dim=1,
-                             index=A_nodes)
-
-        edges = torch.gather(edges_m.unsqueeze(1).expand(-1, nodes_per_graph, -1, -1),
-                             dim=2,
-                             index=A_edges)
-        nodes_mask = (A_nodes != 0).float()
-        edges_mask = (A_edges != 0).float()
+        return self.update_state(current_state, dense_aggregation(current_state, edges_m, A_nodes, A_edges))
 
-        new_state = (nodes*nodes_mask + edges*edges_mask).sum(2)
-        new_state = self._update_layer(torch.cat((new_state, current_state), dim=-1))
+    def update_state(self, current_state, activation):
+        new_state = self._update_layer(torch.cat((activation, current_state), dim=-1))
         return new_state
 
 
@@ -62,23 +141,9 @@ class GatedPropagationModel(nn.Module):
         # self._dropout = nn.Dropout(p=hp_dropout)
 
     def forward(self, current_state, edges_m, A_nodes, A_edges):
-        nodes_per_graph = current_state.size(1)
-        edges_per_node = A_edges.size(-1)
+        return self.update_state(current_state, dense_aggregation(current_state, edges_m, A_nodes, A_edges))
 
-        A_nodes = A_nodes.unsqueeze(-1).expand(-1, -1, -1, current_state.size(-1))
-        A_edges = A_edges.unsqueeze(-1).expand(-1, -1, -1, edges_m.size(-1))
-
-        nodes = torch.gather(current_state.unsqueeze(2).expand(-1, -1, edges_per_node, -1),
-                             dim=1,
-                             index=A_nodes)
-
-        edges = torch.gather(edges_m.unsqueeze(1).expand(-1, nodes_per_graph, -1, -1),
-                             dim=2,
-                             index=A_edges)
-        nodes_mask = (A_nodes != 0).float()
-        edges_mask = (A_edges != 0).float()
-
-        activation = (nodes*nodes_mask + edges*edges_mask).sum(2)
+    def update_state(self, current_state, activation):
         activation_current_state = torch.cat((activation, current_state), dim=-1)
         update_gate = self._update_layer(activation_current_state)
         reset_gate = self._reset_layer(activation_current_state)
@@ -94,12 +159,14 @@ class GNN(nn.Module):
                  hp_in_features,
                  hp_out_features,
                  hp_dropout=0.1,
-                 hp_gated=True):
+                 hp_gated=True,
+                 hp_propagation="dense"):
         super(GNN, self).__init__()
         self.hp_in_features = hp_in_features
         self.hp_out_features = hp_out_features
         self.hp_dropout = hp_dropout
         self.hp_gated = hp_gated
+        self.hp_propagation = hp_propagation  # 'dense' or 'sparse', both give the same result
         self._steps = 5
 
         self._prop_model: nn.Module = GatedPropagationModel(hp_out_features)
@@ -141,8 +208,15 @@ class GNN(nn.Module):
         current_state = self._dropout(current_state)
         edges_m = self._dropout(edges_m)
 
-        for i in range(self._steps):
-            current_state = self._prop_model(current_state, edges_m, A_nodes, A_edges)
+        # Models saved before the propagation choice was added use the dense propagation
+        if getattr(self, "hp_propagation", "dense") == "sparse":
+            adjacency = sparse_adjacency(A_nodes, A_edges, edges_m.size(1))
+            for i in range(self._steps):
+                current_state = self._prop_model.update_state(current_state,
+                                                              sparse_aggregation(current_state, edges_m, *adjacency))
+        else:
+            for i in range(self._steps):
+                current_state = self._prop_model(current_state, edges_m, A_nodes, A_edges)
 
         graph_vector = current_state[:, 1].contiguous()
         graph_vector = self._dropout(graph_vector)
@@ -164,7 +238,8 @@ class GNNModel(nn.Module):
         self._gnn: nn.Module = GNN(self._tokens_encoder._word_embedding.embedding_dim,
                                    tokens_encoder.output_vector_size,
                                    hp_dropout=kwargs.get("hp_dropout", 0.1),
-                                   hp_gated=kwargs.get("hp_gated", True)
+                                   hp_gated=kwargs.get("hp_gated", True),
+                                   hp_propagation=kwargs.get("hp_propagation", "dense")
                                    )
         # self._pool = nn.AdaptiveMaxPool1d(1)
 
@@ -178,9 +253,33 @@ class GNNModel(nn.Module):
                                              )
 
     def forward(self, questions_m, nodes_m, edges_m, A_nodes, A_edges):
+        return self._score(self.encode_question(questions_m), nodes_m, edges_m, A_nodes, A_edges)
 
+    def encode_question(self, questions_m):
         questions_m = self._tokens_encoder(questions_m)
-
+        return self._question_layer(questions_m)
+
+    def score_graphs(self, question_vector, nodes_m, edges_m, A_nodes, A_edges):
+        """
+        Score any number of graphs for a single question with a precomputed question vector.
+
+        :param question_vector: the output of encode_question for one question
+        :param nodes_m: node labels of the graphs of one question
+        :param edges_m: edge labels of the graphs
+        :param A_nodes: adjacent nodes in the graphs
+        :param A_edges: adjacent edges in the graphs
+        :return: a score for each graph
+        """
+        return self._score(question_vector.unsqueeze(0),
+                           nodes_m.unsqueeze(0), edges_m.unsqueeze(0), A_nodes.unsqueeze(0), A_edges.unsqueeze(0)
+                           ).squeeze(0)
+
+    def _score(self, questions_m, nodes_m, edges_m, A_nodes, A_edges):
+        return modules.score_without_padding(self._score_batch, questions_m, nodes_m, edges_m, A_nodes, A_edges)
+
+    def _score_batch(self, questions_m, nodes_m, edges_m, A_nodes, A_edges):
+        if modules.TRIM_PADDING:
+            nodes_m, edges_m, A_nodes, A_edges = trim_padding_rows(nodes_m, edges_m, A_nodes, A_edges)
         graphs_per_sample = edges_m.size(1)
         edges_per_graph = edges_m.size(2)
         predictions_mask = (nodes_m.sum(-1).sum(-1) != 0).float()
@@ -209,7 +308,6 @@ class GNNModel(nn.Module):
         graph_vectors1 = self._gnn(nodes_m, edges_m, A_nodes, A_edges)
         graph_vectors1 = graph_vectors1.view(-1, graphs_per_sample, graph_vectors1.size(-1))
 
-        questions_m = self._question_layer(questions_m)
         graph_vectors1 = self._graph_layer(graph_vectors1)
         predictions = batchmv_cosine_similarity(graph_vectors1, questions_m) * predictions_mask
 
@@ -17,9 +17,25 @@ class OneEdgeModel(nn.Module):
         self._tokens_encoder: nn.Module = tokens_encoder
 
     def forward(self, questions_m, graphs_m):
+        return self._score(self.encode_question(questions_m), graphs_m)
 
-        question_vector1 = self._tokens_encoder(questions_m)
+    def encode_question(self, questions_m):
+        return self._tokens_encoder(questions_m)
 
+    def score_graphs(self, question_vector, graphs_m):
+        """
+        Score any number of graphs for a single question with a precomputed question vector.
+
+        :param question_vector: the output of encode_question for one question
+        :param graphs_m: encoded graphs of one question
+        :return: a score for each graph
+        """
+        return self._score(question_vector.unsqueeze(0), graphs_m.unsqueeze(0)).squeeze(0)
+
+    def _score(self, question_vector1, graphs_m):
+        return modules.score_without_padding(self._score_batch, question_vector1, graphs_m)
+
+    def _score_batch(self, question_vector1, graphs_m):
         edge_vectors1 = self._tokens_encoder(graphs_m.view(-1, graphs_m.size(-1)))
         edge_vectors1 = edge_vectors1.view(-1, graphs_m.size(1), edge_vectors1.size(-1))
 
@@ -45,10 +61,31 @@ class STAGGModel(nn.Module):
                                             )
 
     def forward(self, questions_m, graphs_m, graphs_features_m):
-        graphs_features_m = graphs_features_m.float()
+        return self._score(self.encode_question(questions_m), graphs_m, graphs_features_m)
 
+    def encode_question(self, questions_m):
         question_vector1 = self._tokens_encoder(questions_m[..., 0, :])
         question_vector2 = self._tokens_encoder(questions_m[..., 1, :])
+        return torch.stack((question_vector1, question_vector2), dim=-2)
+
+    def score_graphs(self, question_vector, graphs_m, graphs_features_m):
+        """
+        Score any number of graphs for a single question with a precomputed question vector.
+
+        :param question_vector: the output of encode_question for one question
+        :param graphs_m: encoded graphs of one question
+        :param graphs_features_m: structural features of the graphs
+        :return: a score for each graph
+        """
+        return self._score(question_vector.unsqueeze(0), graphs_m.unsqueeze(0), graphs_features_m.unsqueeze(0)).squeeze(0)
+
+    def _score(self, question_vectors, graphs_m, graphs_features_m):
+        return modules.score_without_padding(self._score_batch, question_vectors, graphs_m, graphs_features_m)
+
+    def _score_batch(self, question_vectors, graphs_m, graphs_features_m):
+        graphs_features_m = graphs_features_m.float()
+        question_vector1 = question_vectors[..., 0, :]
+        question_vector2 = question_vectors[..., 1, :]
 
         edge_vectors1 = self._tokens_encoder(graphs_m[..., 0, :]
                                              .contiguous()
@@ -82,8 +119,29 @@ class PooledEdgesModel(nn.Module):
         self._pool = self._tokens_encoder._pool
 
     def forward(self, questions_m, graphs_m, *args):
-        question_vector = self._tokens_encoder(questions_m)
-        edge_vectors = graphs_m.view(-1, graphs_m.size(-1))
+        return self._score(self.encode_question(questions_m), graphs_m)
+
+    def encode_question(self, questions_m):
+        return self._tokens_encoder(questions_m)
+
+    def score_graphs(self, question_vector, graphs_m, *args):
+        """
+        Score any number of graphs for a single question with a precomputed question vector.
+
+        :param question_vector: the output of encode_question for one question
+        :param graphs_m: encoded graphs of one question
+        :return: a score for each graph
+        """
+        return self._score(question_vector.unsqueeze(0), graphs_m.unsqueeze(0)).squeeze(0)
+
+    def _score(self, question_vector, graphs_m):
+        return modules.score_without_padding(self._score_batch, question_vector, graphs_m)
+
+    def _score_batch(self, question_vector, graphs_m):
+        if modules.TRIM_PADDING and isinstance(self._pool, nn.AdaptiveMaxPool1d):
+            # One padding edge is kept, the max pooling over the edges then gives the same result
+            graphs_m = graphs_m[:, :, :modules.used_size(graphs_m, 2) + 1]
+        edge_vectors = graphs_m.contiguous().view(-1, graphs_m.size(-1))
 
         edge_vectors = self._tokens_encoder(edge_vectors)
         edge_vectors = edge_vectors.view(-1, graphs_m.size(-2), edge_vectors.size(-1))\
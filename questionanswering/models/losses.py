@@ -1,35 +1,36 @@
 import torch
 from torch import nn as nn
-from torch.nn import functional as F
-from torch.autograd import Variable
 
 DEFAULT_MARGIN = 0.5
 MIN_TARGET_VALUE = 0.25
+MAX_TARGET_POSITIONS = 10
 
 
 class VariableMarginLoss(nn.Module):
 
     def forward(self, predictions, target):
-        loss = Variable(torch.zeros(1))
-        target_index_var = Variable(torch.LongTensor([0]))
-        if torch.cuda.is_available():
-            loss = loss.cuda()
-            target_index_var = target_index_var.cuda()
-
+        """
+        A multi-class margin loss that is summed over the best targets of each sample: every target above
+        MIN_TARGET_VALUE, at most MAX_TARGET_POSITIONS of them, should score higher than all lower ranked graphs
+        by a margin proportional to the target value. Computed for all samples and target positions at once.
+
+        :param predictions: model scores of shape (samples, graphs)
+        :param target: target values of shape (samples, graphs)
+        :return: the summed loss of shape (1,)
+        """
         target_sorted, target_indices = torch.sort(target, dim=-1, descending=True)
         predictions = predictions.gather(1, target_indices)
-        margins = DEFAULT_MARGIN * target_sorted.data
-        # margins = margins.clamp(max=1.0, min=0.5)
-        for sample_index in range(target_indices.size(0)):
-            target_index = 0
-
-            while target_index < min(target_indices.size(1), 10) and \
-                    (target_sorted[sample_index, target_index].data[0] > MIN_TARGET_VALUE):
-                loss += F.multi_margin_loss(predictions[sample_index, target_index:],
-                                            target_index_var,
-                                            margin=margins[sample_index, target_index],
-                                            size_average=False)
-                target_index += 1
-        return loss
-
-
+        num_positions = min(predictions.size(1), MAX_TARGET_POSITIONS)
+        target_sorted = target_sorted[:, :num_positions].type_as(predictions)
+        margins = DEFAULT_MARGIN * target_sorted.detach()
+
+        # Hinge loss of each target position against each graph: (samples, positions, graphs)
+        hinge = (margins - predictions[:, :num_positions]).unsqueeze(2) + predictions.unsqueeze(1)
+        hinge = hinge.clamp(min=0)
+        # Only the graphs ranked lower than the target position are compared with it, the loss is normalized
+        # by the number of compared graphs including the target, as in F.multi_margin_loss
+        lower_mask = torch.ones(num_positions, predictions.size(1)).triu(diagonal=1).type_as(predictions)
+        normalizer = lower_mask.sum(-1) + 1
+        position_loss = (hinge * lower_mask).sum(-1) / normalizer
+        position_mask = (target_sorted > MIN_TARGET_VALUE).type_as(predictions)
+        return (position_loss * position_mask).sum().view(1)
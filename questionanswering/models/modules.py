@@ -4,6 +4,9 @@ from torch import nn as nn
 
 from questionanswering.models import pooling as P
 
+# The padding graphs and edges at the end of a batch are skipped by the models, the scores stay the same
+TRIM_PADDING = True
+
 
 class ConvWordsEncoder(nn.Module):
 
@@ -83,10 +86,23 @@ class ConvWordsEncoder(nn.Module):
                                                  )
 
     def load_word_embeddings_from_numpy(self, word_embeddings: np.ndarray):
+        if not word_embeddings.flags.writeable:  # Memory-mapped embeddings
+            word_embeddings = np.array(word_embeddings)
         word_embeddings = torch.from_numpy(word_embeddings).float()
         self._word_embedding.weight = nn.Parameter(word_embeddings)
         self._word_embedding.weight.requires_grad = False
 
+    def prune_word_embeddings(self, kept_indices):
+        """
+        Keep only the given rows of the word embeddings, the new index of a word is its position in kept_indices.
+
+        :param kept_indices: a list of the word indices to keep
+        """
+        word_embeddings = self._word_embedding.weight.data[torch.LongTensor(kept_indices)].cpu().numpy()
+        self._word_embedding = nn.Embedding(len(kept_indices), word_embeddings.shape[1], padding_idx=0)
+        self.load_word_embeddings_from_numpy(word_embeddings)
+        self.hp_vocab_size = len(kept_indices)
+
     def forward(self, words_m):
         words_m = words_m.long()
         words_mask = (words_m != 0).float().unsqueeze(-1).expand(-1, -1, self.hp_conv_size).transpose(-2, -1)
@@ -117,8 +133,46 @@ def batchmv_cosine_similarity(m, v):
     :param v: a 2D tensor that contains a batch of vectors
     :return: a 2D tensor with similarity values per vector * matrix row
     """
-    predictions = torch.bmm(m, v.unsqueeze(2)).squeeze()
+    predictions = torch.bmm(m, v.unsqueeze(2)).squeeze(-1)
     w1 = torch.norm(m, 2, dim=-1)
     w2 = torch.norm(v, 2, dim=-1, keepdim=True)
     predictions = (predictions / (w1 * w2.expand_as(w1)).clamp(min=10e-8))
-    return predictions
\ No newline at end of file
+    return predictions
+
+def used_size(m, dim):
+    """
+    The size of the tensor along the dimension without the trailing slices that are all zero.
+
+    :param m: a tensor
+    :param dim: the dimension
+    :return: the position of the last non-zero slice + 1, 0 if the tensor is all zero
+    >>> used_size(torch.LongTensor([[1, 0, 2, 0, 0], [0, 1, 0, 0, 0]]), 1)
+    3
+    >>> used_size(torch.zeros(2, 3), 0)
+    0
+    """
+    nonzero = m.transpose(0, dim).contiguous().view(m.size(dim), -1).ne(0).any(1).nonzero()
+    return int(nonzero[-1]) + 1 if len(nonzero) > 0 else 0
+
+
+def score_without_padding(score, question_vectors, *graphs_m):
+    """
+    Score the graphs up to the last non-empty graph in the batch and fill in the score of an empty graph for
+    the rest. The graphs are scored independently of each other, so the result is the same as scoring the full batch,
+    but the padding that is added for the questions with the most graphs is computed only once.
+
+    :param score: a function that takes the question vectors and the graph tensors and returns (questions, graphs)
+    :param question_vectors: encoded questions
+    :param graphs_m: graph tensors of shape (questions, graphs, ...)
+    :return: scores of shape (questions, graphs)
+    """
+    if not TRIM_PADDING:
+        return score(question_vectors, *graphs_m)
+    graphs_per_sample = graphs_m[0].size(1)
+    used_graphs = max(max(used_size(m, 1) for m in graphs_m), 1)
+    if used_graphs == graphs_per_sample:
+        return score(question_vectors, *graphs_m)
+    predictions = score(question_vectors, *[m[:, :used_graphs].contiguous() for m in graphs_m])
+    padding_predictions = score(question_vectors, *[torch.zeros_like(m[:, :1]) for m in graphs_m])
+    return torch.cat((predictions.view(-1, used_graphs),
+                      padding_predictions.view(-1, 1).expand(-1, graphs_per_sample - used_graphs)), dim=-1)
@@ -0,0 +1,40 @@
+import torch
+
+SLIM_MODEL_EXTENSION = ".slim.pkl"
+
+
+def prune_model(model, kept_indices):
+    """
+    Restrict the word embeddings of a model to the given rows, see vectorization.prune_vocabulary.
+
+    :param model: one of the models, e.g. GNNModel
+    :param kept_indices: a list of the word indices to keep
+    :return: the same model with a smaller embedding matrix
+    """
+    model._tokens_encoder.prune_word_embeddings(kept_indices)
+    return model
+
+
+def save_slim_model(model, path_to_model):
+    """
+    Save a model with pruned word embeddings. The model is stored as a whole pickled module and not as a state
+    dictionary, since the vocabulary size and the other hyper-parameters can't be derived from the model type.
+
+    :param model: a model returned by prune_model
+    :param path_to_model: location of the model file, should end with SLIM_MODEL_EXTENSION
+    """
+    torch.save(model, path_to_model)
+
+
+def is_slim_model(path_to_model):
+    return path_to_model.endswith(SLIM_MODEL_EXTENSION)
+
+
+def load_slim_model(path_to_model):
+    """
+    Load a model saved with save_slim_model to the CPU.
+
+    :param path_to_model: location of the model file
+    :return: the model as a torch module
+    """
+    return torch.load(path_to_model, map_location=lambda storage, location: storage, weights_only=False)
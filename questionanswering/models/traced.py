@@ -0,0 +1,114 @@
+import json
+import logging
+
+import numpy as np
+import torch
+
+from questionanswering.models import modules
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.ERROR)
+
+METADATA_FILE = "metadata.json"
+DEFAULT_BATCH_SIZE = 128
+
+
+def trace_model(model, questions_m, *graphs_m):
+    """
+    Trace the forward, encode_question and score_graphs methods of a model with example inputs. The models skip
+    the padding depending on the input values, this is switched off while tracing and the traced model always
+    computes the full input.
+
+    :param model: one of the models, e.g. GNNModel
+    :param questions_m: encoded questions as a tensor
+    :param graphs_m: encoded graphs as tensors, in the format of vectorization.encode_graphs_for_model
+    :return: a traced torch.jit.ScriptModule
+    """
+    model.eval()
+    trim_padding = modules.TRIM_PADDING
+    modules.TRIM_PADDING = False
+    try:
+        with torch.no_grad():
+            question_vector = model.encode_question(questions_m)
+            return torch.jit.trace_module(model, {
+                'forward': (questions_m, *graphs_m),
+                'encode_question': (questions_m,),
+                'score_graphs': (question_vector[0], *[m[0] for m in graphs_m]),
+            })
+    finally:
+        modules.TRIM_PADDING = trim_padding
+
+
+def check_parity(model, traced_model, questions_m, *graphs_m):
+    """
+    Compare the scores of the traced model and the eager model on a batch. The batch should not be the one
+    that was used for tracing.
+
+    :param model: the eager model
+    :param traced_model: the model returned by trace_model
+    :param questions_m: encoded questions as a tensor
+    :param graphs_m: encoded graphs as tensors
+    :return: the maximum absolute difference of the scores of forward and of score_graphs
+    """
+    model.eval()
+    with torch.no_grad():
+        max_difference = float((model(questions_m, *graphs_m) - traced_model(questions_m, *graphs_m)).abs().max())
+        question_vectors = model.encode_question(questions_m)
+        traced_question_vectors = traced_model.encode_question(questions_m)
+        max_difference = max(max_difference, float((question_vectors - traced_question_vectors).abs().max()))
+        for i in range(questions_m.size(0)):
+            scores = model.score_graphs(question_vectors[i], *[m[i] for m in graphs_m])
+            traced_scores = traced_model.score_graphs(traced_question_vectors[i], *[m[i] for m in graphs_m])
+            max_difference = max(max_difference, float((scores - traced_scores).abs().max()))
+    return max_difference
+
+
+def save_traced_model(traced_model, path_to_model, model_type, **metadata):
+    """
+    Save the traced model together with the model type and other metadata in one file.
+
+    :param traced_model: the model returned by trace_model
+    :param path_to_model: location of the output file
+    :param model_type: name of the model class
+    :param metadata: additional parameters of the model, e.g. the description
+    """
+    torch.jit.save(traced_model, path_to_model,
+                   _extra_files={METADATA_FILE: json.dumps({'model_type': model_type, **metadata})})
+
+
+class TracedModelContainer:
+    def __init__(self, path_to_model, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        A traced model loaded for the CPU inference. The container has the same interface as fackel.TorchContainer
+        that is used by the beam search in staged_generation: the model is accessible as _model and
+        batches are scored with predict_batchwise.
+
+        :param path_to_model: location of the file written with save_traced_model
+        :param batch_size: the batch size for predict_batchwise
+        """
+        extra_files = {METADATA_FILE: ""}
+        self._model = torch.jit.load(path_to_model, map_location="cpu", _extra_files=extra_files)
+        self._model.eval()
+        self.metadata = json.loads(extra_files[METADATA_FILE])
+        self.model_type = self.metadata['model_type']
+        self.description = self.metadata.get('description', "")
+        self.batch_size = batch_size
+        logger.debug(f"Loaded a traced {self.model_type} from {path_to_model}")
+
+    def predict_batchwise(self, *samples):
+        """
+        :param samples: encoded questions and graphs as numpy arrays
+        :return: the scores of the graphs as a tensor of shape (questions, graphs)
+        """
+        samples = [torch.from_numpy(np.ascontiguousarray(m)) for m in samples]
+        with torch.no_grad():
+            return torch.cat([self._model(*[m[i:i + self.batch_size] for m in samples])
+                              for i in range(0, len(samples[0]), self.batch_size)])
+
+
+def get_model_type(container):
+    """
+    :param container: a fackel.TorchContainer or a TracedModelContainer
+    :return: the name of the model class
+    """
+    return getattr(container, 'model_type', None) or container._model.__class__.__name__
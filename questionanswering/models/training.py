@@ -0,0 +1,179 @@
+import logging
+
+import numpy as np
+import torch
+
+from questionanswering.datasets import batch_producer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.ERROR)
+
+# The parameters of the training section of the config that are used by train
+TRAINING_PARAMETERS = ('batch_size', 'max_epochs', 'early_stopping', 'monitor', 'lr_decay')
+
+
+class EncodedData:
+    def __init__(self, samples, targets, graph_order=None, question_order=None, graph_counts=None,
+                 bucket_size=None):
+        """
+        Encoded questions with their graphs, the batches are gathered on demand. The arrays are kept as they were
+        encoded or loaded from the encoding cache, e.g. memory-mapped, and only the rows of a batch are copied.
+
+        :param samples: a list of numpy arrays as returned by vectorization.encode_for_model
+        :param targets: a numpy array of the targets of shape (questions, graphs)
+        :param graph_order: an array of shape (questions, graphs) with the order of the graphs of each question,
+            the stored order is used if None
+        :param question_order: the stored row of each question, the stored order is used if None
+        :param graph_counts: the number of graphs of each question in the question order, a batch is then padded
+            only to the largest number of graphs in it
+        :param bucket_size: if given, the consecutive chunks of this many questions in the question order are
+            buckets of similar questions and train uses each of them as a batch, see vectorization.get_size_buckets
+        """
+        self.samples = samples
+        self.targets = targets
+        self.graph_order = graph_order if graph_order is not None \
+            else np.tile(np.arange(targets.shape[1]), (len(targets), 1))
+        self.question_order = np.asarray(question_order if question_order is not None else range(len(targets)))
+        self.graph_counts = np.asarray(graph_counts) if graph_counts is not None else None
+        self.bucket_size = bucket_size
+
+    def __len__(self):
+        return len(self.question_order)
+
+    def batch(self, indices):
+        """
+        Gather a batch of questions.
+
+        :param indices: positions of the questions in the question order
+        :return: (a list of numpy arrays with the samples, targets as a numpy array)
+        """
+        rows = self.question_order[indices]
+        graph_order = self.graph_order[rows]
+        if self.graph_counts is not None:
+            graph_order = graph_order[:, :max(int(self.graph_counts[indices].max()), 1)]
+        graph_index = (rows[:, None], graph_order)
+        samples = [self.samples[0][rows], *[m[graph_index] for m in self.samples[1:]]]
+        return samples, self.targets[graph_index]
+
+    def arrays(self):
+        """
+        Gather all questions in the question order at once, e.g. for a trainer that takes the whole data set.
+
+        :return: (a list of numpy arrays with the samples, targets as a numpy array)
+        """
+        return self.batch(np.arange(len(self)))
+
+
+def train(model, criterion, optimizer, metrics, training_data, dev_data=None, save_model=None,
+          batch_size=128, max_epochs=50, early_stopping=5, monitor="acc", lr_decay=None,
+          num_workers=0, max_queued_batches=batch_producer.DEFAULT_MAX_QUEUED_BATCHES, logger=logger):
+    """
+    Train the model on batches gathered from EncodedData. After each epoch the model is evaluated on the dev data,
+    or on the training data if there is no dev data, and the monitored metric decides on the checkpoints and
+    on stopping. The batches are gathered in background processes with batch_producer if num_workers is set,
+    the model is not used by the workers. If the training data has buckets, the order of the buckets is shuffled
+    in each epoch and each bucket is a batch, otherwise the questions are shuffled.
+
+    :param model: the model to train
+    :param criterion: the loss, called with the model scores and the targets of a batch
+    :param optimizer: a torch optimizer for the model parameters
+    :param metrics: a function of the targets and the scores that returns a dictionary of metrics, the dev metrics
+        are computed with validation=True
+    :param training_data: an EncodedData object
+    :param dev_data: an optional EncodedData object
+    :param save_model: a function that is called when the monitored metric improves, e.g. to save a checkpoint
+    :param batch_size: the number of questions in a batch, the bucket size is used instead if there are buckets
+    :param max_epochs: the maximum number of epochs
+    :param early_stopping: stop after this many epochs without an improvement, never stop early if 0
+    :param monitor: the metric to monitor, higher is better
+    :param lr_decay: halve the learning rate after this many epochs without an improvement, no decay if 0 or None
+    :param num_workers: number of processes that gather the batches, the batches are gathered in the training
+        process if 0
+    :param max_queued_batches: maximum number of batches that are gathered in advance
+    :param logger: the logger for the training progress
+    :return: a list with the loss and the metrics of each epoch
+    """
+    log_history = []
+    best_value, epochs_without_improvement = None, 0
+    for epoch in range(max_epochs):
+        model.train()
+        epoch_losses = []
+        batches = batch_producer.produce_batches(training_data.batch, get_epoch_batches(training_data, batch_size),
+                                                 seed=np.random.randint(2 ** 31), num_workers=num_workers,
+                                                 max_queued_batches=max_queued_batches)
+        for samples, targets in batches:
+            optimizer.zero_grad()
+            loss = criterion(model(*_to_model_input(samples, model)), _to_model_input([targets], model)[0].float())
+            loss.backward()
+            optimizer.step()
+            epoch_losses.append(loss.item())
+
+        predictions, targets = predict(model, dev_data if dev_data is not None else training_data, batch_size)
+        results = metrics(targets, predictions, validation=dev_data is not None)
+        log_history.append({'epoch': epoch, 'loss': float(np.mean(epoch_losses)),
+                            **{k: float(v) for k, v in results.items() if k != 'predictions'}})
+        logger.info(f"Epoch {epoch}: {log_history[-1]}")
+
+        if best_value is None or log_history[-1][monitor] > best_value:
+            best_value, epochs_without_improvement = log_history[-1][monitor], 0
+            if save_model is not None:
+                save_model()
+        else:
+            epochs_without_improvement += 1
+            if lr_decay and epochs_without_improvement % lr_decay == 0:
+                for group in optimizer.param_groups:
+                    group['lr'] /= 2
+                logger.info(f"Learning rate decreased to {optimizer.param_groups[0]['lr']}")
+            if early_stopping and epochs_without_improvement >= early_stopping:
+                logger.info(f"No improvement of {monitor} for {early_stopping} epochs, stopping")
+                break
+    return log_history
+
+
+def get_epoch_batches(data, batch_size):
+    """
+    Split the questions into the batches of an epoch: the buckets of the data in a random order or, without
+    buckets, the shuffled questions.
+
+    :param data: an EncodedData object
+    :param batch_size: the number of questions in a batch if the data has no buckets
+    :return: a list of arrays with the positions of the questions in each batch
+    >>> data = EncodedData([np.zeros((5, 1))], np.zeros((5, 2)), bucket_size=2)
+    >>> sorted(b.tolist() for b in get_epoch_batches(data, 4))
+    [[0, 1], [2, 3], [4]]
+    """
+    if data.bucket_size:
+        batches = [np.arange(i, min(i + data.bucket_size, len(data))) for i in range(0, len(data), data.bucket_size)]
+        return [batches[i] for i in np.random.permutation(len(batches))]
+    order = np.random.permutation(len(data))
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def predict(model, data, batch_size=128):
+    """
+    Score the graphs of all questions in the order of the data. The batches that are padded to fewer graphs
+    are filled up with the score -inf, so that a padding graph is never the top scoring one.
+
+    :param model: the model
+    :param data: an EncodedData object
+    :param batch_size: the number of questions in a batch
+    :return: (the scores as a tensor of shape (questions, graphs), the targets as a tensor of the same shape)
+    """
+    model.eval()
+    num_graphs = data.targets.shape[1]
+    predictions, targets = [], []
+    with torch.no_grad():
+        for i in range(0, len(data), batch_size):
+            samples, batch_targets = data.batch(np.arange(i, min(i + batch_size, len(data))))
+            batch_predictions = model(*_to_model_input(samples, model))
+            predictions.append(torch.nn.functional.pad(batch_predictions, (0, num_graphs - batch_predictions.size(1)),
+                                                       value=float("-inf")))
+            targets.append(np.pad(batch_targets, ((0, 0), (0, num_graphs - batch_targets.shape[1]))))
+    return torch.cat(predictions), _to_model_input([np.concatenate(targets)], model)[0].float()
+
+
+def _to_model_input(arrays, model):
+    tensors = [torch.from_numpy(np.ascontiguousarray(m)) for m in arrays]
+    if next(model.parameters()).is_cuda:
+        tensors = [m.cuda() for m in tensors]
+    return tensors
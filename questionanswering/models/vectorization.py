@@ -1,8 +1,15 @@
+import hashlib
+import itertools
+import json
+import os
+import random
+import shutil
+
 import numpy as np
 
 from typing import List
 
-from collections import defaultdict
+from collections import defaultdict, Counter
 
 from questionanswering import _utils
 from questionanswering.construction.graph import SemanticGraph, Edge
@@ -25,26 +32,64 @@ MAX_NEGATIVE_GRAPHS = 100
 
 WORD_2_IDX = None
 
+# Seed for the embeddings of the special tokens in the binary embeddings
+EMBEDDINGS_SEED = 1
+
+# Token ids of the relation and entity labels are memoized across graphs and beam steps,
+# the memos are reset when a different vocabulary is used
+MEMOIZE_ENCODINGS = True
+MAX_ENCODING_MEMO_SIZE = 100000
+ENCODING_MEMO_STATS = Counter()
+_relation_encoding_memo = {}
+_entity_encoding_memo = {}
+_encoding_memo_vocab = None
+
+# Encoded training data is cached on disk, the version is part of the cache key and
+# should be increased whenever the encoding changes
+ENCODING_CACHE_VERSION = 1
+
 
 def encode_for_model(selected_questions, model_type, word2idx=None):
+    return (encode_questions_for_model(selected_questions, model_type, word2idx),
+            *encode_graphs_for_model(selected_questions, model_type, word2idx))
+
+
+def encode_questions_for_model(selected_questions, model_type, word2idx=None):
+    """
+    Encode only the questions in the format of the model, see encode_for_model.
+
+    :return: a numpy array with the encoded questions
+    """
+    assert word2idx or WORD_2_IDX
+    if not word2idx:
+        word2idx = WORD_2_IDX
+    return {
+        "OneEdgeModel": lambda: encode_batch_questions(selected_questions, word2idx)[..., 0, :],
+        "STAGGModel": lambda: encode_batch_questions(selected_questions, word2idx),
+        "PooledEdgesModel": lambda: encode_batch_questions(selected_questions, word2idx)[..., 1, :],
+        "GNNModel": lambda: encode_batch_questions(selected_questions, word2idx)[..., 1, :]
+    }[model_type]()
+
+
+def encode_graphs_for_model(selected_questions, model_type, word2idx=None):
+    """
+    Encode only the graphs of the questions in the format of the model, see encode_for_model.
+
+    :return: a tuple of numpy arrays with the encoded graphs
+    """
     assert word2idx or WORD_2_IDX
     if not word2idx:
         word2idx = WORD_2_IDX
-    samples = {
-        "OneEdgeModel": lambda: (encode_batch_questions(selected_questions, word2idx)[..., 0, :],
-                                 encode_batch_graphs(selected_questions, word2idx)[..., 0, 0, :]),
-        "STAGGModel": lambda: (encode_batch_questions(selected_questions, word2idx),
-                               encode_batch_graphs(selected_questions, word2idx)[..., 0, :, :],
+    return {
+        "OneEdgeModel": lambda: (encode_batch_graphs(selected_questions, word2idx)[..., 0, 0, :],),
+        "STAGGModel": lambda: (encode_batch_graphs(selected_questions, word2idx)[..., 0, :, :],
                                encode_structural_features(selected_questions)),
-        "PooledEdgesModel": lambda: (encode_batch_questions(selected_questions, word2idx)[..., 1, :],
-                                     encode_batch_graphs(selected_questions, word2idx)[..., 1, :]),
-        "GNNModel": lambda: (encode_batch_questions(selected_questions, word2idx)[..., 1, :],
-                             *encode_batch_graph_structure(selected_questions, word2idx))
+        "PooledEdgesModel": lambda: (encode_batch_graphs(selected_questions, word2idx)[..., 1, :],),
+        "GNNModel": lambda: encode_batch_graph_structure(selected_questions, word2idx)
     }[model_type]()
-    return samples
 
 
-def extend_embeddings_with_special_tokens(embeddings, word2idx):
+def extend_embeddings_with_special_tokens(embeddings, word2idx, random_state=np.random):
     for el in SPECIAL_TOKENS.values():
         word2idx[el] = len(word2idx)
     for el in SENT_TOKENS:
@@ -53,11 +98,101 @@ def extend_embeddings_with_special_tokens(embeddings, word2idx):
     std = np.std(embeddings)
     mean = np.mean(embeddings)
     embeddings = np.concatenate((embeddings,
-                                 std*np.random.randn(len(word2idx) - embeddings.shape[0], embeddings.shape[1]))+mean,
+                                 std*random_state.randn(len(word2idx) - embeddings.shape[0], embeddings.shape[1]))+mean,
                                 axis=0)
     return embeddings, word2idx
 
 
+def load_word_embeddings_with_special_tokens(path_to_embeddings):
+    """
+    Load the word embeddings extended with the special tokens. If a binary version of the embeddings
+    was created with convert_word_embeddings, it is memory-mapped instead of parsing the text file.
+
+    :param path_to_embeddings: location of the embeddings in the GloVe text format
+    :return: (embeddings as a numpy array, word to index mapping)
+    """
+    path_prefix = os.path.splitext(path_to_embeddings)[0]
+    if os.path.exists(path_prefix + ".npy") and os.path.exists(path_prefix + ".vocab"):
+        return _utils.load_word_embeddings_binary(path_prefix)
+    return extend_embeddings_with_special_tokens(*_utils.load_word_embeddings(path_to_embeddings))
+
+
+def load_model_vocabulary(path_to_model):
+    """
+    Load the vocabulary of a model. The exported models come with their own vocabulary next to the model file,
+    for the other models the vocabulary of the GloVe embeddings is used.
+
+    :param path_to_model: location of the model file
+    :return: word to index mapping
+    """
+    path_to_vocabulary = os.path.splitext(path_to_model)[0] + ".vocab"
+    if os.path.exists(path_to_vocabulary):
+        return _utils.Vocabulary(path_to_vocabulary)
+    _, word2idx = load_word_embeddings_with_special_tokens(
+        _utils.RESOURCES_FOLDER + "../../resources/embeddings/glove/glove.6B.100d.txt"
+    )
+    return word2idx
+
+
+def convert_word_embeddings(path_to_embeddings):
+    """
+    Convert the embeddings from the GloVe text format to a .npy matrix and a .vocab file next to the text file.
+    The special tokens are appended with a fixed seed, so that the conversion is reproducible.
+
+    :param path_to_embeddings: location of the embeddings in the GloVe text format
+    :return: the location of the binary embeddings without the extension
+    """
+    embeddings, word2idx = extend_embeddings_with_special_tokens(*_utils.load_word_embeddings(path_to_embeddings),
+                                                                 random_state=np.random.RandomState(EMBEDDINGS_SEED))
+    path_prefix = os.path.splitext(path_to_embeddings)[0]
+    _utils.save_word_embeddings_binary(embeddings, word2idx, path_prefix)
+    return path_prefix
+
+
+def get_reachable_vocabulary(tokens, entity_labels):
+    """
+    Collect the words that the encoders can look up for the given questions: the question tokens,
+    the tokens of the property and entity labels and the special tokens.
+
+    :param tokens: an iterable of question tokens
+    :param entity_labels: an iterable of entity labels
+    :return: a set of lowercased words
+    >>> sorted(get_reachable_vocabulary(["Who", "won"], ["Nobel Prize"]) - get_reachable_vocabulary([], []))
+    ['nobel', 'prize', 'who', 'won']
+    """
+    words = set(SPECIAL_TOKENS.values()) | set(SENT_TOKENS) | {ENTITY_TOKEN}
+    words.update(t.lower() for t in tokens)
+    labels = itertools.chain((p_meta['label'] for p_meta in scheme.property2label.values()), entity_labels)
+    for label in labels:
+        if label:
+            words.update(t.lower() for t in _utils.split_pattern.split(label))
+    return words
+
+
+def prune_vocabulary(word2idx, words):
+    """
+    Restrict the vocabulary to the given words. The padding and the unknown token keep their indices,
+    the other words are renumbered in alphabetical order.
+
+    :param word2idx: word to index mapping
+    :param words: an iterable of words to keep, words that are not in word2idx are skipped
+    :return: (a list of the old indices of the kept words, word to compact index dictionary)
+    >>> kept_indices, compact_word2idx = prune_vocabulary({_utils.all_zeroes: 0, _utils.unknown_el: 1, "who": 2, "won": 3, "the": 4}, {"the", "who", "nobel"})
+    >>> kept_indices, dict(compact_word2idx)
+    ([0, 1, 4, 2], {'ALL_ZERO': 0, '_UNKNOWN': 1, 'the': 2, 'who': 3})
+    """
+    kept_indices = [word2idx[_utils.all_zeroes], word2idx[_utils.unknown_el]]
+    compact_word2idx = defaultdict(lambda: 1)
+    compact_word2idx[_utils.all_zeroes] = 0
+    compact_word2idx[_utils.unknown_el] = 1
+    for w in sorted(words):
+        idx = word2idx.get(w)
+        if idx is not None and w not in compact_word2idx:
+            compact_word2idx[w] = len(kept_indices)
+            kept_indices.append(idx)
+    return kept_indices, compact_word2idx
+
+
 def encode_batch_graphs(questions: List[Sentence], vocab):
     max_negative_graphs = min(max(len(s.graphs) for s in questions), MAX_NEGATIVE_GRAPHS)
     out = np.zeros((len(questions), max_negative_graphs, MAX_EDGES, 2, MAX_LABEL_TOKEN_LEN), dtype=np.int32)
@@ -70,15 +205,13 @@ def encode_batch_graphs(questions: List[Sentence], vocab):
                               and e.relationid not in graph_queries.sparql_class_relation] \
                              + [e for e in g.graph.edges if e.relationid in graph_queries.sparql_class_relation]
                 for ei, e in enumerate(main_edges[:MAX_EDGES]):
-                    word_ids = [vocab[w.lower()]
-                                for w in _get_edge_str_representation(e, entity2label, entity2type,
-                                                                      replace_entities=True,
-                                                                      mark_boundaries=True)][:MAX_LABEL_TOKEN_LEN]
+                    word_ids = _encode_edge(e, entity2label, entity2type, vocab,
+                                            replace_entities=True,
+                                            mark_boundaries=True)[:MAX_LABEL_TOKEN_LEN]
                     out[i, gi, ei, 0, :len(word_ids)] = word_ids
-                    word_ids = [vocab[w.lower()]
-                                for w in _get_edge_str_representation(e, entity2label, entity2type,
-                                                                      replace_entities=False,
-                                                                      mark_boundaries=True)][:MAX_LABEL_TOKEN_LEN]
+                    word_ids = _encode_edge(e, entity2label, entity2type, vocab,
+                                            replace_entities=False,
+                                            mark_boundaries=True)[:MAX_LABEL_TOKEN_LEN]
                     out[i, gi, ei, 1, :len(word_ids)] = word_ids
     return out
 
@@ -194,7 +327,178 @@ def _entity_kbid2token(entity_kbid, entity2label, entity2type, replace_entities,
     return tokens
 
 
+def _encode_edge(edge: Edge, entity2label, entity2type, vocab,
+                 replace_entities=True,
+                 mark_boundaries=False,
+                 no_entity=False):
+    """
+    Token ids of the edge representation produced by _get_edge_str_representation. The relation and
+    entity labels are encoded through the memos.
+
+    :return: a tuple of token ids
+    >>> _encode_edge(Edge(leftentityid=graph_queries.QUESTION_VAR, rightentityid="Q5", relationid="P31"), {"Q5": "human"}, {"Q5": "NN"}, {"instance": 2, "of": 3, "human": 4, "<s>": 5, "<f>": 6}, mark_boundaries=True)
+    (5, 2, 3, 4, 6)
+    """
+    word_ids = _encode_relation_label(edge.relationid, edge.qualifierrelationid, vocab)
+    entity_kbids = [n for n in edge.nodes() if n and n != graph_queries.QUESTION_VAR]
+    if any(entity_kbids) and not no_entity:
+        word_ids += _encode_entity(entity_kbids[0], entity2label, entity2type, vocab, replace_entities)
+    if mark_boundaries:
+        word_ids = (vocab[SENT_TOKENS[0]],) + word_ids + (vocab[SENT_TOKENS[1]],)
+    return word_ids
+
+
+def _encode_relation_label(relationid, qualifierrelationid, vocab):
+    _check_encoding_memo_vocab(vocab)
+    key = (relationid, qualifierrelationid)
+    if MEMOIZE_ENCODINGS and key in _relation_encoding_memo:
+        ENCODING_MEMO_STATS['hits'] += 1
+        return _relation_encoding_memo[key]
+    ENCODING_MEMO_STATS['misses'] += 1
+    property_label = [""]
+    p_meta = scheme.property2label.get(relationid)
+    if p_meta:
+        property_label = _utils.split_pattern.split(p_meta['label'])
+    p_meta = scheme.property2label.get(qualifierrelationid)
+    if p_meta:
+        property_label += _utils.split_pattern.split(p_meta['label'])
+    word_ids = tuple(vocab[w.lower()] for w in property_label)
+    if MEMOIZE_ENCODINGS:
+        _memoize_encoding(_relation_encoding_memo, key, word_ids)
+    return word_ids
+
+
+def _encode_entity(entity_kbid, entity2label, entity2type, vocab, replace_entities, resolve_m=True):
+    _check_encoding_memo_vocab(vocab)
+    resolved_kbid = entity_kbid[3:] if entity_kbid.startswith("?") else entity_kbid
+    key = (entity_kbid, entity2type.get(entity_kbid), resolved_kbid in entity2label,
+           entity2label.get(resolved_kbid), entity2type.get(resolved_kbid), replace_entities, resolve_m)
+    if MEMOIZE_ENCODINGS and key in _entity_encoding_memo:
+        ENCODING_MEMO_STATS['hits'] += 1
+        return _entity_encoding_memo[key]
+    ENCODING_MEMO_STATS['misses'] += 1
+    word_ids = tuple(vocab[w.lower()] for w in _entity_kbid2token(entity_kbid, entity2label, entity2type,
+                                                                  replace_entities, resolve_m=resolve_m))
+    if MEMOIZE_ENCODINGS:
+        _memoize_encoding(_entity_encoding_memo, key, word_ids)
+    return word_ids
+
+
+def _check_encoding_memo_vocab(vocab):
+    global _encoding_memo_vocab
+    if vocab is not _encoding_memo_vocab:
+        reset_encoding_memo()
+        _encoding_memo_vocab = vocab
+
+
+def _memoize_encoding(memo, key, value):
+    if len(memo) >= MAX_ENCODING_MEMO_SIZE:
+        memo.clear()
+    memo[key] = value
+
+
+def reset_encoding_memo():
+    _relation_encoding_memo.clear()
+    _entity_encoding_memo.clear()
+    ENCODING_MEMO_STATS.clear()
+
+
+def encoding_memo_stats():
+    """
+    :return: the number of memo hits and misses since the last reset and the hit rate
+    """
+    hits, misses = ENCODING_MEMO_STATS['hits'], ENCODING_MEMO_STATS['misses']
+    return {'hits': hits, 'misses': misses, 'hit.rate': hits / max(hits + misses, 1),
+            'size': len(_relation_encoding_memo) + len(_entity_encoding_memo)}
+
+
+def get_size_buckets(questions: List[Sentence], bucket_size):
+    """
+    Order the questions so that each consecutive chunk of bucket_size questions has a similar number of graphs
+    and edges. The models skip the padding at the end of a batch, a batch of similar questions has therefore
+    less computation. The chunks are returned in a random order.
+
+    :param questions: a list of Sentence objects with graphs
+    :param bucket_size: the number of questions in a chunk, e.g. the batch size
+    :return: a list of question indices
+    """
+    sizes = [(min(len(s.graphs), MAX_NEGATIVE_GRAPHS), max((len(g.graph.edges) for g in s.graphs), default=0))
+             for s in questions]
+    order = sorted(range(len(questions)), key=lambda i: sizes[i])
+    buckets = [order[i:i + bucket_size] for i in range(0, len(order), bucket_size)]
+    random.shuffle(buckets)
+    return [i for bucket in buckets for i in bucket]
+
+
+def get_encoding_cache_key(dataset_paths, model_type, word2idx, **extra):
+    """
+    Compute the key of the encoded data sets in the cache. The key covers the contents of the data set files,
+    the model type, the vocabulary and the encoding constants.
+
+    :param dataset_paths: list of the data set files the encoded questions are loaded from
+    :param model_type: name of the model class
+    :param word2idx: the vocabulary used for the encoding
+    :param extra: any other parameters that change the encoded data, e.g. the question selection criteria
+    :return: the key as a hex string
+    """
+    key = {
+        'version': ENCODING_CACHE_VERSION,
+        'datasets': [_utils.get_file_hash(p) for p in dataset_paths],
+        'model.type': model_type,
+        'vocabulary': _utils.get_vocabulary_hash(word2idx),
+        'constants': [MAX_LABEL_TOKEN_LEN, MAX_EDGES, MAX_EDGES_PER_ENTITY, MAX_NEGATIVE_GRAPHS],
+        'extra': extra,
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def save_encoded(path_to_cache, samples, targets):
+    """
+    Store the encoded samples and the targets as .npy files in the cache directory. The files are first written
+    to a temporary directory, so that an interrupted run doesn't leave an incomplete cache entry.
+
+    :param path_to_cache: the cache entry directory, e.g. cache folder + key
+    :param samples: a list of numpy arrays as returned by encode_for_model
+    :param targets: a numpy array of the targets
+    """
+    path_to_tmp = f"{path_to_cache.rstrip(os.sep)}.{os.getpid()}.tmp"
+    os.makedirs(path_to_tmp, exist_ok=True)
+    for i, m in enumerate(samples):
+        np.save(os.path.join(path_to_tmp, f"samples.{i}.npy"), m)
+    np.save(os.path.join(path_to_tmp, "targets.npy"), targets)
+    try:
+        os.rename(path_to_tmp, path_to_cache)
+    except OSError:
+        # Another run has stored the same entry in the meantime
+        shutil.rmtree(path_to_tmp, ignore_errors=True)
+
+
+def load_encoded(path_to_cache):
+    """
+    Load the encoded samples and the targets stored with save_encoded. The arrays are memory-mapped.
+
+    :param path_to_cache: the cache entry directory
+    :return: (a list of read-only numpy arrays, targets as a read-only numpy array) or None if the entry doesn't exist
+    """
+    if not os.path.isdir(path_to_cache):
+        return None
+    samples = []
+    while os.path.exists(os.path.join(path_to_cache, f"samples.{len(samples)}.npy")):
+        samples.append(np.load(os.path.join(path_to_cache, f"samples.{len(samples)}.npy"), mmap_mode='r'))
+    targets = np.load(os.path.join(path_to_cache, "targets.npy"), mmap_mode='r')
+    return samples, targets
+
+
 def encode_batch_graph_structure(questions: List[Sentence], vocab):
+    """
+    Encode the graphs of each question as node labels, edge labels and adjacency lists. The graphs are first
+    flattened into compact arrays of token ids and adjacency entries and the padded output arrays are then filled
+    in bulk.
+
+    :param questions: a list of Sentence objects with graphs
+    :param vocab: word to index mapping
+    :return: (node tokens, edge tokens, adjacent nodes, adjacent edges) of shape (questions, graphs, MAX_EDGES, ...)
+    """
     max_negative_graphs = min(max(len(s.graphs) for s in questions), MAX_NEGATIVE_GRAPHS)
 
     out_nodes = np.zeros((len(questions), max_negative_graphs, MAX_EDGES, MAX_LABEL_TOKEN_LEN//2), dtype=np.int32)
@@ -203,63 +507,110 @@ def encode_batch_graph_structure(questions: List[Sentence], vocab):
     out_A_nodes = np.zeros((len(questions), max_negative_graphs, MAX_EDGES, MAX_EDGES_PER_ENTITY), dtype=np.uint8)
     out_A_edges = np.zeros((len(questions), max_negative_graphs, MAX_EDGES, MAX_EDGES_PER_ENTITY), dtype=np.uint8)
 
+    graph_ids, node_rows, node_offsets, node_tokens, edge_rows, edge_offsets, edge_tokens, adjacency = \
+        _flatten_graph_structure(questions, vocab, max_negative_graphs)
+
+    out_nodes[graph_ids[:, 0], graph_ids[:, 1], 1] = 1  # The second row is the Qvar
+    _fill_token_rows(out_nodes, node_rows, node_offsets, node_tokens)
+    _fill_token_rows(out_edges, edge_rows, edge_offsets, edge_tokens)
+
+    if len(adjacency) > 0:
+        # The position of an entry in the adjacency list of its node is its rank among the entries of the node
+        keys = np.ravel_multi_index(tuple(adjacency[:, :3].T), out_A_nodes.shape[:3])
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        group_starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        group_sizes = np.diff(np.r_[group_starts, len(keys)])
+        slots = np.empty(len(keys), dtype=np.int64)
+        slots[order] = np.arange(len(keys)) - np.repeat(group_starts, group_sizes)
+        adjacency, slots = adjacency[slots < MAX_EDGES_PER_ENTITY], slots[slots < MAX_EDGES_PER_ENTITY]
+        out_A_nodes[adjacency[:, 0], adjacency[:, 1], adjacency[:, 2], slots] = adjacency[:, 3]
+        out_A_edges[adjacency[:, 0], adjacency[:, 1], adjacency[:, 2], slots] = adjacency[:, 4]
+    return out_nodes, out_edges, out_A_nodes, out_A_edges
+
+
+def _flatten_graph_structure(questions: List[Sentence], vocab, max_negative_graphs):
+    """
+    Flatten the graphs of the questions into compact arrays. The token ids of the node and edge labels are
+    concatenated and the label of row k spans the tokens from offsets[k] to offsets[k+1].
+
+    :return: (graph ids as (question, graph), node rows as (question, graph, node), node offsets, node tokens,
+              edge rows as (question, graph, edge), edge offsets, edge tokens,
+              adjacency entries as (question, graph, node, adjacent node, adjacent edge))
+    """
+    graph_ids, node_rows, node_lengths, node_tokens = [], [], [], []
+    edge_rows, edge_lengths, edge_tokens = [], [], []
+    adjacency = []
+    entity_token_id = vocab[ENTITY_TOKEN.lower()]
     for i, s in enumerate(questions):  # Iterate over lists of graphs for questions
         entity2label = {k: l for e in s.entities for k, l in e['linkings']}
         entity2type = {k: e['type'] for e in s.entities for k, l in e['linkings']}
 
         for gi, g in enumerate(s.graphs[:max_negative_graphs]):  # Iterate over graph alternatives for a question
+            graph_ids += (i, gi)
             edges = [e for e in g.graph.edges
                      if e.relationid not in graph_queries.sparql_class_relation] \
                          + [e for e in g.graph.edges if e.relationid in graph_queries.sparql_class_relation]
 
-            # edges = edges[:(MAX_EDGES - 2)]
             nodes = {n for e in edges for n in e.nodes() if n} - {graph_queries.QUESTION_VAR}
             nodes = list(nodes)[:(MAX_EDGES - 2)]  # The first row in the matrix is 0 padding and the second is the Qvar
             node2id = {n: ni for ni, n in enumerate(nodes, start=2)}
 
             for n, ni in node2id.items():
-                entity_tokens = _entity_kbid2token(n, entity2label, entity2type,
-                                                   replace_entities=False,
-                                                   mark_boundaries=False, resolve_m=False)
-                if entity_tokens:
-                    word_ids = [vocab[w.lower()] for w in entity_tokens][:MAX_LABEL_TOKEN_LEN//2]
-                    out_nodes[i, gi, ni, :len(word_ids)] = word_ids
-                else:
-                    out_nodes[i, gi, ni, 0] = vocab[ENTITY_TOKEN.lower()]
+                word_ids = _encode_entity(n, entity2label, entity2type, vocab,
+                                          replace_entities=False, resolve_m=False) or (entity_token_id,)
+                node_rows += (i, gi, ni)
+                node_lengths.append(len(word_ids))
+                node_tokens += word_ids
             node2id[graph_queries.QUESTION_VAR] = 1
-            out_nodes[i, gi, 1] = 1
 
-            temp_edges = defaultdict(list)
-            temp_nodes = defaultdict(list)
             for ei, e in enumerate(edges, start=1):
-                property_tokens = _get_edge_str_representation(e, entity2label, entity2type,
-                                                               mark_boundaries=False,
-                                                               no_entity=True)
-                if property_tokens:
-                    word_ids = [vocab[w.lower()] for w in property_tokens][:MAX_LABEL_TOKEN_LEN//2]
-                    out_edges[i, gi, ei, :len(word_ids)] = word_ids
-
+                word_ids = _encode_edge(e, entity2label, entity2type, vocab,
+                                        mark_boundaries=False,
+                                        no_entity=True)
+                if word_ids:
+                    edge_rows += (i, gi, ei)
+                    edge_lengths.append(len(word_ids))
+                    edge_tokens += word_ids
+
+                connected = []
                 if e.leftentityid in node2id:
                     if e.rightentityid in node2id:
-                        temp_edges[node2id[e.leftentityid]].append(ei)
-                        temp_nodes[node2id[e.leftentityid]].append(node2id[e.rightentityid])
-                        temp_edges[node2id[e.rightentityid]].append(ei + MAX_EDGES)
-                        temp_nodes[node2id[e.rightentityid]].append(node2id[e.leftentityid])
+                        connected.append((e.leftentityid, e.rightentityid))
                     if e.qualifierentityid in node2id:
-                        temp_edges[node2id[e.leftentityid]].append(ei)
-                        temp_nodes[node2id[e.leftentityid]].append(node2id[e.qualifierentityid])
-                        temp_edges[node2id[e.qualifierentityid]].append(ei + MAX_EDGES)
-                        temp_nodes[node2id[e.qualifierentityid]].append(node2id[e.leftentityid])
+                        connected.append((e.leftentityid, e.qualifierentityid))
                 if e.rightentityid in node2id and e.qualifierentityid in node2id:
-                    temp_edges[node2id[e.rightentityid]].append(ei)
-                    temp_nodes[node2id[e.rightentityid]].append(node2id[e.qualifierentityid])
-                    temp_edges[node2id[e.qualifierentityid]].append(ei + MAX_EDGES)
-                    temp_nodes[node2id[e.qualifierentityid]].append(node2id[e.rightentityid])
-
-            for nodeid, nodeids in temp_nodes.items():
-                nodeids = nodeids[:MAX_EDGES_PER_ENTITY]
-                out_A_nodes[i, gi, nodeid, :len(nodeids)] = nodeids
-            for nodeid, edgeids in temp_edges.items():
-                edgeids = edgeids[:MAX_EDGES_PER_ENTITY]
-                out_A_edges[i, gi, nodeid, :len(edgeids)] = edgeids
-    return out_nodes, out_edges, out_A_nodes, out_A_edges
+                    connected.append((e.rightentityid, e.qualifierentityid))
+                for n1, n2 in connected:
+                    adjacency += (i, gi, node2id[n1], node2id[n2], ei,
+                                  i, gi, node2id[n2], node2id[n1], ei + MAX_EDGES)
+
+    return (np.asarray(graph_ids, dtype=np.int64).reshape(-1, 2),
+            np.asarray(node_rows, dtype=np.int64).reshape(-1, 3),
+            np.r_[0, np.cumsum(node_lengths, dtype=np.int64)],
+            np.asarray(node_tokens, dtype=np.int32),
+            np.asarray(edge_rows, dtype=np.int64).reshape(-1, 3),
+            np.r_[0, np.cumsum(edge_lengths, dtype=np.int64)],
+            np.asarray(edge_tokens, dtype=np.int32),
+            np.asarray(adjacency, dtype=np.int64).reshape(-1, 5))
+
+
+def _fill_token_rows(out, rows, offsets, tokens):
+    """
+    Copy the flattened token ids into the padded array, the labels that are too long are cut.
+
+    :param out: the output array of shape (questions, graphs, rows, tokens)
+    :param rows: the position of each label as (question, graph, row)
+    :param offsets: the offsets of the labels in tokens
+    :param tokens: concatenated token ids
+    >>> out = np.zeros((1, 1, 3, 2), dtype=np.int32)
+    >>> _fill_token_rows(out, np.array([[0, 0, 1], [0, 0, 2]]), np.array([0, 3, 4]), np.array([5, 6, 7, 8]))
+    >>> out[0, 0].tolist()
+    [[0, 0], [5, 6], [8, 0]]
+    """
+    lengths = np.diff(offsets)
+    row_index = np.repeat(np.arange(len(lengths)), lengths)
+    positions = np.arange(len(tokens)) - offsets[row_index]
+    mask = positions < out.shape[-1]
+    row_index = row_index[mask]
+    out[rows[row_index, 0], rows[row_index, 1], rows[row_index, 2], positions[mask]] = tokens[mask]
@@ -1,4 +1,3 @@
-import json
 import logging
 import sys
 import random
@@ -15,10 +14,12 @@ import fackel
 from questionanswering import config_utils, _utils
 from questionanswering import models
 from questionanswering.models import vectorization as V
-from questionanswering.models import losses
+from questionanswering.models import losses, training
 
 
-from questionanswering.construction.sentence import sentence_object_hook, Sentence
+from questionanswering.construction import silver_columns
+from questionanswering.datasets import batch_producer
+from questionanswering.construction.sentence import iter_sentences, Sentence
 
 
 @click.command()
@@ -45,40 +46,40 @@ def train(config_file_path, seed, gpuid, model_description, experiment_tag):
     # Load data
     if not isinstance(config['training']["path_to_dataset"], list):
         config['training']["path_to_dataset"] = [config['training']["path_to_dataset"]]
-    training_dataset = []
-    for path_to_train in config['training']["path_to_dataset"]:
-        with open(path_to_train) as f:
-            training_dataset += json.load(f,  object_hook=sentence_object_hook)
-    logger.info(f"Train: {len(training_dataset)}")
-    train_size_available = len(training_dataset)
+    training_dataset, train_size_available = load_trainable(config['training']["path_to_dataset"])
+    logger.info(f"Train: {len(training_dataset)}/{train_size_available}")
     dataset_name = config['training']["path_to_dataset"][0].split("/")[-1].split(".")[0]
 
     if "path_to_validation" not in config['training']:
         config['training']["path_to_validation"] = config['training']["path_to_dataset"][-1]
         logger.info(f"No validation set, using part of the training data.")
-    with open(config['training']["path_to_validation"]) as f:
-        val_dataset = json.load(f,  object_hook=sentence_object_hook)
-    logger.info(f"Validation: {len(val_dataset)}")
-    val_size_available = len(val_dataset)
+    val_dataset, val_size_available = load_trainable([config['training']["path_to_validation"]])
+    logger.info(f"Validation: {len(val_dataset)}/{val_size_available}")
 
-    wordembeddings, word2idx = V.extend_embeddings_with_special_tokens(
-        *_utils.load_word_embeddings(_utils.RESOURCES_FOLDER + "../../resources/embeddings/glove/glove.6B.100d.txt")
+    wordembeddings, word2idx = V.load_word_embeddings_with_special_tokens(
+        _utils.RESOURCES_FOLDER + "../../resources/embeddings/glove/glove.6B.100d.txt"
     )
     logger.info(f"Loaded word embeddings: {wordembeddings.shape}")
 
     model_type = config['training']["model_type"]
     logger.info(f"Model type: {model_type}")
 
+    path_to_train_cache, path_to_val_cache = None, None
     V.MAX_NEGATIVE_GRAPHS = 50
-    training_dataset = [s for s in training_dataset if any(scores[2] > losses.MIN_TARGET_VALUE for g, scores in s.graphs)]
-    training_samples, training_targets = pack_data(training_dataset, word2idx, model_type)
-    logger.info(f"Data encoded: {[m.shape for m in training_samples]}")
+    if "encoding.cache" in config['training']:
+        path_to_train_cache = os.path.join(config['training']["encoding.cache"], V.get_encoding_cache_key(
+            config['training']["path_to_dataset"], model_type, word2idx, min_target_value=losses.MIN_TARGET_VALUE))
+    bucket_size = config['training']['batch_size'] if config['training'].get('bucketing', False) else None
+    training_data = pack_data(training_dataset, word2idx, model_type, path_to_train_cache, bucket_size=bucket_size)
+    logger.info(f"Data encoded: {[m.shape for m in training_data.samples]}")
 
     V.MAX_NEGATIVE_GRAPHS = 100
-    val_dataset = [s for s in val_dataset if any(scores[2] > losses.MIN_TARGET_VALUE for g, scores in s.graphs)]
+    if "encoding.cache" in config['training']:
+        path_to_val_cache = os.path.join(config['training']["encoding.cache"], V.get_encoding_cache_key(
+            [config['training']["path_to_validation"]], model_type, word2idx, min_target_value=losses.MIN_TARGET_VALUE))
     print(f"Val F1 upper bound: {np.average([q.graphs[0].scores[2] for q in val_dataset])}")
-    val_samples, val_targets = pack_data(val_dataset, word2idx, model_type)
-    logger.info(f"Val data encoded: {[m.shape for m in val_samples]}")
+    val_data = pack_data(val_dataset, word2idx, model_type, path_to_val_cache, bucket_size=bucket_size)
+    logger.info(f"Val data encoded: {[m.shape for m in val_data.samples]}")
 
     encoder = models.ConvWordsEncoder(
         hp_vocab_size=wordembeddings.shape[0],
@@ -103,7 +104,7 @@ def train(config_file_path, seed, gpuid, model_description, experiment_tag):
                     if abs(idx) < len(q.graphs):
                         cur_f1 += q.graphs[idx].scores[2]
             cur_f1 /= predicted_targets.size(0)
-        return {'acc': cur_acc.data[0], 'f1': cur_f1, 'predictions': predicted_targets.data.unsqueeze(0)}
+        return {'acc': cur_acc.item(), 'f1': cur_f1, 'predictions': predicted_targets.data.unsqueeze(0)}
 
     # Save models into model specific directory
     if "save_to_dir" in config['training']:
@@ -114,15 +115,17 @@ def train(config_file_path, seed, gpuid, model_description, experiment_tag):
                                             f"{model_type.lower()}s_{now.year}Q{now.month // 4 + 1}/"
         if not os.path.exists(config['training']['save_to_dir']):
             os.makedirs(config['training']['save_to_dir'])
+    criterion = losses.VariableMarginLoss()
+    # criterion = nn.MultiMarginLoss(margin=0.5, size_average=False)
+    optimizer_params = {
+        'weight_decay': 0.05,
+        # 'lr': 0.01
+    }
     container = fackel.TorchContainer(
         torch_model=net,
-        criterion=losses.VariableMarginLoss(),
-        # criterion=nn.MultiMarginLoss(margin=0.5, size_average=False),
+        criterion=criterion,
         metrics=metrics,
-        optimizer_params={
-            'weight_decay': 0.05,
-            # 'lr': 0.01
-        },
+        optimizer_params=optimizer_params,
         optimizer="Adam",
         logger=logger,
         init_model_weights=True,
@@ -133,18 +136,40 @@ def train(config_file_path, seed, gpuid, model_description, experiment_tag):
     if results_logger:
         results_logger.info("Model save to: {}".format(container._save_model_to))
 
-    log_history = container.train(
-        training_samples, training_targets,
-        dev=val_samples, dev_targets=val_targets
-    )
+    batch_loop = path_to_train_cache is not None or bucket_size is not None
+    if batch_loop:
+        # The batches are gathered from the cached arrays or the buckets by training.train,
+        # the container would copy the whole data set to tensors and mix the buckets
+        optimizer = torch.optim.Adam(container._model.parameters(), **optimizer_params)
+        log_history = training.train(
+            container._model, criterion, optimizer, metrics, training_data, dev_data=val_data,
+            save_model=container.save_model if config['training'].get('model_checkpoint', False) else None,
+            logger=logger,
+            num_workers=config['training'].get('generator.workers', 0),
+            max_queued_batches=config['training'].get('generator.queue.size',
+                                                      batch_producer.DEFAULT_MAX_QUEUED_BATCHES),
+            **{k: v for k, v in config['training'].items() if k in training.TRAINING_PARAMETERS}
+        )
+    else:
+        training_samples, training_targets = training_data.arrays()
+        val_samples, val_targets = val_data.arrays()
+        log_history = container.train(
+            training_samples, training_targets,
+            dev=val_samples, dev_targets=val_targets
+        )
 
     for q in val_dataset:
         random.shuffle(q.graphs)
     if container._model_checkpoint:
         container.reload_from_saved()
-    val_samples, val_targets = pack_data(val_dataset, word2idx, model_type)
-    predictions = container.predict_batchwise(*val_samples)
-    results = metrics(*container._torchify_data(True, val_targets), predictions, validation=True)
+    val_data = pack_data(val_dataset, word2idx, model_type, bucket_size=bucket_size)
+    if batch_loop:
+        predictions, val_targets = training.predict(container._model, val_data, config['training']['batch_size'])
+    else:
+        val_samples, val_targets = val_data.arrays()
+        predictions = container.predict_batchwise(*val_samples)
+        val_targets, = container._torchify_data(True, val_targets)
+    results = metrics(val_targets, predictions, validation=True)
     _, predictions = torch.topk(predictions, 1, dim=-1)
     print(f"Acc: {results['acc']}, F1: {results['f1']}")
     print(f"Predictions head: {predictions.data[:10].view(1,-1)}")
@@ -174,20 +199,78 @@ def train(config_file_path, seed, gpuid, model_description, experiment_tag):
     print(container._save_model_to)
 
 
+def load_trainable(paths_to_datasets):
+    """
+    Read the data sets one sentence at a time and keep the sentences that have at least one graph
+    with a target above losses.MIN_TARGET_VALUE.
+
+    :param paths_to_datasets: a list of data set files
+    :return: the list of kept sentences and the number of read sentences
+    """
+    dataset, size_available = [], 0
+    for path_to_dataset in paths_to_datasets:
+        if path_to_dataset.endswith(".npz"):
+            # The scores are read from the columns, only the kept sentences are decoded
+            columns = silver_columns.SilverColumns(path_to_dataset)
+            size_available += len(columns)
+            dataset += [columns.sentence(i) for i in range(len(columns))
+                        if np.any(columns.sentence_scores(i)[:, 2] > losses.MIN_TARGET_VALUE)]
+            continue
+        for s in iter_sentences(path_to_dataset):
+            size_available += 1
+            if any(scores[2] > losses.MIN_TARGET_VALUE for g, scores in s.graphs):
+                dataset.append(s)
+    return dataset, size_available
+
+
 def pack_data(selected_questions: List[Sentence],
               word2idx,
-              model_type):
+              model_type,
+              path_to_cache=None,
+              bucket_size=None):
+    """
+    Encode the questions and their graphs for the model, the graphs of each question are shuffled.
+    The questions are encoded before the graphs are shuffled and the shuffle is applied when a batch is gathered,
+    so that a cached encoding can be reused with any random seed and the cached arrays are not copied.
+
+    :param selected_questions: a list of Sentence objects, the graphs of each question are truncated and shuffled
+    :param word2idx: word to index dictionary
+    :param model_type: name of the model class
+    :param path_to_cache: a cache entry directory to load the encoded data from or to store it to, no caching if None
+    :param bucket_size: if given, the questions are reordered in place into buckets of this size with a similar
+        number of graphs and edges, see vectorization.get_size_buckets, and each bucket is a training batch
+    :return: an EncodedData object, the questions are in the order of selected_questions
+    """
     max_negative_graphs = min(max(len(s.graphs) for s in selected_questions), V.MAX_NEGATIVE_GRAPHS)
-    targets = np.zeros((len(selected_questions), max_negative_graphs))
-    for qi, q in enumerate(selected_questions):
+    for q in selected_questions:
         q.graphs = q.graphs[:max_negative_graphs]
-        random.shuffle(q.graphs)
-        for gi, g in enumerate(q.graphs):
-            targets[qi, gi] = g.scores[2]
 
-    samples = V.encode_for_model(selected_questions, model_type, word2idx)
-    return samples, targets
+    encoded = V.load_encoded(path_to_cache) if path_to_cache else None
+    if encoded is not None and len(encoded[1]) == len(selected_questions):
+        samples, targets = encoded
+    else:
+        targets = np.zeros((len(selected_questions), max_negative_graphs))
+        for qi, q in enumerate(selected_questions):
+            for gi, g in enumerate(q.graphs):
+                targets[qi, gi] = g.scores[2]
+        samples = V.encode_for_model(selected_questions, model_type, word2idx)
+        if path_to_cache:
+            V.save_encoded(path_to_cache, samples, targets)
+
+    # Shuffling a list of positions consumes the random state in the same way as shuffling the graphs
+    graph_order = np.tile(np.arange(max_negative_graphs), (len(selected_questions), 1))
+    for qi, q in enumerate(selected_questions):
+        permutation = list(range(len(q.graphs)))
+        random.shuffle(permutation)
+        q.graphs = [q.graphs[gi] for gi in permutation]
+        graph_order[qi, :len(permutation)] = permutation
 
+    question_order = None
+    if bucket_size:
+        question_order = V.get_size_buckets(selected_questions, bucket_size)
+        selected_questions[:] = [selected_questions[qi] for qi in question_order]
+    return training.EncodedData(samples, targets, graph_order, question_order,
+                                graph_counts=[len(q.graphs) for q in selected_questions], bucket_size=bucket_size)
 
 if __name__ == "__main__":
     train()
@@ -10,4 +10,4 @@ setup(name='UKP_FactoidQA_on_Wikidata',
       author_email='sorokin@ukp.informatik.tu-darmstadt.de',
       url='ukp.tu-darmstadt.de/ukp-home/',
       packages=find_packages(), requires=['numpy', 'nltk', 'tqdm', 'SPARQLWrapper', 'click', 'keras', 'sklearn',
-                                          'torch', 'flask'])
+                                          'torch', 'flask', 'aiohttp'])
@@ -0,0 +1,117 @@
+import asyncio
+import threading
+
+import pytest
+from aiohttp import web
+
+from questionanswering.construction.graph import SemanticGraph, Edge
+from questionanswering.grounding import async_queries, graph_queries, query_cache, local_store
+
+
+class StubEndpoint:
+    def __init__(self):
+        """
+        A SPARQL endpoint that answers every request with the next prepared response, the last one is repeated.
+        """
+        self.responses = []
+        self.requests = []
+        self.url = None
+
+    def respond(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    async def handle(self, request):
+        self.requests.append(dict(await request.post()))
+        status, body = self.responses[min(len(self.requests), len(self.responses)) - 1]
+        return web.json_response(body, status=status)
+
+
+def select_response(var, values):
+    return {'head': {'vars': [var]},
+            'results': {'bindings': [{var: {'type': 'uri', 'value': "http://www.wikidata.org/entity/" + v}}
+                                     for v in values]}}
+
+
+@pytest.fixture(scope="module")
+def endpoint():
+    stub = StubEndpoint()
+    loop = asyncio.new_event_loop()
+    app = web.Application()
+    app.router.add_post("/sparql", stub.handle)
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    stub.url = "http://127.0.0.1:{}/sparql".format(site._server.sockets[0].getsockname()[1])
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield stub
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+@pytest.fixture(autouse=True)
+def no_cache():
+    query_cache.set_cache(None)
+    graph_queries.reset_memo()
+    yield
+    query_cache.set_cache(None)
+    graph_queries.reset_memo()
+
+
+def run_query(url, query, **kwargs):
+    async def _query():
+        async with async_queries.AsyncSparqlClient(url, backoff=0.01) as client:
+            return await client.query_wikidata(query, **kwargs)
+    return asyncio.run(_query())
+
+
+def test_query(endpoint):
+    endpoint.respond((200, select_response('e0', ["Q76"])))
+    assert run_query(endpoint.url, "SELECT ?e0 WHERE { ?e0 ?p ?o }", timeout=2) == [{'e0': "Q76"}]
+    assert endpoint.requests[0]['timeout'] == "2000"
+
+
+def test_retries(endpoint):
+    endpoint.respond((500, {}), (200, {'head': {}, 'boolean': True}))
+    assert run_query(endpoint.url, "ASK { ?s ?p ?o }") is True
+    assert len(endpoint.requests) == 2
+    endpoint.respond((400, {}))
+    assert run_query(endpoint.url, "ASK { ?s ?p ?o }") is None
+    assert len(endpoint.requests) == 1
+
+
+def test_cache(endpoint):
+    query_cache.set_cache(query_cache.SparqlCache(":memory:"))
+    endpoint.respond((200, select_response('e0', ["Q76"])))
+    assert run_query(endpoint.url, "SELECT ?e0 WHERE { ?e0 ?p ?o }") == [{'e0': "Q76"}]
+    assert run_query(endpoint.url, "SELECT ?e0 WHERE { ?e0 ?p ?o }") == [{'e0': "Q76"}]
+    assert len(endpoint.requests) == 1
+
+
+def test_local_backend(endpoint):
+    store = local_store.TripleStore()
+    store.add("Q76", "P26s", "Q76S1", "http://wikidata.org/statements")
+    store.add("Q76S1", "P26v", "Q13133", "http://wikidata.org/statements")
+    query_cache.set_local_backend(store)
+    try:
+        endpoint.respond((500, {}))
+        assert run_query(endpoint.url, "ASK WHERE { GRAPH g:statements { e:Q76 e:P26s/e:P26v e:Q13133 . } }") is True
+        assert len(endpoint.requests) == 0
+    finally:
+        query_cache.set_local_backend(None)
+
+
+def test_grounder(endpoint):
+    g = SemanticGraph([Edge(leftentityid="Q76", rightentityid=graph_queries.QUESTION_VAR)])
+    endpoint.respond((200, select_response('r0v', ["P26v"])))
+    grounder = async_queries.AsyncGrounder(endpoint.url)
+    try:
+        assert grounder.ground_graphs([g]) == [[{'r0v': "P26v"}]]
+    finally:
+        grounder.close()
+    # The groundings are shared with the synchronous code
+    assert graph_queries.get_graph_groundings(g) == [{'r0v': "P26v"}]
+    assert len(endpoint.requests) == 1
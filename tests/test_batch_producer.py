@@ -0,0 +1,41 @@
+import os
+
+import pytest
+import numpy as np
+
+from questionanswering.datasets import batch_producer
+
+
+def make_batch(indices):
+    return np.random.choice(100, len(indices))
+
+
+def failing_batch(indices):
+    raise ValueError("Broken batch")
+
+
+def dying_batch(indices):
+    os._exit(1)
+
+
+def test_reproducible_batches():
+    batches = [[0, 1, 2, 3]] * 20
+    in_process = list(batch_producer.produce_batches(make_batch, batches, seed=1))
+    for num_workers in [1, 3]:
+        produced = list(batch_producer.produce_batches(make_batch, batches, seed=1, num_workers=num_workers,
+                                                       max_queued_batches=4))
+        assert len(produced) == len(in_process)
+        assert all(np.array_equal(b, p) for b, p in zip(in_process, produced))
+    assert not np.array_equal(in_process[0], in_process[1])
+    other_seed = list(batch_producer.produce_batches(make_batch, batches, seed=2))
+    assert not all(np.array_equal(b, o) for b, o in zip(in_process, other_seed))
+
+
+def test_worker_error():
+    with pytest.raises(RuntimeError):
+        list(batch_producer.produce_batches(failing_batch, [[0]] * 3, seed=1, num_workers=2))
+
+
+def test_worker_death():
+    with pytest.raises(RuntimeError, match="died"):
+        list(batch_producer.produce_batches(dying_batch, [[0]] * 3, seed=1, num_workers=2))
@@ -2,15 +2,18 @@ import pytest
 import json
 
 import numpy as np
+import torch
 from torch import nn as nn
 
 import fackel
 
 from questionanswering.construction import sentence
+from questionanswering.construction.graph import SemanticGraph, Edge, WithScore
+from questionanswering.grounding import graph_queries
 from questionanswering import _utils
 from questionanswering.models.modules import ConvWordsEncoder
 from questionanswering.models.gnn import GNNModel
-from questionanswering.models import vectorization as V
+from questionanswering.models import vectorization as V, modules
 
 
 wordembeddings, word2idx = V.extend_embeddings_with_special_tokens(
@@ -25,6 +28,17 @@ def test_encode_structure():
     print(train_questions[0])
 
 
+def test_encode_structure_adjacency():
+    s = sentence.Sentence(entities=[{'type': 'NN', 'linkings': [("Q5", "human")], 'token_ids': [0]}])
+    s.graphs = [WithScore(SemanticGraph([Edge(leftentityid=graph_queries.QUESTION_VAR, rightentityid="Q5", relationid="P31")]),
+                          (0.0, 0.0, 0.0))]
+    nodes, edges, A_nodes, A_edges = V.encode_batch_graph_structure([s], word2idx)
+    assert nodes[0, 0, 2, 0] == word2idx["human"]
+    assert all(nodes[0, 0, 1] == 1)
+    assert list(A_nodes[0, 0, 1]) == [2, 0, 0, 0] and list(A_edges[0, 0, 1]) == [1, 0, 0, 0]
+    assert list(A_nodes[0, 0, 2]) == [1, 0, 0, 0] and list(A_edges[0, 0, 2]) == [1 + V.MAX_EDGES, 0, 0, 0]
+
+
 def test_load_parameters():
     encoder = ConvWordsEncoder(*wordembeddings.shape)
     encoder.load_word_embeddings_from_numpy(wordembeddings)
@@ -47,6 +61,38 @@ def test_load_parameters():
     assert container._model._gnn._prop_model._dropout.p == 0.2
 
 
+def test_sparse_propagation():
+    train_questions = V.encode_batch_questions(training_dataset, word2idx)[..., 1, :]
+    train_graphs = V.encode_batch_graph_structure(training_dataset, word2idx)
+    samples = [torch.from_numpy(m.astype(np.int64)) for m in (train_questions, *train_graphs)]
+    for gated in [True, False]:
+        encoder = ConvWordsEncoder(*wordembeddings.shape)
+        encoder.load_word_embeddings_from_numpy(wordembeddings)
+        net = GNNModel(encoder, hp_gated=gated)
+        net.eval()
+        dense_predictions = net(*samples)
+        net._gnn.hp_propagation = "sparse"
+        sparse_predictions = net(*samples)
+        assert torch.allclose(dense_predictions, sparse_predictions, atol=1e-5)
+
+
+def test_trim_padding():
+    train_questions = V.encode_batch_questions(training_dataset, word2idx)[..., 1, :]
+    train_graphs = V.encode_batch_graph_structure(training_dataset, word2idx)
+    samples = [torch.from_numpy(m.astype(np.int64)) for m in (train_questions, *train_graphs)]
+    encoder = ConvWordsEncoder(*wordembeddings.shape)
+    encoder.load_word_embeddings_from_numpy(wordembeddings)
+    net = GNNModel(encoder)
+    net.eval()
+    trimmed_predictions = net(*samples)
+    modules.TRIM_PADDING = False
+    try:
+        predictions = net(*samples)
+    finally:
+        modules.TRIM_PADDING = True
+    assert torch.equal(predictions, trimmed_predictions)
+
+
 def test_ggnn():
     encoder = ConvWordsEncoder(*wordembeddings.shape)
     encoder.load_word_embeddings_from_numpy(wordembeddings)
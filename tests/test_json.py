@@ -2,8 +2,11 @@ import pytest
 
 import json
 
-from questionanswering.construction.sentence import Sentence, SentenceEncoder, sentence_object_hook
+from questionanswering.construction.sentence import Sentence, SentenceEncoder, sentence_object_hook, \
+    read_sentences_jsonl, load_sentences, iter_sentences, convert_to_jsonl
 from questionanswering.construction.graph import SemanticGraph, Edge, EdgeList
+from questionanswering.construction import silver_columns
+from questionanswering import convert_silver_graphs
 
 
 def test_encode():
@@ -43,5 +46,72 @@ def test_decode():
     assert s_decoded.graphs[0].scores[2] == 0.0
 
 
+def test_jsonl(tmpdir):
+    s = Sentence(entities=[{"type": "NN", "linkings": [("Q5", "human")], 'token_ids': [0]}])
+    s.graphs[0].graph.edges.append(Edge(leftentityid="?qvar", rightentityid="Q76", relationid="P26"))
+    path_to_json = str(tmpdir.join("silver.json"))
+    with open(path_to_json, 'w') as out:
+        json.dump([s, s], out, cls=SentenceEncoder)
+    assert convert_to_jsonl(path_to_json, path_to_json + "l") == 2
+    sentences = list(read_sentences_jsonl(path_to_json + "l"))
+    assert len(sentences) == 2
+    assert isinstance(sentences[0].graphs[0].graph.edges, EdgeList)
+    assert sentences[0].graphs[0].graph.edges[0].relationid == "P26"
+    assert json.dumps(sentences, cls=SentenceEncoder, sort_keys=True) == \
+        json.dumps(load_sentences(path_to_json), cls=SentenceEncoder, sort_keys=True)
+
+
+def test_missing_fields(tmpdir):
+    path_to_jsonl = str(tmpdir.join("silver.jsonl"))
+    with open(path_to_jsonl, 'w') as out:
+        for _ in range(2):
+            s = json.loads(json.dumps(Sentence(), cls=SentenceEncoder))
+            del s['graphs'][0][0]['denotations']
+            out.write(json.dumps(s) + "\n")
+    first, second = iter_sentences(path_to_jsonl)
+    first.graphs[0].graph.denotations.append("Q76")
+    assert second.graphs[0].graph.denotations == []
+    assert SemanticGraph().denotations == []
+
+
+def test_silver_columns(tmpdir):
+    s = Sentence(entities=[{"type": "NN", "linkings": [("Q5", "human")], 'token_ids': [0]}])
+    s.graphs[0].graph.edges.append(Edge(leftentityid="?qvar", rightentityid="Q76", relationid="P26"))
+    s.graphs[0].graph.denotations = ["Q13133"]
+    empty = Sentence()
+    empty.graphs = []
+    path_to_json = str(tmpdir.join("silver.json"))
+    with open(path_to_json, 'w') as out:
+        json.dump([s, empty, s], out, cls=SentenceEncoder, sort_keys=True, indent=4)
+    path_to_columns = str(tmpdir.join("silver.npz"))
+    assert silver_columns.convert_to_columns(path_to_json, path_to_columns) == 3
+    columns = silver_columns.SilverColumns(path_to_columns)
+    assert len(columns) == 3
+    assert columns.sentence_scores(2).tolist() == [[0.0, 0.0, 0.0]]
+    assert columns.sentence(2).graphs[0].graph.edges[0].relationid == "P26"
+    assert columns.sentence(2).graphs[0].graph.edges[0].qualifierentityid is None
+    assert silver_columns.convert_to_json(path_to_columns, path_to_json + ".converted") == 3
+    with open(path_to_json) as f, open(path_to_json + ".converted") as f_converted:
+        assert f.read() == f_converted.read()
+
+
+def test_convert_silver_graphs(tmpdir):
+    s = Sentence(entities=[{"type": "NN", "linkings": [("Q5", "human")], 'token_ids': [0]}])
+    s.graphs[0].graph.edges.append(Edge(leftentityid="?qvar", rightentityid="Q76", relationid="P26"))
+    path_to_json = str(tmpdir.join("silver.json"))
+    with open(path_to_json, 'w') as out:
+        json.dump([s, s], out, cls=SentenceEncoder, sort_keys=True, indent=4)
+    with open(path_to_json) as f:
+        expected = f.read()
+    convert_silver_graphs.convert.callback(path_to_json, "")
+    convert_silver_graphs.convert.callback(str(tmpdir.join("silver.jsonl")), str(tmpdir.join("silver.npz")))
+    convert_silver_graphs.convert.callback(str(tmpdir.join("silver.npz")), str(tmpdir.join("columns.jsonl")))
+    convert_silver_graphs.convert.callback(str(tmpdir.join("columns.jsonl")), "")
+    with open(str(tmpdir.join("columns.json"))) as f:
+        assert f.read() == expected
+    with pytest.raises(SystemExit):
+        convert_silver_graphs.convert.callback(path_to_json, str(tmpdir.join("copy.json")))
+
+
 if __name__ == '__main__':
     pytest.main(['-v', __file__])
@@ -0,0 +1,119 @@
+import pytest
+
+from questionanswering.construction.graph import SemanticGraph, Edge
+from questionanswering.grounding import graph_queries, query_cache, local_store, neighbourhood_index
+
+E = "<http://www.wikidata.org/entity/{}>"
+STATEMENTS = "<http://wikidata.org/statements>"
+INSTANCES = "<http://wikidata.org/instances>"
+SIMPLE_STATEMENTS = "<http://wikidata.org/simple-statements>"
+TIME = "<http://www.wikidata.org/ontology#time>"
+RDF_TYPE = "<http://www.w3.org/1999/02/22-rdf-syntax-ns#type>"
+SUBCLASS_OF = "<http://www.w3.org/2000/01/rdf-schema#subClassOf>"
+
+dump = [
+    # Barack Obama, spouse Michelle Obama, start time 1992
+    (E.format("Q76"), E.format("P26s"), E.format("Q76S1"), STATEMENTS),
+    (E.format("Q76S1"), E.format("P26v"), E.format("Q13133"), STATEMENTS),
+    (E.format("Q76S1"), E.format("P580q"), "_:t1", STATEMENTS),
+    ("_:t1", TIME, '"1992-10-03T00:00:00Z"^^<http://www.w3.org/2001/XMLSchema#dateTime>', STATEMENTS),
+    # Barack Obama, place of birth Honolulu, located in Hawaii, located in USA
+    (E.format("Q76"), E.format("P19s"), E.format("Q76S2"), STATEMENTS),
+    (E.format("Q76S2"), E.format("P19v"), E.format("Q18094"), STATEMENTS),
+    (E.format("Q18094"), E.format("P131s"), E.format("Q18094S1"), STATEMENTS),
+    (E.format("Q18094S1"), E.format("P131v"), E.format("Q782"), STATEMENTS),
+    (E.format("Q782"), E.format("P131s"), E.format("Q782S1"), STATEMENTS),
+    (E.format("Q782S1"), E.format("P131v"), E.format("Q30"), STATEMENTS),
+    (E.format("Q76"), RDF_TYPE, E.format("Q82955"), INSTANCES),
+    (E.format("Q82955"), SUBCLASS_OF, E.format("Q5"), INSTANCES),
+    (E.format("Q76"), E.format("P31c"), E.format("Q5"), SIMPLE_STATEMENTS),
+]
+
+
+@pytest.fixture(scope="module")
+def store(tmpdir_factory):
+    path = tmpdir_factory.mktemp("store").join("subset.nq")
+    path.write("\n".join(" ".join(t) + " ." for t in dump) + "\n")
+    store = local_store.TripleStore.from_file(str(path))
+    query_cache.set_local_backend(store)
+    graph_queries.reset_memo()
+    yield store
+    query_cache.set_local_backend(None)
+    graph_queries.reset_memo()
+
+
+def test_load(store):
+    assert store.size == len(dump)
+    assert list(store.triples(s="Q76S1", p="P26v")) == [("Q76S1", "P26v", "Q13133")]
+
+
+def test_groundings(store):
+    g = SemanticGraph([Edge(leftentityid="Q76", rightentityid=graph_queries.QUESTION_VAR)])
+    groundings = store.query(graph_queries.graph_to_query(g))
+    assert sorted(r['r0v'] for r in groundings if r['r0v'].endswith("v")) == ["P19v", "P26v"]
+
+
+def test_time_filter(store):
+    g = SemanticGraph([Edge(leftentityid="Q76", rightentityid=graph_queries.QUESTION_VAR, qualifierentityid="1992")])
+    assert {'r0v': 'P26v'} in store.query(graph_queries.graph_to_query(g))
+    g = SemanticGraph([Edge(leftentityid="Q76", rightentityid=graph_queries.QUESTION_VAR, qualifierentityid="1993")])
+    assert store.query(graph_queries.graph_to_query(g)) == []
+
+
+def test_ask(store):
+    g = SemanticGraph([Edge(leftentityid="Q76", relationid="P26", rightentityid="Q13133")])
+    assert store.query(graph_queries.graph_to_ask(g)) is True
+    g = SemanticGraph([Edge(leftentityid="Q76", relationid="P19", rightentityid="Q13133")])
+    assert store.query(graph_queries.graph_to_ask(g)) == []
+
+
+def test_transitive(store):
+    g = SemanticGraph([Edge(leftentityid="Q18094", relationid="P131", rightentityid=graph_queries.QUESTION_VAR)])
+    denotations = store.query(graph_queries.graph_to_query(g))
+    assert sorted(d[graph_queries.QUESTION_VAR[1:]] for d in denotations) == ["Q30", "Q782"]
+    g = SemanticGraph([Edge(leftentityid="Q18094", relationid="P131", rightentityid="Q30")])
+    assert store.query(graph_queries.graph_to_ask(g)) == []
+
+
+def test_class(store):
+    g = SemanticGraph([Edge(leftentityid=graph_queries.QUESTION_VAR, relationid="P26", rightentityid="Q13133"),
+                       Edge(leftentityid=graph_queries.QUESTION_VAR, relationid="class", rightentityid="Q5")])
+    assert store.query(graph_queries.graph_to_ask(g)) is True
+    g = SemanticGraph([Edge(leftentityid="Q76", relationid="P26", rightentityid=graph_queries.QUESTION_VAR),
+                       Edge(leftentityid=graph_queries.QUESTION_VAR, relationid="iclass")])
+    assert store.query(graph_queries.graph_to_query(g)) == []
+
+
+def test_batch_verification(store):
+    graphs = [SemanticGraph([Edge(leftentityid="Q76", relationid="P19", rightentityid="Q13133")]),
+              SemanticGraph([Edge(leftentityid="Q76", relationid="P26", rightentityid="Q13133")])]
+    assert graph_queries.verify_groundings(graphs) == [False, True]
+
+
+def test_neighbourhood_index(store, tmpdir):
+    path = str(tmpdir.join("neighbourhood.jsonl.gz"))
+    assert neighbourhood_index.build_index(["Q76", "Q18094"], path) == 2
+    assert neighbourhood_index.build_index(["Q76"], path) == 0
+    index = neighbourhood_index.NeighbourhoodIndex(path)
+    for g in neighbourhood_index.entity_shapes("Q76") + neighbourhood_index.entity_shapes("Q18094"):
+        for e in g.edges:
+            e.edgeid += 1
+        expected = store.query(graph_queries.graph_to_query(g, limit=500))
+        assert index.get_groundings(g) == expected
+    assert index.get_groundings(SemanticGraph([Edge(leftentityid="Q30", rightentityid=graph_queries.QUESTION_VAR)])) is None
+
+
+def test_neighbourhood_index_resume(store, tmpdir):
+    path = str(tmpdir.join("neighbourhood.jsonl.gz"))
+    assert neighbourhood_index.build_index(["Q76"], path) == 1
+    # A job killed in the middle of a write leaves an incomplete line in the partial file
+    with open(path + ".partial", "w") as f:
+        f.write('{"entity": "Q18094", "sha')
+    assert neighbourhood_index.build_index(["Q76", "Q18094"], path) == 1
+    assert {e['entity'] for e in neighbourhood_index.read_entries(path)} == {"Q76", "Q18094"}
+    with open(path, "rb") as f:
+        content = f.read()
+    with open(path, "wb") as f:
+        f.write(content[:len(content) // 2])
+    index = neighbourhood_index.NeighbourhoodIndex(path)
+    assert index.entities <= {"Q76", "Q18094"}
@@ -5,6 +5,7 @@ import random
 import numpy as np
 import torch
 from torch import nn as nn
+from torch.nn import functional as F
 
 import fackel
 
@@ -21,6 +22,39 @@ with open(_utils.RESOURCES_FOLDER + "../data/generated/webqsp.examples.train.sil
     dataset = json.load(f,  object_hook=sentence.sentence_object_hook)
 
 
+def _variable_margin_loss_reference(predictions, target):
+    # Loop over the samples and the target positions with F.multi_margin_loss
+    loss = torch.zeros(1)
+    target_sorted, target_indices = torch.sort(target, dim=-1, descending=True)
+    predictions = predictions.gather(1, target_indices)
+    margins = losses.DEFAULT_MARGIN * target_sorted.data
+    for sample_index in range(target_indices.size(0)):
+        target_index = 0
+        while target_index < min(target_indices.size(1), 10) and \
+                (target_sorted[sample_index, target_index].item() > losses.MIN_TARGET_VALUE):
+            loss += F.multi_margin_loss(predictions[sample_index, target_index:].unsqueeze(0),
+                                        torch.LongTensor([0]),
+                                        margin=margins[sample_index, target_index].item(),
+                                        reduction='sum')
+            target_index += 1
+    return loss
+
+
+def test_variable_margin_loss_batched():
+    criterion = losses.VariableMarginLoss()
+    torch.manual_seed(1)
+    for num_graphs in [1, 5, 100]:
+        target = torch.rand(64, num_graphs)
+        target[target < 0.5] = 0.0
+        predictions = torch.randn(64, num_graphs, requires_grad=True)
+        loss = criterion(predictions, target)
+        gradients, = torch.autograd.grad(loss, predictions)
+        reference_loss = _variable_margin_loss_reference(predictions, target)
+        reference_gradients, = torch.autograd.grad(reference_loss, predictions)
+        assert torch.allclose(loss, reference_loss, atol=1e-4)
+        assert torch.allclose(gradients, reference_gradients, atol=1e-6)
+
+
 def test_variable_margin_loss():
     encoder = ConvWordsEncoder(*wordembeddings.shape)
     encoder.load_word_embeddings_from_numpy(wordembeddings)
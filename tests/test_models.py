@@ -1,6 +1,7 @@
 import pytest
 import json
 import random
+import copy
 
 import numpy as np
 import torch
@@ -12,7 +13,8 @@ from questionanswering.construction import sentence
 from questionanswering import _utils
 from questionanswering.models.lexical_baselines import OneEdgeModel, STAGGModel, PooledEdgesModel
 from questionanswering.models.modules import ConvWordsEncoder
-from questionanswering.models import vectorization as V, losses
+from questionanswering.models.gnn import GNNModel
+from questionanswering.models import vectorization as V, losses, traced, slim
 
 wordembeddings, word2idx = V.extend_embeddings_with_special_tokens(
     *_utils.load_word_embeddings(_utils.RESOURCES_FOLDER + "../../resources/embeddings/glove/glove.6B.100d.txt")
@@ -91,6 +93,96 @@ def test_stagg_model():
     container.train(train=(train_questions, train_edges, train_features), train_targets=np.zeros(len(training_dataset), dtype=np.int32))
 
 
+def test_score_graphs():
+    for model_type in ["OneEdgeModel", "STAGGModel", "PooledEdgesModel"]:
+        encoder = ConvWordsEncoder(*wordembeddings.shape)
+        encoder.load_word_embeddings_from_numpy(wordembeddings)
+        net = globals()[model_type](encoder)
+        net.eval()
+        s = training_dataset[0]
+        samples = [torch.from_numpy(np.ascontiguousarray(m)) for m in V.encode_for_model([s], model_type, word2idx)]
+        question_vector = net.encode_question(samples[0])[0]
+        graphs = [torch.from_numpy(np.ascontiguousarray(m[0]))
+                  for m in V.encode_graphs_for_model([s], model_type, word2idx)]
+        assert torch.allclose(net(*samples)[0], net.score_graphs(question_vector, *graphs), atol=1e-6)
+
+
+def test_traced_model(tmpdir):
+    # The held-out batch has more questions and more graphs per question than the trace batch
+    trace_questions = [copy.copy(s) for s in training_dataset[:2]]
+    for s in trace_questions:
+        s.graphs = s.graphs[:2]
+    for model_type, parameters in [("OneEdgeModel", {}), ("STAGGModel", {}), ("PooledEdgesModel", {}),
+                                   ("GNNModel", {'hp_propagation': "dense"}),
+                                   ("GNNModel", {'hp_propagation': "sparse"})]:
+        encoder = ConvWordsEncoder(*wordembeddings.shape)
+        encoder.load_word_embeddings_from_numpy(wordembeddings)
+        net = globals()[model_type](encoder, **parameters)
+        trace_batch, check_batch = [[torch.from_numpy(np.ascontiguousarray(m))
+                                     for m in V.encode_for_model(batch, model_type, word2idx)]
+                                    for batch in (trace_questions, training_dataset[2:])]
+        assert all(check_batch[1].size(d) > trace_batch[1].size(d) for d in (0, 1))
+        traced_model = traced.trace_model(net, *trace_batch)
+        assert traced.check_parity(net, traced_model, *check_batch) < 1e-5
+        path_to_model = str(tmpdir.join(f"{model_type}.{parameters.get('hp_propagation', '')}.traced.pt"))
+        traced.save_traced_model(traced_model, path_to_model, model_type, description="test")
+        container = traced.TracedModelContainer(path_to_model)
+        assert traced.get_model_type(container) == model_type
+        with torch.no_grad():
+            assert torch.allclose(net(*check_batch),
+                                  container.predict_batchwise(*[m.numpy() for m in check_batch]), atol=1e-5)
+
+
+def test_slim_model(tmpdir):
+    encoder = ConvWordsEncoder(*wordembeddings.shape)
+    encoder.load_word_embeddings_from_numpy(wordembeddings)
+    net = OneEdgeModel(encoder)
+    net.eval()
+    samples = V.encode_for_model(training_dataset, "OneEdgeModel", word2idx)
+    used_indices = set(np.unique(np.concatenate([m.ravel() for m in samples])))
+    kept_indices, compact_word2idx = V.prune_vocabulary(word2idx, [w for w, idx in word2idx.items()
+                                                                   if idx in used_indices])
+    path_to_model = str(tmpdir.join("OneEdgeModel_test" + slim.SLIM_MODEL_EXTENSION))
+    with torch.no_grad():
+        scores = net(*[torch.from_numpy(np.ascontiguousarray(m)) for m in samples])
+    slim.save_slim_model(slim.prune_model(net, kept_indices), path_to_model)
+    _utils.save_vocabulary(compact_word2idx, len(kept_indices), str(tmpdir.join("OneEdgeModel_test.slim.vocab")))
+
+    slim_net = slim.load_slim_model(path_to_model)
+    slim_net.eval()
+    assert slim_net._tokens_encoder._word_embedding.num_embeddings == len(kept_indices)
+    slim_samples = V.encode_for_model(training_dataset, "OneEdgeModel", V.load_model_vocabulary(path_to_model))
+    with torch.no_grad():
+        assert torch.allclose(scores, slim_net(*[torch.from_numpy(np.ascontiguousarray(m)) for m in slim_samples]),
+                              atol=1e-6)
+
+
+def test_encoding_memo():
+    V.reset_encoding_memo()
+    memoized = V.encode_batch_graphs(training_dataset, word2idx), V.encode_batch_graph_structure(training_dataset, word2idx)
+    assert V.encoding_memo_stats()['hits'] > 0
+    V.MEMOIZE_ENCODINGS = False
+    try:
+        direct = V.encode_batch_graphs(training_dataset, word2idx), V.encode_batch_graph_structure(training_dataset, word2idx)
+    finally:
+        V.MEMOIZE_ENCODINGS = True
+    assert np.array_equal(memoized[0], direct[0])
+    assert all(np.array_equal(m, d) for m, d in zip(memoized[1], direct[1]))
+
+
+def test_encoding_cache(tmpdir):
+    path_to_cache = str(tmpdir.join(V.get_encoding_cache_key([], "GNNModel", word2idx)))
+    assert V.load_encoded(path_to_cache) is None
+    samples = V.encode_for_model(training_dataset, "GNNModel", word2idx)
+    targets = np.random.rand(len(training_dataset), samples[1].shape[1])
+    V.save_encoded(path_to_cache, samples, targets)
+    cached_samples, cached_targets = V.load_encoded(path_to_cache)
+    assert len(cached_samples) == len(samples)
+    assert all(np.array_equal(m, c) for m, c in zip(samples, cached_samples))
+    assert np.array_equal(targets, cached_targets)
+    assert V.get_encoding_cache_key([], "GNNModel", word2idx) != V.get_encoding_cache_key([], "STAGGModel", word2idx)
+
+
 def test_metrics():
     encoder = ConvWordsEncoder(*wordembeddings.shape)
     encoder.load_word_embeddings_from_numpy(wordembeddings)
@@ -12,5 +12,21 @@ def test_batch_similarity():
     assert predictions.size() == (8, 50)
 
 
+def test_score_without_padding():
+    questions = torch.randn(4, 16)
+    graphs = torch.zeros(4, 10, 16)
+    graphs[:, :3] = torch.randn(4, 3, 16)
+    graphs[1, 5] = torch.randn(16)
+    layer = torch.nn.Linear(16, 16)
+
+    def score(question_vectors, graphs_m):
+        return modules.batchmv_cosine_similarity(layer(graphs_m), question_vectors)
+
+    predictions = modules.score_without_padding(score, questions, graphs)
+    assert predictions.size() == (4, 10)
+    assert torch.allclose(predictions, score(questions, graphs), atol=1e-6)
+    assert modules.used_size(graphs, 1) == 6
+
+
 if __name__ == '__main__':
     pytest.main(['-v', __file__])
@@ -0,0 +1,116 @@
+import collections
+import copy
+
+import numpy as np
+import pytest
+import torch
+
+from questionanswering.construction.sentence import Sentence
+from questionanswering.construction.graph import SemanticGraph, Edge, WithScore
+from questionanswering.datasets import negative_mining
+from questionanswering import models
+from questionanswering.models import vectorization as V
+
+
+class LengthModel:
+    def __init__(self):
+        self.scored = 0
+
+    def scores_for_instance(self, instance):
+        self.scored += 1
+        return [len(g) for g in instance[1]]
+
+
+pools = {0: (["who"], ["a", "abc", "ab"]), 1: None, 2: (["what"], ["abcd", "a"])}
+
+
+def test_negative_scores():
+    model = LengthModel()
+    cache = negative_mining.NegativeScoreCache(len(pools), refresh_interval=2, batch_size=2)
+    assert cache.next_epoch(model, [0, 1, 2], pools.get)
+    assert model.scored == 2
+    assert np.array_equal(cache.get_scores(0), [1, 3, 2])
+    assert len(cache.get_scores(1)) == 0
+    assert np.array_equal(cache.get_scores(2), [4, 1])
+    assert not cache.next_epoch(model, [0, 1, 2], pools.get)
+    assert model.scored == 2
+    assert cache.next_epoch(model, [2], pools.get)
+    assert len(cache.get_scores(0)) == 0
+    assert np.array_equal(cache.get_scores(2), [4, 1])
+
+
+words = ["<pad>", "<unk>", "who", "is", "the", "wife", "of", "obama", "spouse", "father", "child"] + \
+        list(V.SPECIAL_TOKENS.values()) + list(V.SENT_TOKENS) + [V.ENTITY_TOKEN]
+word2idx = collections.defaultdict(lambda: 1, {w: i for i, w in enumerate(words)})
+
+
+def encode_instances(instances):
+    sentences = []
+    for s, pool in instances:
+        s = copy.copy(s)
+        s.graphs = [WithScore(g, (0.0, 0.0, 0.0)) for g in pool]
+        sentences.append(s)
+    return V.encode_for_model(sentences, "OneEdgeModel", word2idx)
+
+
+def test_batched_scores():
+    torch.manual_seed(1)
+    tokens = "who is the wife of obama".split()
+    s = Sentence(input_text=" ".join(tokens),
+                 tagged=[{'originalText': t, 'word': t, 'pos': 'NN', 'ner': 'O', 'index': i + 1}
+                         for i, t in enumerate(tokens)],
+                 entities=[{"type": "NNP", "linkings": [("Q76", "obama")], 'token_ids': [5]}])
+    relations = ["P26", "P22", "P40"]
+    instances = [(s, [SemanticGraph([Edge(leftentityid="?qvar", rightentityid="Q76", relationid=relations[j % 3])])
+                      for j in range(i, i + n)])
+                 for i, n in enumerate([3, 1, 5])]
+    net = models.OneEdgeModel(hp_vocab_size=len(words), hp_word_emb_size=8, hp_conv_size=8)
+    calls = []
+    net.register_forward_hook(lambda *args: calls.append(True))
+    batched = negative_mining.score_instances(net, instances, encode=encode_instances)
+    assert len(calls) == 1
+    assert [len(scores) for scores in batched] == [3, 1, 5]
+    for instance, scores in zip(instances, batched):
+        assert np.allclose(scores, negative_mining.score_instances(net, [instance], encode=encode_instances)[0],
+                           atol=1e-6)
+
+    cache = negative_mining.NegativeScoreCache(3, batch_size=3, encode=encode_instances)
+    cache.refresh(net, [0, 1, 2], dict(enumerate(instances)).get)
+    assert len(calls) == 5
+    assert np.allclose(cache.get_scores(2), batched[2], atol=1e-6)
+
+    # The mode of the model is restored after scoring
+    for training in [True, False]:
+        net.train(training)
+        cache.refresh(net, [0, 1, 2], dict(enumerate(instances)).get)
+        assert net.training == training
+
+
+def test_wide_pool_scores(monkeypatch):
+    torch.manual_seed(1)
+    tokens = "who is the wife of obama".split()
+    s = Sentence(input_text=" ".join(tokens),
+                 tagged=[{'originalText': t, 'word': t, 'pos': 'NN', 'ner': 'O', 'index': i + 1}
+                         for i, t in enumerate(tokens)],
+                 entities=[{"type": "NNP", "linkings": [("Q76", "obama")], 'token_ids': [5]}])
+    relations = ["P26", "P22", "P40"]
+    instances = [(s, [SemanticGraph([Edge(leftentityid="?qvar", rightentityid="Q76", relationid=relations[j % 3])])
+                      for j in range(n)])
+                 for n in [7, 2]]
+    net = models.OneEdgeModel(hp_vocab_size=len(words), hp_word_emb_size=8, hp_conv_size=8)
+    calls = []
+    net.register_forward_hook(lambda *args: calls.append(True))
+    scores = negative_mining.score_instances(net, instances, encode=encode_instances)
+    monkeypatch.setattr(V, "MAX_NEGATIVE_GRAPHS", 3)
+    chunked_scores = negative_mining.score_instances(net, instances, encode=encode_instances)
+    assert len(calls) == 2
+    assert [len(pool_scores) for pool_scores in chunked_scores] == [7, 2]
+    assert all(np.allclose(a, b, atol=1e-6) for a, b in zip(scores, chunked_scores))
+
+    # An encoding that keeps fewer graphs than the limit can't score the pools
+    def encode_two_graphs(chunks):
+        questions, *graphs = encode_instances(chunks)
+        return [questions] + [m[:, :2] for m in graphs]
+
+    with pytest.raises(ValueError, match="MAX_NEGATIVE_GRAPHS"):
+        negative_mining.score_instances(net, instances, encode=encode_two_graphs)
@@ -0,0 +1,35 @@
+import multiprocessing
+
+from questionanswering.grounding import query_cache
+
+
+def _fill_cache(path, worker):
+    query_cache.set_cache(query_cache.SparqlCache(path))
+    query_cache.reopen_cache()
+    for i in range(200):
+        query_cache.CACHE.put(f"ASK {{ e:Q{i} ?p ?o }}", {}, True)
+        assert query_cache.CACHE.get(f"ASK {{ e:Q{i} ?p ?o }}", {}) is True
+        query_cache.CACHE.put(f"ASK {{ e:Q{i} e:P{worker} ?o }}", {}, [])
+    query_cache.CACHE.close()
+
+
+def test_shared_file(tmpdir):
+    path = str(tmpdir.join("sparql.sqlite"))
+    processes = [multiprocessing.get_context("fork").Process(target=_fill_cache, args=(path, worker))
+                 for worker in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0] * 4
+    cache = query_cache.SparqlCache(path, read_only=True)
+    assert cache.stats()['size'] == 200 + 4 * 200
+    assert cache.get("ASK { e:Q1 e:P3 ?o }", {}) == []
+
+
+def test_backend_key():
+    cache = query_cache.SparqlCache(":memory:")
+    cache.put("ASK { ?s ?p ?o }", {}, True)
+    cache.put("ASK { ?s ?p ?o }", {}, [], backend="local:subset.nq")
+    assert cache.get("ASK { ?s ?p ?o }", {}) is True
+    assert cache.get("ASK { ?s ?p ?o }", {}, backend="local:subset.nq") == []
@@ -0,0 +1,187 @@
+import pytest
+
+import collections
+import copy
+import glob
+import os
+
+import yaml
+
+import numpy as np
+import torch
+
+from questionanswering.construction.sentence import Sentence, write_sentences_jsonl
+from questionanswering.construction.graph import SemanticGraph, Edge, WithScore
+from questionanswering.grounding import graph_queries
+from questionanswering import models, train_model
+from questionanswering.models import vectorization as V, losses, training
+
+words = ["<pad>", "<unk>", "who", "is", "the", "wife", "of", "obama", "spouse", "father", "human"] + \
+        list(V.SPECIAL_TOKENS.values()) + list(V.SENT_TOKENS) + [V.ENTITY_TOKEN]
+word2idx = collections.defaultdict(lambda: 1, {w: i for i, w in enumerate(words)})
+
+
+def make_sentence(num_graphs):
+    tokens = "who is the wife of obama".split()
+    s = Sentence(input_text=" ".join(tokens),
+                 tagged=[{'originalText': t, 'word': t, 'pos': 'NN', 'ner': 'O', 'index': i + 1}
+                         for i, t in enumerate(tokens)],
+                 entities=[{"type": "NNP", "linkings": [("Q76", "obama")], 'token_ids': [5]}])
+    s.graphs = [WithScore(SemanticGraph([Edge(leftentityid=graph_queries.QUESTION_VAR, rightentityid="Q76",
+                                              relationid="P26" if gi == 0 else "P22")] * (gi % 3 + 1)),
+                          (0.0, 0.0, 1.0 if gi == 0 else 0.0))
+                for gi in range(num_graphs)]
+    return s
+
+
+def accuracy(targets, predictions, validation=False):
+    return {'acc': float((predictions.argmax(dim=-1) == targets.argmax(dim=-1)).float().mean())}
+
+
+def test_encoded_data_batch(tmpdir):
+    questions = [make_sentence(n) for n in (2, 5, 3, 4)]
+    samples = V.encode_for_model(questions, "OneEdgeModel", word2idx)
+    targets = np.arange(4 * 5, dtype=np.float64).reshape(4, 5)
+    V.save_encoded(str(tmpdir.join("entry")), samples, targets)
+    samples, targets = V.load_encoded(str(tmpdir.join("entry")))
+    graph_order = np.array([np.roll(np.arange(5), i) for i in range(4)])
+    data = training.EncodedData(samples, targets, graph_order, question_order=[3, 1, 0, 2])
+    batch_samples, batch_targets = data.batch([0, 2])
+    assert batch_targets.tolist() == [targets[3][graph_order[3]].tolist(), targets[0].tolist()]
+    assert np.array_equal(batch_samples[0], samples[0][[3, 0]])
+    assert np.array_equal(batch_samples[1][0], samples[1][3][graph_order[3]])
+    # The stored arrays stay memory-mapped
+    assert all(isinstance(m, np.memmap) for m in data.samples) and isinstance(data.targets, np.memmap)
+
+    # A batch is padded to its largest number of graphs
+    data = training.EncodedData(samples, targets, question_order=[0, 2, 1, 3],
+                                graph_counts=[len(questions[qi].graphs) for qi in [0, 2, 1, 3]])
+    batch_samples, batch_targets = data.batch([0, 1])
+    assert batch_targets.shape == (2, 3) and batch_samples[1].shape[:2] == (2, 3)
+    assert data.batch([2, 3])[1].shape == (2, 5)
+
+
+def test_train():
+    np.random.seed(1)
+    torch.manual_seed(1)
+    questions = [make_sentence(n) for n in (2, 5, 3, 4, 1, 2)]
+    targets = np.array([[g.scores[2] for g in s.graphs] + [0.0] * (5 - len(s.graphs)) for s in questions])
+    data = training.EncodedData(V.encode_for_model(questions, "OneEdgeModel", word2idx), targets)
+    net = models.OneEdgeModel(hp_vocab_size=len(words), hp_word_emb_size=8, hp_conv_size=8)
+    saved = []
+    log_history = training.train(net, losses.VariableMarginLoss(), torch.optim.Adam(net.parameters()), accuracy,
+                                 data, dev_data=data, save_model=lambda: saved.append(True),
+                                 batch_size=4, max_epochs=3, early_stopping=0)
+    assert len(log_history) == 3 and len(saved) >= 1
+    assert all(np.isfinite(epoch['loss']) for epoch in log_history)
+    predictions, predicted_targets = training.predict(net, data, batch_size=4)
+    assert predictions.shape == (6, 5)
+    assert predicted_targets.tolist() == targets.tolist()
+
+
+def test_train_with_workers():
+    questions = [make_sentence(n) for n in (2, 5, 3, 4, 1, 2, 3)]
+    targets = np.array([[g.scores[2] for g in s.graphs] + [0.0] * (5 - len(s.graphs)) for s in questions])
+    data = training.EncodedData(V.encode_for_model(questions, "OneEdgeModel", word2idx), targets)
+    log_histories = []
+    for num_workers in [0, 2]:
+        np.random.seed(1)
+        torch.manual_seed(1)
+        net = models.OneEdgeModel(hp_vocab_size=len(words), hp_word_emb_size=8, hp_conv_size=8)
+        log_histories.append(training.train(net, losses.VariableMarginLoss(), torch.optim.Adam(net.parameters()),
+                                            accuracy, data, batch_size=2, max_epochs=2, num_workers=num_workers))
+    assert log_histories[0] == log_histories[1]
+
+
+def test_train_buckets():
+    np.random.seed(1)
+    torch.manual_seed(1)
+    questions = [make_sentence(n) for n in (1, 1, 2, 2, 5, 4, 3)]
+    targets = np.array([[g.scores[2] for g in s.graphs] + [0.0] * (5 - len(s.graphs)) for s in questions])
+    data = training.EncodedData(V.encode_for_model(questions, "OneEdgeModel", word2idx), targets,
+                                graph_counts=[len(s.graphs) for s in questions], bucket_size=2)
+    batches = []
+    gather_batch = data.batch
+    data.batch = lambda indices: batches.append(list(indices)) or gather_batch(indices)
+    net = models.OneEdgeModel(hp_vocab_size=len(words), hp_word_emb_size=8, hp_conv_size=8)
+    training.train(net, losses.VariableMarginLoss(), torch.optim.Adam(net.parameters()), accuracy,
+                   data, batch_size=4, max_epochs=3, early_stopping=0)
+    # Each epoch has four training batches and two batches of the evaluation on the training data
+    epochs = [batches[i:i + 4] for i in range(0, len(batches), 6)]
+    assert len(epochs) == 3
+    assert all(sorted(epoch) == [[0, 1], [2, 3], [4, 5], [6]] for epoch in epochs)
+    assert any(epoch != epochs[0] for epoch in epochs)
+    predictions, predicted_targets = training.predict(net, data, batch_size=2)
+    assert predictions.shape == (7, 5) and torch.isinf(predictions[0, 1:]).all()
+    assert predicted_targets.tolist() == targets.tolist()
+
+
+@pytest.mark.parametrize("path_to_config",
+                         sorted(glob.glob(os.path.join(os.path.dirname(__file__), "../configs/train_*.yaml"))))
+def test_train_config(tmpdir, path_to_config):
+    with open(path_to_config) as config_file:
+        config = yaml.safe_load(config_file)['training']
+    np.random.seed(1)
+    # A seed for which the small model keeps changing after the last checkpoint
+    torch.manual_seed(2)
+    questions = [make_sentence(n) for n in (2, 5, 3, 4, 1, 2)]
+    targets = np.array([[g.scores[2] for g in s.graphs] + [0.0] * (5 - len(s.graphs)) for s in questions])
+    data = training.EncodedData(V.encode_for_model(questions, "OneEdgeModel", word2idx), targets)
+    net = models.OneEdgeModel(hp_vocab_size=len(words), hp_word_emb_size=8, hp_conv_size=8)
+    optimizer = torch.optim.Adam(net.parameters(), lr=0.01)
+    # The monitored metric improves in the first three epochs and then never again
+    monitored_values = iter([0.1, 0.3, 0.5] + [0.2] * config['max_epochs'])
+    evaluated_weights = []
+
+    def metrics(targets, predictions, validation=False):
+        evaluated_weights.append(copy.deepcopy(net.state_dict()))
+        return {'acc': 0.0, 'f1': 0.0, config['monitor']: next(monitored_values)}
+
+    checkpoints = []
+
+    def save_model():
+        checkpoints.append(str(tmpdir.join(f"checkpoint{len(checkpoints)}.pt")))
+        torch.save(net.state_dict(), checkpoints[-1])
+
+    log_history = training.train(net, losses.VariableMarginLoss(), optimizer, metrics, data, dev_data=data,
+                                 save_model=save_model if config['model_checkpoint'] else None,
+                                 **{k: v for k, v in config.items() if k in training.TRAINING_PARAMETERS})
+    assert len(log_history) == min(3 + config['early_stopping'], config['max_epochs'])
+    assert optimizer.param_groups[0]['lr'] == 0.01 / 2 ** (config['early_stopping'] // config['lr_decay'])
+    assert len(checkpoints) == 3
+    net.load_state_dict(torch.load(checkpoints[-1]))
+    assert all(torch.equal(net.state_dict()[k], evaluated_weights[2][k]) for k in evaluated_weights[2])
+    assert not all(torch.equal(net.state_dict()[k], evaluated_weights[-1][k]) for k in evaluated_weights[-1])
+
+
+@pytest.mark.parametrize("batch_loop_parameter", [None, "bucketing", "encoding.cache"])
+def test_train_model(tmpdir, monkeypatch, capsys, batch_loop_parameter):
+    np.random.seed(1)
+    path_to_dataset = str(tmpdir.join("silver.jsonl"))
+    write_sentences_jsonl([make_sentence(n) for n in (2, 5, 3, 4, 1)], path_to_dataset)
+    config = {
+        'logger': {'level': 'ERROR'},
+        'training': {'path_to_dataset': path_to_dataset, 'path_to_validation': path_to_dataset,
+                     'save_to_dir': str(tmpdir.join("models")) + "/", 'model_type': "OneEdgeModel",
+                     'model_checkpoint': True, 'batch_size': 2, 'max_epochs': 1, 'monitor': "f1",
+                     'early_stopping': 5, 'lr_decay': 5},
+        'model': {'hp_conv_size': 8},
+    }
+    if batch_loop_parameter is not None:
+        config['training'][batch_loop_parameter] = True if batch_loop_parameter == "bucketing" \
+            else str(tmpdir.join("encoded"))
+    else:
+        # The default configuration is trained by the container
+        monkeypatch.setattr(training, "train", None)
+    path_to_config = str(tmpdir.join("train.yaml"))
+    with open(path_to_config, 'w') as out:
+        yaml.dump(config, out)
+    embeddings = np.random.randn(len(words), 8)
+    monkeypatch.setattr(V, "load_word_embeddings_with_special_tokens", lambda path: (embeddings, word2idx))
+    train_model.train.callback(path_to_config, 1, -1, "test", "")
+    output = capsys.readouterr().out
+    assert "Acc: " in output and "F1: " in output
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])